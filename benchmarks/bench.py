@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+# benchmarks of the vcs commands, run through the libvcs api on a synthetic repository
+# every benchmark runs in a forked process, so that it's peak memory and io counters aren't mixed with the ones
+# of the other benchmarks. Results are written as json and two result files can be compared.
+#
+# usage: python3 benchmarks/bench.py run [--files N] [--depth N] [--size BYTES] [--size-dist DIST] [--binary FRACTION]
+#                                       [--commits N] [--churn FRACTION] [--seed N] [--config SECTION.KEY=VALUE ...]
+#                                       [--dir DIR] [-o FILE]
+#        python3 benchmarks/bench.py compare OLD NEW [--threshold FRACTION]
+
+import argparse
+import collections
+import configparser
+import contextlib
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import libvcs
+import synthetic
+
+RESULT_VERSION = 1
+# counters of /proc/self/io reported by the benchmarks: bytes passed to read and write calls and bytes which
+# actually went to or came from the storage
+IO_COUNTERS = ["rchar", "wchar", "read_bytes", "write_bytes"]
+
+
+def proc_io():
+    """Returns the io counters of the process, or an empty dictionary when /proc/self/io isn't available"""
+    try:
+        with open("/proc/self/io") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return dict()
+    counters = dict()
+    for line in lines:
+        key, _, value = line.partition(":")
+        if key in IO_COUNTERS:
+            counters[key] = int(value)
+    return counters
+
+
+class benchMeter(object):
+    """Accumulates the time and io of the measured operations of a benchmark"""
+    def __init__(self):
+        self.seconds = 0.0
+        self.ops = 0
+        self.items = 0
+        self.io = collections.Counter()
+
+    @contextlib.contextmanager
+    def measure(self, ops=1, items=0):
+        """Measures the block as ops operations processing items items (files, commits ...)"""
+        before = proc_io()
+        start = time.perf_counter()
+        yield
+        self.seconds += time.perf_counter() - start
+        after = proc_io()
+        for key in after:
+            self.io[key] += after[key] - before.get(key, 0)
+        self.ops += ops
+        self.items += items
+
+    def result(self):
+        res = collections.OrderedDict()
+        res["ops"] = self.ops
+        res["seconds"] = self.seconds
+        res["ops_per_sec"] = self.ops / self.seconds if self.seconds else None
+        if self.items:
+            res["items"] = self.items
+            res["items_per_sec"] = self.items / self.seconds if self.seconds else None
+        # kilobytes on linux
+        res["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        for key in IO_COUNTERS:
+            res[key] = self.io[key] if key in self.io else None
+        return res
+
+
+def run_forked(fn):
+    """Runs fn in a child process, with it's standard output discarded, and returns the result it returned"""
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        try:
+            result = fn()
+        except BaseException:
+            result = {"error": traceback.format_exc()}
+        with os.fdopen(w, "w") as f:
+            json.dump(result, f)
+        os._exit(0)
+    os.close(w)
+    with os.fdopen(r) as f:
+        data = f.read()
+    os.waitpid(pid, 0)
+    result = json.loads(data)
+    if "error" in result:
+        raise Exception("Benchmark failed:\n" + result["error"])
+    return result
+
+
+def vcs(*argv):
+    """Runs a vcs command in process"""
+    libvcs.main(list(argv))
+
+
+def bench_init(root, repeat=20):
+    meter = benchMeter()
+    for i in range(repeat):
+        path = os.path.join(root, "init", str(i))
+        os.makedirs(path)
+        with meter.measure():
+            libvcs.repo_create(path)
+    return meter.result()
+
+
+def bench_commit_cold(worktree, shape):
+    """First commit of the worktree: every file is hashed and written"""
+    meter = benchMeter()
+    with meter.measure(items=shape.files):
+        vcs("commit", "initial")
+    return meter.result()
+
+
+def bench_commit_history(worktree, paths, shape):
+    """Commits of the history, each one after modifying shape.churn of the files"""
+    meter = benchMeter()
+    rng = random.Random(shape.seed + 1)
+    for i in range(1, shape.commits):
+        changed = synthetic.changed_files(paths, rng, shape)
+        synthetic.write_files(worktree, changed, rng, shape)
+        with meter.measure(items=len(changed)):
+            vcs("commit", "commit {0}".format(i))
+    return meter.result()
+
+
+def bench_commit_noop(repeat=5):
+    """Commit of a worktree which didn't change since the last commit"""
+    meter = benchMeter()
+    for _ in range(repeat):
+        with meter.measure():
+            vcs("commit", "nothing")
+    return meter.result()
+
+
+def bench_status(repeat=5):
+    meter = benchMeter()
+    for _ in range(repeat):
+        with meter.measure():
+            vcs("status")
+    return meter.result()
+
+
+def bench_log(shape, repeat=5):
+    meter = benchMeter()
+    for _ in range(repeat):
+        with meter.measure(items=shape.commits):
+            vcs("log", "HEAD")
+    return meter.result()
+
+
+def bench_ls_tree(repeat=20):
+    repo = libvcs.repo_find()
+    tree = libvcs.object_find(repo, "HEAD", fmt=b'tree')
+    meter = benchMeter()
+    for _ in range(repeat):
+        with meter.measure():
+            vcs("ls-tree", tree)
+    return meter.result()
+
+
+def bench_cat_file(shape, count=200):
+    repo = libvcs.repo_find()
+    shas = sorted(entry.sha for entry in libvcs.index_read(repo).entries.values())
+    shas = random.Random(shape.seed).sample(shas, min(count, len(shas)))
+    meter = benchMeter()
+    for sha in shas:
+        with meter.measure():
+            vcs("cat-file", "blob", sha)
+    return meter.result()
+
+
+def bench_checkout(root, shape, repeat=3):
+    meter = benchMeter()
+    for i in range(repeat):
+        dest = os.path.join(root, "checkout", str(i))
+        with meter.measure(items=shape.files):
+            vcs("checkout", "HEAD", dest)
+        shutil.rmtree(dest)
+    return meter.result()
+
+
+def write_config(vcsdir, settings):
+    """Sets the SECTION.KEY=VALUE settings in the config of the repository"""
+    path = os.path.join(vcsdir, "config")
+    conf = configparser.ConfigParser()
+    conf.read(path)
+    for setting in settings:
+        name, _, value = setting.partition("=")
+        section, _, key = name.rpartition(".")
+        if not section or not key:
+            raise Exception("Invalid setting {0}, expected SECTION.KEY=VALUE".format(setting))
+        if not conf.has_section(section):
+            conf.add_section(section)
+        conf.set(section, key, value)
+    with open(path, "w") as f:
+        conf.write(f)
+
+
+def objects_size(vcsdir):
+    """Returns the number of bytes of the files of the object database"""
+    total = 0
+    for path, _, files in os.walk(os.path.join(vcsdir, "objects")):
+        total += sum(os.path.getsize(os.path.join(path, f)) for f in files)
+    return total
+
+
+def run(shape, root, settings=()):
+    """Generates the repository of shape under root, with the config settings, and runs every benchmark on it.
+    Returns the results and the size of the object database"""
+    results = collections.OrderedDict()
+    results["init"] = run_forked(lambda: bench_init(root))
+
+    worktree = os.path.join(root, "repo")
+    os.makedirs(worktree)
+    rng = random.Random(shape.seed)
+    paths = synthetic.file_paths(shape)
+    synthetic.write_files(worktree, paths, rng, shape)
+    libvcs.repo_create(worktree)
+    synthetic.write_user_info(os.path.join(worktree, ".vcs"))
+    write_config(os.path.join(worktree, ".vcs"), settings)
+    os.chdir(worktree)
+
+    results["commit_cold"] = run_forked(lambda: bench_commit_cold(worktree, shape))
+    if shape.commits > 1:
+        results["commit_history"] = run_forked(lambda: bench_commit_history(worktree, paths, shape))
+    results["commit_noop"] = run_forked(bench_commit_noop)
+    results["status"] = run_forked(bench_status)
+    results["log"] = run_forked(lambda: bench_log(shape))
+    results["ls_tree"] = run_forked(bench_ls_tree)
+    results["cat_file"] = run_forked(lambda: bench_cat_file(shape))
+    results["checkout"] = run_forked(lambda: bench_checkout(root, shape))
+    return results, objects_size(os.path.join(worktree, ".vcs"))
+
+
+def print_results(results, out=sys.stdout):
+    out.write("{0:<16}{1:>8}{2:>12}{3:>14}{4:>12}{5:>14}{6:>14}\n".format(
+              "benchmark", "ops", "seconds", "ops/s", "peak rss", "read", "written"))
+    for name, res in results.items():
+        out.write("{0:<16}{1:>8}{2:>12.4f}{3:>14.1f}{4:>9} KB{5:>14}{6:>14}\n".format(
+                  name, res["ops"], res["seconds"], res["ops_per_sec"] or 0, res["peak_rss_kb"],
+                  res["rchar"] if res["rchar"] is not None else "-", res["wchar"] if res["wchar"] is not None else "-"))
+
+
+def compare(old, new, threshold, out=sys.stdout):
+    """Prints the change of every metric between the results old and new. Returns the number of benchmarks whose
+    throughput dropped by more than threshold"""
+    if old["shape"] != new["shape"]:
+        out.write("warning: the runs used different repository shapes\n")
+    if old.get("config") != new.get("config"):
+        out.write("warning: the runs used different configs: {0} and {1}\n".format(old.get("config"), new.get("config")))
+    regressions = 0
+    out.write("{0:<16}{1:<14}{2:>14}{3:>14}{4:>10}\n".format("benchmark", "metric", "old", "new", "change"))
+    for name in old["results"]:
+        if name not in new["results"]:
+            continue
+        for metric in ["ops_per_sec", "items_per_sec", "peak_rss_kb"] + IO_COUNTERS:
+            a = old["results"][name].get(metric)
+            b = new["results"][name].get(metric)
+            if a is None or b is None:
+                continue
+            change = (b - a) / a if a else 0.0
+            flag = ""
+            # throughput is better when higher, memory and io when lower
+            worse = -change if metric.endswith("per_sec") else change
+            if worse > threshold:
+                flag = "  worse"
+                if metric == "ops_per_sec":
+                    regressions += 1
+            elif worse < -threshold:
+                flag = "  better"
+            out.write("{0:<16}{1:<14}{2:>14.6g}{3:>14.6g}{4:>+9.1f}%{5}\n".format(name, metric, a, b, change * 100, flag))
+    if old.get("objects_bytes") and new.get("objects_bytes"):
+        a, b = old["objects_bytes"], new["objects_bytes"]
+        out.write("{0:<16}{1:<14}{2:>14}{3:>14}{4:>+9.1f}%\n".format("repository", "objects_bytes", a, b, (b - a) / a * 100))
+    return regressions
+
+
+argparser = argparse.ArgumentParser(description="Benchmarks of vcs on a synthetic repository")
+argsubparsers = argparser.add_subparsers(title="Commands", dest="command")
+argsubparsers.required = True
+
+argsp = argsubparsers.add_parser("run", help="Generate a repository and run the benchmarks")
+argsp.add_argument("--files", type=int, default=1000, help="number of files")
+argsp.add_argument("--depth", type=int, default=3, help="depth of the directory tree")
+argsp.add_argument("--size", type=int, default=4096, help="mean size of the files in bytes")
+argsp.add_argument("--size-dist", dest="sizeDist", choices=["fixed", "uniform", "lognormal"], default="lognormal", help="distribution of the file sizes")
+argsp.add_argument("--binary", type=float, default=0.0, help="fraction of the files holding random bytes")
+argsp.add_argument("--commits", type=int, default=10, help="number of commits of the history")
+argsp.add_argument("--churn", type=float, default=0.01, help="fraction of the files changed by every commit")
+argsp.add_argument("--seed", type=int, default=0, help="seed of the generator")
+argsp.add_argument("--config", action="append", default=[], help="SECTION.KEY=VALUE setting of the repository config, can be repeated")
+argsp.add_argument("--dir", default=None, help="directory in which the repository is generated (default: a temporary directory, removed afterwards)")
+argsp.add_argument("-o", dest="output", default=None, help="file to write the json results to (default: standard output)")
+
+argsp = argsubparsers.add_parser("compare", help="Compare the results of two runs")
+argsp.add_argument("old", help="json results of the reference run")
+argsp.add_argument("new", help="json results of the run to compare")
+argsp.add_argument("--threshold", type=float, default=0.05, help="relative change reported as better or worse")
+
+
+def main(argv=sys.argv[1:]):
+    args = argparser.parse_args(argv)
+
+    if args.command == "compare":
+        with open(args.old) as f:
+            old = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        sys.exit(1 if compare(old, new, args.threshold) else 0)
+
+    shape = synthetic.repoShape(files=args.files, depth=args.depth, size=args.size, sizeDist=args.sizeDist,
+                                commits=args.commits, churn=args.churn, seed=args.seed, binary=args.binary)
+    root = args.dir or tempfile.mkdtemp(prefix="vcs_bench_")
+    cwd = os.getcwd()
+    try:
+        results, objectsBytes = run(shape, os.path.abspath(root), args.config)
+    finally:
+        os.chdir(cwd)
+        if not args.dir:
+            shutil.rmtree(root)
+
+    report = collections.OrderedDict()
+    report["version"] = RESULT_VERSION
+    report["date"] = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+    report["python"] = platform.python_version()
+    report["platform"] = platform.platform()
+    report["cpus"] = os.cpu_count()
+    report["shape"] = shape.as_dict()
+    report["config"] = args.config
+    report["results"] = results
+    report["objects_bytes"] = objectsBytes
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print_results(results)
+        sys.stdout.write("objects: {0} bytes\n".format(objectsBytes))
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# micro-benchmark of the tree and commit codecs of libvcs
+# trees of growing size are serialized and parsed, as well as commits with a growing number of header lines.
+# The time per entry should stay within a small factor whatever the size (bigger data no longer fits in the cpu
+# caches), where a quadratic codec would get 100 times slower per entry from 1000 to 100000 entries.
+#
+# usage: python3 benchmarks/codec_bench.py [--sizes N,N,...] [--repeat N]
+
+import argparse
+import gc
+import hashlib
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import libvcs
+
+
+def make_tree(count):
+    """Returns a vcsTree of count records, every 16th hash starting with a zero byte"""
+    tree = libvcs.vcsTree(None)
+    tree.items = list()
+    for i in range(count):
+        sha = hashlib.sha1(str(i).encode()).digest()
+        if i % 16 == 0:
+            sha = b'\x00' + sha[1:]
+        mode = b'16877' if i % 10 == 0 else b'33188'
+        tree.items.append(libvcs.vcsTreeLeaf(mode, "/worktree/dir/file{0}.txt".format(i).encode(), sha.hex()))
+    return tree
+
+
+def make_commit(count):
+    """Returns the serialized content of a commit with count parents and a multi line signature"""
+    data = [b'tree ' + b'1' * 40]
+    for i in range(count):
+        data.append(b'parent ' + hashlib.sha1(str(i).encode()).hexdigest().encode())
+    data.append(b'gpgsig -----BEGIN PGP SIGNATURE-----\n ' + b'\n '.join([b'x' * 64] * (count // 10 + 1)))
+    data.append(b'author bench <bench@example.com> 0 +0000')
+    return b'\n'.join(data) + b'\n\nmessage\n'
+
+
+def best_time(fn, repeat):
+    """Returns the best time of repeat runs of fn. Like timeit, the garbage collector is disabled during the runs,
+    as it's passes over the objects created would make the time grow faster than the size"""
+    best = None
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        gc.enable()
+    return best
+
+
+def bench(sizes, repeat, out=sys.stdout):
+    out.write("{0:<20}{1:>10}{2:>14}{3:>14}{4:>10}\n".format("codec", "entries", "total ms", "ns/entry", "scaling"))
+    for name in ["tree_serialize", "parse_tree", "commit_serialize", "commit_parse"]:
+        base = None
+        for size in sizes:
+            if name.startswith("tree"):
+                tree = make_tree(size)
+                raw = libvcs.tree_serialize(tree)
+                parsed = libvcs.parse_tree(raw)
+                assert [item.sha for item in parsed] == [item.sha for item in tree.items]
+                fn = (lambda: libvcs.tree_serialize(tree)) if name == "tree_serialize" else (lambda: libvcs.parse_tree(raw))
+            else:
+                raw = make_commit(size)
+                dct = libvcs.keyValueMessageParser(raw)
+                assert libvcs.keyValueMessageSerialize(dct) == raw
+                fn = (lambda: libvcs.keyValueMessageSerialize(dct)) if name == "commit_serialize" else (lambda: libvcs.keyValueMessageParser(raw))
+            elapsed = best_time(fn, repeat)
+            perEntry = elapsed / size * 1e9
+            if base is None:
+                base = perEntry
+            out.write("{0:<20}{1:>10}{2:>14.3f}{3:>14.1f}{4:>9.2f}x\n".format(name, size, elapsed * 1e3, perEntry, perEntry / base))
+
+
+argparser = argparse.ArgumentParser(description="Micro-benchmark of the tree and commit codecs")
+argparser.add_argument("--sizes", default="1000,10000,100000", help="comma separated numbers of entries")
+argparser.add_argument("--repeat", type=int, default=5, help="number of runs, the best one is reported")
+
+
+def main(argv=sys.argv[1:]):
+    args = argparser.parse_args(argv)
+    bench([int(size) for size in args.sizes.split(",")], args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+# synthetic repository generator used by the benchmarks
+# a repository is described by it's shape: number of files, depth of the directory tree, distribution of the
+# file sizes, fraction of binary files, length of the history and fraction of the files changed by every commit. The same shape and seed
+# always give the same repository, so two runs of the benchmarks work on identical data.
+
+import math
+import os
+import random
+
+
+class repoShape(object):
+    """Parameters of a synthetic repository"""
+    def __init__(self, files=1000, depth=3, size=4096, sizeDist="lognormal", commits=10, churn=0.01, seed=0, binary=0.0):
+        self.files = files
+        self.depth = depth
+        # mean file size in bytes
+        self.size = size
+        # "fixed", "uniform" (0 to 2 * size) or "lognormal" (median size, long tail of large files)
+        self.sizeDist = sizeDist
+        self.commits = commits
+        # fraction of the files modified by each commit after the first one
+        self.churn = churn
+        self.seed = seed
+        # fraction of the files holding random bytes, which don't compress like images or archives
+        self.binary = binary
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+def file_size(rng, shape):
+    """Draws the size of a file from the size distribution of shape"""
+    if shape.sizeDist == "fixed":
+        return shape.size
+    if shape.sizeDist == "uniform":
+        return rng.randint(0, 2 * shape.size)
+    if shape.sizeDist == "lognormal":
+        return min(int(rng.lognormvariate(math.log(max(shape.size, 1)), 1.0)), 1000 * shape.size)
+    raise Exception("Unknown size distribution {0}".format(shape.sizeDist))
+
+
+def file_content(rng, size):
+    """Returns size bytes of text made of random words, which compresses like source code does"""
+    words = [b"lorem", b"ipsum", b"dolor", b"sit", b"amet", b"vcs", b"tree", b"blob", b"commit", b"index",
+             b"return", b"self", b"def", b"class", b"import", b"\n", b"    ", b"(", b")", b"=", b"0x%x" % rng.getrandbits(32)]
+    parts = list()
+    total = 0
+    while total < size:
+        word = rng.choice(words)
+        parts.append(word)
+        total += len(word) + 1
+    return b" ".join(parts)[:size]
+
+
+def file_paths(shape):
+    """Returns the paths (relative to the worktree) of the files of the repository. The files are spread over a
+    directory tree of shape.depth levels with about 10 files per directory of the last level"""
+    fanout = max(2, math.ceil((shape.files / 10) ** (1 / shape.depth))) if shape.depth else 1
+    paths = list()
+    for i in range(shape.files):
+        parts = list()
+        n = i // 10
+        for level in range(shape.depth):
+            parts.append("d{0}_{1}".format(level, n % fanout))
+            n //= fanout
+        parts.append("f{0}.txt".format(i))
+        paths.append(os.path.join(*parts))
+    return paths
+
+
+def write_files(worktree, paths, rng, shape):
+    """Writes new content to the files paths of the worktree. Returns the number of bytes written"""
+    total = 0
+    for path in paths:
+        full = os.path.join(worktree, path)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        size = file_size(rng, shape)
+        # rng is only drawn from for binary files when there are some, so text only shapes give the same files as before
+        if shape.binary and rng.random() < shape.binary:
+            data = rng.randbytes(size)
+        else:
+            data = file_content(rng, size)
+        with open(full, "wb") as f:
+            f.write(data)
+        total += len(data)
+    return total
+
+
+def write_user_info(vcsdir):
+    """Creates the user info file, so that commits don't prompt for the name and email of the user"""
+    with open(os.path.join(vcsdir, "userInfo"), "w") as f:
+        f.write("[info]\nname = bench\nemail = bench@example.com\n\n")
+
+
+def changed_files(paths, rng, shape):
+    """Picks the files modified by a commit of the history"""
+    count = max(1, int(len(paths) * shape.churn)) if paths else 0
+    return rng.sample(paths, count)
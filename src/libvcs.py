@@ -1,10 +1,30 @@
 # importing various library
 import argparse
+import bisect
 import collections
+import concurrent.futures
+import ctypes
+import errno
+import datetime
 import hashlib
+import heapq
+import io
+import itertools
+import json
+import math
+import mmap
 import os
 import re
+import select
+import signal
+import socket
+import stat
+import struct
 import sys
+import tempfile
+import threading
+import time
+import traceback
 import zlib
 import configparser
 
@@ -26,7 +46,8 @@ def repo_dir(repo, *path, mkdir=False):
             raise Exception("Not a directory %s" % path)
 
     if mkdir:
-        os.makedirs(path)
+        # several threads may write objects of the same fan-out directory at once
+        os.makedirs(path, exist_ok=True)
         return path
     else:
         return None
@@ -42,6 +63,123 @@ def repo_file(repo, *path, mkdir=False):
 
 
 
+# tracing
+# when tracing is enabled (--trace, --trace-json FILE or the VCS_TRACE environment variable), TRACE holds the
+# vcsTrace collecting the counters (objects and bytes read, written, inflated, deflated and hashed, cache hits ...)
+# and the timers of the instrumented functions. Instrumented code checks TRACE before counting and uses trace_span,
+# which returns a shared do nothing context manager when tracing is off, so the cost of disabled tracing is a global
+# lookup at every instrumented point.
+# at exit a summary table is printed on stderr or, with --trace-json, the timers are written as a Chrome trace
+# (chrome://tracing, Perfetto) where every span is a complete event and the counters a counter event.
+
+TRACE = None
+
+
+class vcsTrace(object):
+    """Counters and timers of the current command"""
+    def __init__(self, chrome=False):
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+        # name --> [number of calls, total seconds]
+        self.timers = dict()
+        # complete events of the Chrome trace, only kept if it's requested
+        self.events = list() if chrome else None
+        self.start = time.perf_counter()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def span(self, name):
+        return vcsTraceSpan(self, name)
+
+    def record(self, name, start, end):
+        with self.lock:
+            timer = self.timers.setdefault(name, [0, 0.0])
+            timer[0] += 1
+            timer[1] += end - start
+            if self.events is not None:
+                self.events.append({"name": name, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                                    "ts": (start - self.start) * 1e6, "dur": (end - start) * 1e6})
+
+    def summary(self, out):
+        """Writes the timers and the counters as a table to the text file out"""
+        total = time.perf_counter() - self.start
+        out.write("trace summary: {0:.3f}s\n".format(total))
+        out.write("{0:<32}{1:>10}{2:>14}{3:>14}\n".format("timer", "calls", "total ms", "avg us"))
+        for name, (calls, seconds) in sorted(self.timers.items(), key=lambda item: -item[1][1]):
+            out.write("{0:<32}{1:>10}{2:>14.3f}{3:>14.1f}\n".format(name, calls, seconds * 1e3, seconds * 1e6 / calls))
+        out.write("{0:<32}{1:>10}\n".format("counter", "value"))
+        for name, value in sorted(self.counters.items()):
+            out.write("{0:<32}{1:>10}\n".format(name, value))
+
+    def chrome(self, path):
+        """Writes the spans and the counters to path in the Chrome trace event format"""
+        end = (time.perf_counter() - self.start) * 1e6
+        events = self.events + [{"name": "counters", "ph": "C", "pid": os.getpid(), "ts": end, "args": dict(self.counters)}]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+class vcsTraceSpan(object):
+    """Context manager timing a block for a vcsTrace"""
+    __slots__ = ("trace", "name", "begin")
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.begin = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.record(self.name, self.begin, time.perf_counter())
+        return False
+
+
+class vcsNullSpan(object):
+    """Context manager doing nothing, used when tracing is off"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_SPAN = vcsNullSpan()
+
+
+def trace_span(name):
+    """Returns a context manager timing a block under name when tracing is on"""
+    return TRACE.span(name) if TRACE else NULL_SPAN
+
+
+def trace_begin(summary=False, chromePath=None):
+    """Turns tracing on if requested by the arguments or by VCS_TRACE: a path ending in .json writes a Chrome
+    trace to it, any other non empty value except 0 prints a summary"""
+    global TRACE
+    env = os.environ.get("VCS_TRACE", "")
+    if not chromePath and env.endswith(".json"):
+        chromePath = env
+    if summary or chromePath or env not in ("", "0"):
+        TRACE = vcsTrace(chrome=bool(chromePath))
+        TRACE.chromePath = chromePath
+
+
+def trace_end():
+    """Turns tracing off and outputs what was collected"""
+    global TRACE
+    trace, TRACE = TRACE, None
+    if trace is None:
+        return
+    if trace.chromePath:
+        trace.chrome(trace.chromePath)
+    else:
+        trace.summary(sys.stderr)
+
+
 # class to define a git repository object
 class vcsRepository(object):
     """Abstraction of a vcs repository"""
@@ -49,6 +187,15 @@ class vcsRepository(object):
     worktree = None
     vcsdir = None
     conf = None
+    packs = None
+    # modification time of the pack directory when the packs were listed
+    packsMtime = None
+    cache = None
+    commitGraph = None
+    # vcsBulkCheckin in progress
+    bulkCheckin = None
+    # compression policy read from the config, see repo_compression
+    compression = None
 
     def __init__(self, path, force=False):
         self.worktree = path
@@ -138,7 +285,14 @@ def repo_find(path=".", required=True):
     path = os.path.realpath(path)
 
     if os.path.isdir(os.path.join(path,".vcs")):
-        return vcsRepository(path)
+        if REPO_REUSE is None:
+            return vcsRepository(path)
+        # the command server keeps the repository, and thus it's config, packs and object cache, between requests
+        repo = REPO_REUSE.get(path)
+        if repo is None or not repo_fresh(repo):
+            repo = REPO_REUSE[path] = vcsRepository(path)
+            repo_fresh(repo)
+        return repo
     
     parent = os.path.realpath(os.path.join(path, ".."))
 
@@ -155,6 +309,33 @@ def repo_find(path=".", required=True):
 
 
 
+# repositories reused by repo_find, keyed by worktree, while the command server is running (see vcs server)
+REPO_REUSE = None
+
+def _file_stamp(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+
+def repo_fresh(repo):
+    """Checks that a repository kept by the command server still matches the disk. Returns False if the config changed,
+    else drops the commit graph if the file changed. Objects never change and new packs are found by pack_find"""
+    config = _file_stamp(repo_file(repo, "config"))
+    graph = _file_stamp(repo_file(repo, "commit-graph"))
+    stamps = getattr(repo, "stamps", None)
+    repo.stamps = (config, graph)
+    if stamps is None:
+        return True
+    if stamps[0] != config:
+        return False
+    if stamps[1] != graph:
+        repo.commitGraph = None
+    return True
+
+
 # version control system object creation, storage and retrieval functions
 # version control system is a content based file system
 # a vcs object is a file whose path or address is computed from it's content
@@ -190,50 +371,68 @@ class vcsBlob(vcsObject):
         self.blobdata = data
 
 
+# a large file can be stored as a chunked blob: the file is cut in chunks at content defined boundaries, every chunk is
+# stored as a blob and the chunked blob lists the hash and the size of the chunks, one "<sha> <size>" line per chunk.
+# An edit only changes the chunks around it, so the other chunks are shared by all the versions of the file
+class vcsChunkedBlob(vcsObject):
+    fmt = b'chunked'
+
+    def serialize(self):
+        return b''.join("{0} {1}\n".format(sha, size).encode() for sha, size in self.chunks)
+
+    def deserialize(self, data):
+        self.chunks = list()
+        for line in data.splitlines():
+            sha, size = line.split(b' ')
+            self.chunks.append((sha.decode("ascii"), int(size)))
+
+    def size(self):
+        return sum(size for _, size in self.chunks)
+
+
 # commit, tag content parser functions
 
 def keyValueMessageParser(original, start=0, dct=None):
-    """Recursive function which parses a commit or a tag message and extracts key value pairs and messages"""
-    if not dct:
+    """Function which parses a commit or a tag message and extracts key value pairs and messages.
+    Returns an ordered dictionary of key --> list of values, the message following the blank line is stored
+    under the b'' key. The header lines are parsed one after the other in a single pass over the data"""
+    if dct is None:
         dct = collections.OrderedDict()
 
     # original is a byte string of the commit or tag message
-    spaceIndex = original.find(b' ', start)
-    newlineIndex = original.find(b'\n', start)
-
-    # if newline arrives before space, then the line must be a empty line
-    # thus, it means remainder of the data is a message
-    # the if case handles the situation when a blank line is reached and strings after this will be the message 
-    if (spaceIndex < 0 or newlineIndex < spaceIndex):
-        assert(newlineIndex == start)
-        dct[b''] = original[start+1:]
-        return dct
-
-    # handling the case before blank line is reached, thus parsing key value is needed
-    key = original[start:spaceIndex]
-    end = start
+    pos = start
+    size = len(original)
     while True:
-        end = original.find(b'\n', end+1)
-        if original[end+1] != ord(' '):
-            break
-    
-    value = original[spaceIndex+1:end]
-    value.replace(b'\n ', b'\n')
-
-    if key in dct:
-        if type(dct[key]) == list:
+        spaceIndex = original.find(b' ', pos)
+        newlineIndex = original.find(b'\n', pos)
+
+        # if newline arrives before space, then the line must be a empty line
+        # thus, it means remainder of the data is a message
+        if (spaceIndex < 0 or newlineIndex < spaceIndex):
+            if newlineIndex != pos:
+                raise Exception("Malformed commit or tag: header line without a value")
+            dct[b''] = original[pos+1:]
+            return dct
+
+        # a value goes on over the following lines starting with a space
+        end = newlineIndex
+        while 0 <= end < size - 1 and original[end+1] == 0x20:
+            end = original.find(b'\n', end+1)
+        if end < 0:
+            raise Exception("Malformed commit or tag: no blank line before the message")
+
+        key = original[pos:spaceIndex]
+        value = original[spaceIndex+1:end].replace(b'\n ', b'\n')
+        if key in dct:
             dct[key].append(value)
         else:
-            dct[key] = [dct[key], value]
-    else:
-        dct[key] = [value]
-    
-    # recursive function to extract the next key value pair or message
-    return keyValueMessageParser(original, end+1, dct)
+            dct[key] = [value]
+        pos = end + 1
 
 def keyValueMessageSerialize(keyValueDict):
-    """Function which forms the original commit message from the keyValue dictionary formed by keyvalueParser()"""
-    res = b''
+    """Function which forms the original commit message from the keyValue dictionary formed by keyvalueParser().
+    The parts are gathered in a list and joined once"""
+    res = list()
 
     for keys in keyValueDict.keys():
         if (keys == b''):
@@ -245,32 +444,179 @@ def keyValueMessageSerialize(keyValueDict):
         
         # adding the key value pairs and recreating the original format
         for elements in val:
-            res += keys + b' ' + elements.replace(b'\n', b'\n ') + b'\n'
+            res += (keys, b' ', elements.replace(b'\n', b'\n '), b'\n')
         
     # adding the blank line and the message after
-    res += b'\n' + keyValueDict[b'']
+    res += (b'\n', keyValueDict[b''])
+
+    return b''.join(res)
 
+def keyValueMessageHeader(original, key):
+    """Returns the values of the header lines key of a commit or tag, without parsing the other headers nor the message"""
+    res = list()
+    if original.startswith(b'\n'):
+        return res
+    end = original.find(b'\n\n')
+    if end < 0:
+        raise Exception("Malformed commit or tag: no blank line before the message")
+    prefix = key + b' '
+    pos = 0
+    while pos < end:
+        newlineIndex = original.find(b'\n', pos)
+        if original.startswith(prefix, pos):
+            # a value goes on over the following lines starting with a space
+            while newlineIndex < end and original[newlineIndex+1] == 0x20:
+                newlineIndex = original.find(b'\n', newlineIndex+1)
+            res.append(original[pos+len(prefix):newlineIndex].replace(b'\n ', b'\n'))
+        pos = newlineIndex + 1
     return res
 
 # subclass of vcs commit --> represents the commits
 class vcsCommit(vcsObject):
+    """The content of a commit is only parsed into commitData on first access: walking the history just needs
+    the tree and parent lines, which header() finds in the raw content"""
     fmt=b'commit'
-
-    def serialize(self, data):
+    raw = None
+    _commitData = None
+
+    @property
+    def commitData(self):
+        if self._commitData is None and self.raw is not None:
+            self._commitData = keyValueMessageParser(self.raw)
+        return self._commitData
+
+    @commitData.setter
+    def commitData(self, value):
+        self._commitData = value
+        self.raw = None
+
+    def header(self, key):
+        """Returns the list of values of the header key, like commitData.get(key, [])"""
+        if self._commitData is None and self.raw is not None:
+            return keyValueMessageHeader(self.raw, key)
+        return self.commitData.get(key, [])
+
+    def message(self):
+        """Returns the message of the commit, the content after the first blank line"""
+        if self._commitData is None and self.raw is not None:
+            if self.raw.startswith(b'\n'):
+                return self.raw[1:]
+            end = self.raw.find(b'\n\n')
+            if end < 0:
+                raise Exception("Malformed commit or tag: no blank line before the message")
+            return self.raw[end+2:]
+        return self.commitData[b'']
+
+    def serialize(self, data=None):
+        if self._commitData is None and self.raw is not None:
+            return self.raw
         return keyValueMessageSerialize(self.commitData)
     
     def deserialize(self, data):
-        self.commitData = keyValueMessageParser(data)
+        self.raw = data
+        self._commitData = None
+
+
+# in-process object cache
+# objects read by object_read are kept in memory, keyed by their hash, so that commits and trees read again and again
+# by log, ls-tree or checkout (or by a program reusing the same vcsRepository) are not decompressed and parsed every time.
+# parsed commits and trees and raw blob contents have separate budgets, in bytes of object content, and the least
+# recently used objects are evicted first. The budgets are set by objectlimit and bloblimit in the cache section of the config.
+
+CACHE_OBJECT_LIMIT = 32 * 1024 * 1024
+CACHE_BLOB_LIMIT = 16 * 1024 * 1024
+# rough memory used by a cached object besides it's content, so that many small objects are accounted for
+CACHE_ENTRY_OVERHEAD = 128
+
+class vcsLRU(object):
+    """Least recently used store with a budget in bytes"""
+    def __init__(self, limit):
+        self.limit = limit
+        self.entries = collections.OrderedDict() # key --> (value, size)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def put(self, key, value, size):
+        size += CACHE_ENTRY_OVERHEAD
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+        # an object bigger than the whole budget would only evict everything else
+        if size > self.limit:
+            return
+        self.entries[key] = (value, size)
+        self.size += size
+        while self.size > self.limit:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.size -= evicted
+            self.evictions += 1
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "objects": len(self.entries), "bytes": self.size, "limit": self.limit}
+
+
+class vcsObjectCache(object):
+    """Cache of parsed commits and trees and of blob contents of a repository"""
+    def __init__(self, objectLimit=CACHE_OBJECT_LIMIT, blobLimit=CACHE_BLOB_LIMIT):
+        self.objects = vcsLRU(objectLimit)
+        self.blobs = vcsLRU(blobLimit)
+        # the cache is shared by the worker threads of checkout, gc etc
+        self.lock = threading.Lock()
+
+    def get(self, sha):
+        """Returns the cached parsed object or blob content of sha as a (fmt, value) pair, or None if it isn't cached"""
+        with self.lock:
+            for fmt, pool in ((None, self.objects), (b'blob', self.blobs)):
+                if sha in pool.entries:
+                    pool.hits += 1
+                    pool.entries.move_to_end(sha)
+                    return fmt, pool.entries[sha][0]
+        return None
 
+    def put(self, sha, fmt, value, size):
+        """Caches a parsed object, or the content of a blob when fmt is blob. size is the size of the object content"""
+        with self.lock:
+            pool = self.blobs if fmt == b'blob' else self.objects
+            # the object wasn't found in the cache before being read
+            pool.misses += 1
+            pool.put(sha, value, size)
 
-def object_read(repo, sha):
-    """Read object object_id from vcs repository repo. Return a
-    vcs object whose exact type depends on the object"""
+    def clear(self):
+        with self.lock:
+            for pool in (self.objects, self.blobs):
+                pool.entries.clear()
+                pool.size = 0
+
+    def stats(self):
+        """Hit, miss and eviction counters of both budgets"""
+        return {"objects": self.objects.stats(), "blobs": self.blobs.stats()}
+
+
+def repo_cache(repo):
+    """Returns the object cache of the repository, creating it with the budgets of the config the first time"""
+    if repo.cache is None:
+        repo.cache = vcsObjectCache(
+            repo.conf.getint("cache", "objectlimit", fallback=CACHE_OBJECT_LIMIT),
+            repo.conf.getint("cache", "bloblimit", fallback=CACHE_BLOB_LIMIT))
+    return repo.cache
+
+
+def object_read_raw(repo, sha):
+    """Returns the type and the content of the object represented by sha as a (fmt, data) pair.
+    Loose objects are looked up first and then the packfiles"""
 
     path = repo_file(repo, "objects", sha[0:2], sha[2:])
 
-    with open(path, "rb") as f:
-        raw = zlib.decompress(f.read())
+    if path and os.path.isfile(path):
+        with open(path, "rb") as f:
+            compressed = f.read()
+        with trace_span("zlib.inflate"):
+            raw = zlib.decompress(compressed)
+        if TRACE:
+            TRACE.count("zlib.inflate.bytes_in", len(compressed))
+            TRACE.count("zlib.inflate.bytes_out", len(raw))
 
         # computing the starting position of the whitespace in header of the object file
         x = raw.find(b' ')
@@ -281,17 +627,361 @@ def object_read(repo, sha):
         size = int(raw[x:y].decode("ascii"))
         if size != len(raw) - y - 1:
             raise Exception("Malformed object {0}: bad length".format(sha))
-        
-        # picking proper vcs object class
-        if fmt == b'commit' :   c = vcsCommit
-        elif fmt == b'tree' :   c = vcsTree
-        elif fmt == b'tag'  :   c = vcsTag
-        elif fmt == b'blob' :   c = vcsBlob
-        else:
-            raise Exception("Unknown type %s for object %s".format(fmt.decode("ascii"), sha))
+        return fmt, raw[y+1:]
+
+    res = pack_read(repo, sha)
+    if res is None:
+        raise Exception("Object {0} doesn't exist".format(sha))
+    return res
 
-        # return object of the class picked above
-        return c(repo, raw[y+1:])
+
+def object_read(repo, sha):
+    """Read object object_id from vcs repository repo. Return a
+    vcs object whose exact type depends on the object.
+    Commits and trees come from the object cache of the repository and are shared, so they must not be modified"""
+
+    cache = repo_cache(repo)
+    cached = cache.get(sha)
+    if TRACE:
+        TRACE.count("object_read.cache_hits" if cached else "object_read.cache_misses")
+    if cached:
+        fmt, value = cached
+        return vcsBlob(repo, value) if fmt == b'blob' else value
+
+    with trace_span("object_read"):
+        fmt, data = object_read_raw(repo, sha)
+    if TRACE:
+        TRACE.count("object_read.objects")
+        TRACE.count("object_read.bytes", len(data))
+
+    # picking proper vcs object class
+    if fmt == b'commit' :   c = vcsCommit
+    elif fmt == b'tree' :   c = vcsTree
+    elif fmt == b'tag'  :   c = vcsTag
+    elif fmt == b'blob' :   c = vcsBlob
+    elif fmt == b'chunked': c = vcsChunkedBlob
+    else:
+        raise Exception("Unknown type {0} for object {1}".format(fmt.decode("ascii"), sha))
+
+    # return object of the class picked above
+    obj = c(repo, data)
+    cache.put(sha, fmt, data if fmt == b'blob' else obj, len(data))
+    return obj
+
+
+# size of the chunks in which the content of an object is read, hashed or written
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# the longest possible header is "commit " followed by a 20 digit size and the null separator
+OBJECT_HEADER_MAX = 32
+
+def object_info(repo, sha):
+    """Returns the type and the size of the object represented by sha as a (fmt, size) pair.
+    Only the header of the object is decompressed, so it's cheap even for very large objects"""
+    path = repo_file(repo, "objects", sha[0:2], sha[2:])
+
+    if path and os.path.isfile(path):
+        d = zlib.decompressobj()
+        raw = b''
+        with open(path, "rb") as f:
+            while b'\x00' not in raw:
+                chunk = d.unconsumed_tail or f.read(256)
+                if not chunk or len(raw) >= OBJECT_HEADER_MAX:
+                    raise Exception("Malformed object {0}: bad header".format(sha))
+                raw += d.decompress(chunk, OBJECT_HEADER_MAX - len(raw))
+
+        x = raw.find(b' ')
+        y = raw.find(b'\x00', x)
+        return raw[0:x], int(raw[x:y].decode("ascii"))
+
+    res = pack_info(repo, sha)
+    if res is None:
+        raise Exception("Object {0} doesn't exist".format(sha))
+    return res
+
+
+def _loose_object_chunks(path, sha, chunkSize):
+    """Generator which first yields the (fmt, size) of the loose object stored at path and then it's content
+    in chunks of at most chunkSize bytes"""
+    with open(path, "rb") as f:
+        d = zlib.decompressobj()
+        raw = b''
+        while b'\x00' not in raw:
+            data = d.unconsumed_tail or f.read(256)
+            if not data or len(raw) >= OBJECT_HEADER_MAX:
+                raise Exception("Malformed object {0}: bad header".format(sha))
+            raw += d.decompress(data, OBJECT_HEADER_MAX - len(raw))
+        x = raw.find(b' ')
+        y = raw.find(b'\x00', x)
+        size = int(raw[x:y].decode("ascii"))
+        yield raw[0:x], size
+
+        total = len(raw) - y - 1
+        if total:
+            yield raw[y+1:]
+        while not d.eof:
+            data = d.unconsumed_tail or f.read(65536)
+            out = d.decompress(data, chunkSize)
+            if out:
+                total += len(out)
+                yield out
+            elif not data:
+                raise Exception("Malformed object {0}: truncated".format(sha))
+        if total != size:
+            raise Exception("Malformed object {0}: bad length".format(sha))
+        if TRACE:
+            TRACE.count("object_stream.objects")
+            TRACE.count("zlib.inflate.bytes_out", size)
+
+
+def object_stream(repo, sha, chunkSize=STREAM_CHUNK_SIZE):
+    """Returns (fmt, size, chunks) of the object represented by sha, where chunks is an iterator over it's content.
+    Loose objects are decompressed chunkSize bytes at a time, so a large blob is never held in memory at once.
+    A chunked blob is returned as a blob whose content is the content of it's chunks"""
+    path = repo_file(repo, "objects", sha[0:2], sha[2:])
+    if path and os.path.isfile(path):
+        chunks = _loose_object_chunks(path, sha, chunkSize)
+        fmt, size = next(chunks)
+        if fmt != b'chunked':
+            return fmt, size, chunks
+        data = b''.join(chunks)
+    else:
+        fmt, data = object_read_raw(repo, sha)
+        if fmt != b'chunked':
+            return fmt, len(data), iter([data])
+
+    obj = vcsChunkedBlob(repo, data)
+    return b'blob', obj.size(), _chunked_blob_chunks(repo, obj, chunkSize)
+
+
+def _chunked_blob_chunks(repo, obj, chunkSize):
+    """Generator over the content of the chunks of the chunked blob obj"""
+    for sha, size in obj.chunks:
+        fmt, _, chunks = object_stream(repo, sha, chunkSize)
+        if fmt != b'blob':
+            raise Exception("Chunk {0} is not a blob".format(sha))
+        yield from chunks
+
+
+def object_exists(repo, sha):
+    """Returns True if the object represented by sha is present either as a loose object or in a pack"""
+    path = repo_file(repo, "objects", sha[0:2], sha[2:])
+    if path and os.path.isfile(path):
+        return True
+    return pack_find(repo, sha) is not None
+
+
+# compression policy
+# the zlib level of the objects of a type is the value of it's name (blob, tree, commit, tag or chunked) in the
+# compression section of the config if set, else core.looseCompression for loose objects or pack.compression for
+# packed objects, else core.compression, else the default level of zlib. Level 0 stores the content as it is, in a
+# zlib stream all the same, so objects are read the same way whatever level they were written with.
+# Content which is already compressed (jpg, zip, mp4 ...) only costs cpu time to compress again: a blob of at least
+# COMPRESSION_SAMPLE_MIN bytes whose first COMPRESSION_SAMPLE_SIZE bytes don't shrink by COMPRESSION_MIN_GAIN at
+# level 1 is stored with level 0, unless compression.autoStore is false. Compressing the sample costs a few percent
+# of the compression of such a blob, and zlib goes about ten times faster at level 0 on content it can't shrink.
+
+COMPRESSION_TYPES = [b'blob', b'chunked', b'commit', b'tag', b'tree']
+COMPRESSION_SAMPLE_MIN = 16 * 1024
+COMPRESSION_SAMPLE_SIZE = 4096
+COMPRESSION_MIN_GAIN = 0.1
+
+
+def repo_compression(repo):
+    """Returns the compression policy of the repository as ({(fmt, loose): level}, autoStore). It's read from the
+    config once, as it's needed for every object written"""
+    if repo.compression is None:
+        conf = repo.conf
+        default = conf.getint("core", "compression", fallback=zlib.Z_DEFAULT_COMPRESSION)
+        levels = dict()
+        for loose, option in ((True, ("core", "loosecompression")), (False, ("pack", "compression"))):
+            storage = conf.getint(*option, fallback=default)
+            for fmt in COMPRESSION_TYPES:
+                level = conf.getint("compression", fmt.decode("ascii"), fallback=storage)
+                if not -1 <= level <= 9:
+                    raise Exception("Invalid compression level {0} for {1} objects".format(level, fmt.decode("ascii")))
+                levels[fmt, loose] = level
+        repo.compression = (levels, conf.getboolean("compression", "autostore", fallback=True))
+    return repo.compression
+
+
+def compression_level(repo, fmt, sample, size, loose=True):
+    """Returns the zlib level to write the object of type fmt and size bytes with. sample is the content of the
+    object, or at least it's first COMPRESSION_SAMPLE_SIZE bytes"""
+    levels, autoStore = repo_compression(repo)
+    level = levels[fmt, loose]
+    if autoStore and level != 0 and fmt == b'blob' and size >= COMPRESSION_SAMPLE_MIN:
+        sample = sample[:COMPRESSION_SAMPLE_SIZE]
+        if len(zlib.compress(sample, 1)) > len(sample) * (1 - COMPRESSION_MIN_GAIN):
+            if TRACE:
+                TRACE.count("compression.stored")
+            return 0
+    return level
+
+
+# object writes
+# an object is written to a temporary file which is then renamed, so a crash never leaves a truncated object behind.
+# An object which is already present isn't compressed nor written again: the modification time of it's loose file is
+# refreshed instead, so that gc doesn't take it for an old unreachable object while it's being used again.
+# With core.fsyncObjectFiles, objects are flushed to the storage before being renamed. One at a time this costs a fsync
+# of the file and of it's directory. In a bulk checkin (vcsBulkCheckin) the objects keep their temporary name until
+# the batch ends, then they are fsync'd together on a pool of threads, renamed, and every fan-out directory they went
+# to is fsync'd once. core.fsyncMethod = syncfs flushes the batch with a single syncfs call instead, which also
+# flushes every other dirty file of the file system: it's only worth it on a file system holding little else.
+
+def repo_fsync(repo):
+    """Returns True if objects have to be flushed to the storage when they are written (core.fsyncObjectFiles)"""
+    return repo.conf.getboolean("core", "fsyncobjectfiles", fallback=False)
+
+
+def repo_fsync_syncfs(repo):
+    """Returns True if the batches of objects are flushed with syncfs (core.fsyncMethod = syncfs)"""
+    return repo.conf.get("core", "fsyncmethod", fallback="fsync") == "syncfs"
+
+
+def path_fsync(path):
+    """Flushes the file path, or the entries of the directory path, to the storage"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def files_fsync(files, workers=1, syncfsPath=None):
+    """Flushes the files to the storage, fsync'ing them on a pool of workers threads (fsync releases the GIL, so the
+    storage gets the flushes of several files at once). With syncfsPath, a single syncfs call flushing the whole file
+    system holding syncfsPath is made instead where it's available"""
+    if syncfsPath is not None:
+        syncfs = getattr(ctypes.CDLL(None, use_errno=True), "syncfs", None)
+        if syncfs is not None:
+            fd = os.open(syncfsPath, os.O_RDONLY)
+            try:
+                if syncfs(fd) == 0:
+                    return
+            finally:
+                os.close(fd)
+    if workers > 1 and len(files) > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(workers, len(files))) as pool:
+            list(pool.map(path_fsync, files))
+    else:
+        for name in files:
+            path_fsync(name)
+
+
+class vcsBulkCheckin(object):
+    """Batch of object writes made durable together. Used as a context manager: with core.fsyncObjectFiles, the
+    objects written inside of it are only present in the repository once it exits. Nested bulk checkins join the
+    outer one"""
+    def __init__(self, repo):
+        self.repo = repo
+        self.sync = repo_fsync(repo)
+        # hash --> temporary file of the objects waiting for the end of the batch
+        self.objects = dict()
+        self.lock = threading.Lock()
+        self.outer = None
+
+    def __enter__(self):
+        self.outer = self.repo.bulkCheckin
+        if self.outer is None:
+            self.repo.bulkCheckin = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.outer is not None:
+            return
+        self.repo.bulkCheckin = None
+        if exc_type is None:
+            self.flush()
+        else:
+            for tmpPath in self.objects.values():
+                os.remove(tmpPath)
+            self.objects.clear()
+
+    def pending(self, sha):
+        """Checks if the object sha was written in the batch"""
+        return sha in self.objects
+
+    def add(self, sha, tmpPath):
+        """Adds the object sha, written to the closed temporary file tmpPath, to the batch"""
+        with self.lock:
+            if sha in self.objects:
+                # written by two threads at the same time
+                os.remove(tmpPath)
+            else:
+                self.objects[sha] = tmpPath
+
+    def flush(self):
+        """Flushes the objects of the batch to the storage and moves them to their place"""
+        with self.lock:
+            objects, self.objects = self.objects, dict()
+        if not objects:
+            return
+        with trace_span("object_write.fsync"):
+            objectsDir = repo_dir(self.repo, "objects")
+            files_fsync(list(objects.values()), repo_workers(self.repo),
+                        objectsDir if repo_fsync_syncfs(self.repo) else None)
+            dirs = set()
+            for sha, tmpPath in objects.items():
+                os.replace(tmpPath, repo_file(self.repo, "objects", sha[0:2], sha[2:], mkdir=True))
+                dirs.add(sha[0:2])
+            for d in sorted(dirs):
+                path_fsync(os.path.join(objectsDir, d))
+            # for the fan-out directories created by the batch
+            path_fsync(objectsDir)
+
+
+def object_freshen(repo, sha):
+    """Returns True if the object sha is present in the repository (or waits in it's bulk checkin), refreshing the
+    modification time of it's loose file"""
+    bulk = repo.bulkCheckin
+    if bulk is not None and bulk.pending(sha):
+        return True
+    path = repo_path(repo, "objects", sha[0:2], sha[2:])
+    try:
+        os.utime(path)
+        return True
+    except FileNotFoundError:
+        pass
+    except OSError:
+        # read only repository
+        if os.path.isfile(path):
+            return True
+    return pack_find(repo, sha) is not None
+
+
+def object_tmpfile(repo):
+    """Creates a temporary object file. Returns the file open for writing and it's path"""
+    handle, tmpPath = tempfile.mkstemp(prefix="tmp_obj_", dir=repo_dir(repo, "objects", mkdir=True))
+    return os.fdopen(handle, "wb"), tmpPath
+
+
+def object_install(repo, f, tmpPath, sha):
+    """Closes the temporary object file f and renames it to the file of the object sha, flushing it to the storage
+    first with core.fsyncObjectFiles"""
+    bulk = repo.bulkCheckin
+    if bulk is not None and bulk.sync:
+        f.close()
+        bulk.add(sha, tmpPath)
+        return
+    sync = repo_fsync(repo)
+    if sync:
+        with trace_span("object_write.fsync"):
+            f.flush()
+            os.fsync(f.fileno())
+    f.close()
+    path = repo_file(repo, "objects", sha[0:2], sha[2:], mkdir=True)
+    os.replace(tmpPath, path)
+    if sync:
+        with trace_span("object_write.fsync"):
+            path_fsync(os.path.dirname(path))
+
+
+def object_discard(f, tmpPath):
+    """Closes and removes the temporary object file f"""
+    f.close()
+    if os.path.exists(tmpPath):
+        os.remove(tmpPath)
 
 
 def object_write(obj, actually_write=True):
@@ -304,84 +994,1013 @@ def object_write(obj, actually_write=True):
     
     if type(data) == str:
         data = data.encode()
-    # add header
-    result = obj.fmt + b' ' + str(len(data)).encode() + b'\x00' + data
+    return object_write_data(obj.repo, obj.fmt, data, actually_write)
+
+
+def object_write_data(repo, fmt, data, actually_write=True):
+    """Hashes the object of type fmt and content data and writes it to the repository if actually_write is True
+    and the object isn't present yet. Returns it's hash"""
+    # header and data are hashed and compressed one after the other instead of being joined in a new byte string
+    header = fmt + b' ' + str(len(data)).encode() + b'\x00'
     # compute hash
-    sha = hashlib.sha1(result).hexdigest()
+    with trace_span("sha1"):
+        hasher = hashlib.sha1(header)
+        hasher.update(data)
+        sha = hasher.hexdigest()
+    if TRACE:
+        TRACE.count("sha1.bytes", len(header) + len(data))
 
     if actually_write:
-        path = repo_file(obj.repo, "objects", sha[0:2], sha[2:], mkdir=actually_write)
+        if object_freshen(repo, sha):
+            if TRACE:
+                TRACE.count("object_write.present")
+            return sha
 
-        with open(path, "wb") as f:
+        with trace_span("object_write"):
             # compress the data and write
-            f.write(zlib.compress(result))
+            compressor = zlib.compressobj(compression_level(repo, fmt, data, len(data)))
+            with trace_span("zlib.deflate"):
+                compressed = [compressor.compress(header), compressor.compress(data), compressor.flush()]
+            f, tmpPath = object_tmpfile(repo)
+            try:
+                f.writelines(compressed)
+                object_install(repo, f, tmpPath, sha)
+            except BaseException:
+                object_discard(f, tmpPath)
+                raise
+        if TRACE:
+            TRACE.count("object_write.objects")
+            TRACE.count("zlib.deflate.bytes_in", len(header) + len(data))
+            TRACE.count("zlib.deflate.bytes_out", sum(map(len, compressed)))
     
     return sha
 
 
+def _object_stream_pass(fd, header, size, out=None, repo=None, fmt=None):
+    """Reads size bytes from the open file fd and returns the hash of the object of header and this content.
+    The content is also compressed to the file out if it's given, with the level of repo for objects of type fmt"""
+    hasher = hashlib.sha1(header)
+    compressor = None
+    remaining = size
+    while remaining:
+        chunk = fd.read(min(STREAM_CHUNK_SIZE, remaining))
+        if not chunk:
+            raise Exception("File shrank while it was being hashed")
+        with trace_span("sha1"):
+            hasher.update(chunk)
+        if out:
+            if compressor is None:
+                # the level is chosen once the start of the content is known
+                compressor = zlib.compressobj(compression_level(repo, fmt, chunk, size))
+                out.write(compressor.compress(header))
+            with trace_span("zlib.deflate"):
+                compressed = compressor.compress(chunk)
+            out.write(compressed)
+            if TRACE:
+                TRACE.count("zlib.deflate.bytes_out", len(compressed))
+        remaining -= len(chunk)
+    if out:
+        out.write(compressor.flush())
+    if TRACE:
+        TRACE.count("sha1.bytes", len(header) + size)
+    return hasher.hexdigest()
+
+
+def object_write_stream(repo, fd, size, fmt=b'blob', actually_write=True):
+    """Hashes an object whose size bytes of content are read from the open file fd and writes it
+    to the repository if actually_write is True. Content of up to STREAM_CHUNK_SIZE bytes is read at once, bigger
+    content is read, hashed and compressed in chunks so memory used doesn't depend on the size of the object.
+    Then a file which can be seeked is hashed first and only read again to be compressed if the object isn't present,
+    other files are compressed while they are hashed into a temporary file, dropped if the object is present.
+    A blob of at least core.chunkThreshold bytes is stored as a chunked blob"""
+    if fmt == b'blob' and repo is not None:
+        threshold, average = repo_chunking(repo)
+        if threshold and size >= threshold:
+            return object_write_chunked(repo, fd, size, average, actually_write)
+
+    if size <= STREAM_CHUNK_SIZE:
+        data = fd.read(size)
+        if len(data) < size:
+            raise Exception("File shrank while it was being hashed")
+        return object_write_data(repo, fmt, data, actually_write)
+
+    header = fmt + b' ' + str(size).encode() + b'\x00'
+    if not actually_write:
+        return _object_stream_pass(fd, header, size)
+
+    sha = None
+    if fd.seekable():
+        start = fd.tell()
+        sha = _object_stream_pass(fd, header, size)
+        if object_freshen(repo, sha):
+            if TRACE:
+                TRACE.count("object_write.present")
+            return sha
+        fd.seek(start)
+
+    f, tmpPath = object_tmpfile(repo)
+    try:
+        written = _object_stream_pass(fd, header, size, f, repo, fmt)
+        if sha is not None and written != sha:
+            raise Exception("File changed while it was being hashed")
+        if sha is None and object_freshen(repo, written):
+            object_discard(f, tmpPath)
+            if TRACE:
+                TRACE.count("object_write.present")
+            return written
+        object_install(repo, f, tmpPath, written)
+    except BaseException:
+        object_discard(f, tmpPath)
+        raise
+    if TRACE:
+        TRACE.count("object_write.objects")
+        TRACE.count("zlib.deflate.bytes_in", len(header) + size)
+    return written
+
+
+# content defined chunking
+# chunk boundaries depend only on the bytes around them, so inserting or removing bytes in a file moves the boundaries
+# near the edit and leaves the others (and thus the chunks between them) unchanged. Every byte value is marked or not in
+# the fixed pseudo random CHUNK_MARKS table, which holds one marked value out of four, and a chunk ends after the first
+# run of CHUNK_RUN consecutive marked bytes found at least CHUNK_MIN bytes after it's start, or after CHUNK_MAX bytes.
+# The bytes are translated to their mark and the run is searched for with bytes.find, so the boundaries are found at
+# the speed of C instead of going through a python loop for every byte.
+
+# default average size of the chunks, set by core.chunkSize
+CHUNK_AVERAGE = 1024 * 1024
+CHUNK_MARKS = bytes(1 if hashlib.sha1(bytes([b])).digest()[0] & 3 == 0 else 0 for b in range(256))
+
+
+def repo_chunking(repo):
+    """Returns (threshold, average chunk size) from core.chunkThreshold and core.chunkSize of the repository config.
+    A threshold of 0, the default, disables chunked blobs"""
+    threshold = repo.conf.getint("core", "chunkthreshold", fallback=0)
+    average = repo.conf.getint("core", "chunksize", fallback=CHUNK_AVERAGE)
+    return threshold, max(average, 256)
+
+
+def chunk_params(average):
+    """Returns (minimum size, maximum size, run length) of the chunks for an average size.
+    The expected distance from the minimum size to the end of a run of n marked bytes is about 4 ** n * 4 / 3"""
+    minimum = average // 4
+    run = max(1, round(math.log((average - minimum) * 3 / 4, 4)))
+    return minimum, average * 4, b'\x01' * run
+
+
+def chunk_split(fd, size, average=CHUNK_AVERAGE):
+    """Generator over the chunks of the size bytes read from the open file fd"""
+    minimum, maximum, run = chunk_params(average)
+    buf = b''
+    pos = 0
+    remaining = size
+    while True:
+        if len(buf) - pos < maximum and remaining:
+            data = fd.read(min(remaining, max(maximum, STREAM_CHUNK_SIZE)))
+            if not data:
+                raise Exception("File shrank while it was being hashed")
+            remaining -= len(data)
+            buf = buf[pos:] + data
+            pos = 0
+            continue
+        if pos == len(buf):
+            return
+
+        end = min(pos + maximum, len(buf))
+        cut = end
+        # the bytes are translated an average chunk at a time, most chunks end in the first window
+        start = pos + minimum - len(run)
+        while start + len(run) <= end:
+            stop = min(start + average, end)
+            found = buf[start:stop].translate(CHUNK_MARKS).find(run)
+            if found >= 0:
+                cut = start + found + len(run)
+                break
+            start = stop - len(run) + 1
+        yield buf[pos:cut]
+        pos = cut
+
+
+def object_write_chunked(repo, fd, size, average=CHUNK_AVERAGE, actually_write=True):
+    """Hashes the size bytes read from the open file fd as a chunked blob and writes it to the repository if
+    actually_write is True. Chunks already present in the repository aren't written again"""
+    obj = vcsChunkedBlob(repo)
+    obj.chunks = list()
+    with vcsBulkCheckin(repo):
+        for data in chunk_split(fd, size, average):
+            obj.chunks.append((object_write_data(repo, b'blob', data, actually_write), len(data)))
+        return object_write(obj, actually_write)
+
+
+# shortest abbreviation of a hash accepted by object_find and default length of the abbreviations printed
+SHORT_SHA_MIN = 4
+SHORT_SHA_DEFAULT = 7
+
+def object_resolve_prefix(repo, prefix):
+    """Returns the hashes of the objects starting with the hex string prefix (at most two, which is enough to tell an
+    ambiguous prefix). Packed objects are found with a binary search in the pack indexes and loose objects by listing
+    the single fanout directory of the prefix"""
+    found = set()
+    d = repo_dir(repo, "objects", prefix[0:2])
+    if d:
+        for f in os.listdir(d):
+            if len(f) == 38 and f.startswith(prefix[2:]):
+                found.add(prefix[0:2] + f)
+    for pack in repo_packs(repo, reload=True):
+        found.update(pack.find_prefix(prefix, 2))
+    return sorted(found)[:2]
+
+
+def object_abbrev(repo, sha, length=SHORT_SHA_DEFAULT):
+    """Returns the shortest prefix of sha, of at least length characters, which doesn't match any other object"""
+    for n in range(length, 40):
+        if len(object_resolve_prefix(repo, sha[:n])) <= 1:
+            return sha[:n]
+    return sha
+
+
+def ref_find(repo, name):
+    """Returns the hash referenced by the reference name or None if there is no such reference.
+    name is looked up as is when it's a HEAD like name (HEAD, FETCH_HEAD) or a full reference (refs/heads/master),
+    and then under refs, refs/tags and refs/heads. The other files of .vcs (config, index...) are not references"""
+    candidates = ["refs/" + name, "refs/tags/" + name, "refs/heads/" + name]
+    if re.match(r'^[A-Z_]*HEAD$', name) or name.startswith("refs/"):
+        candidates.insert(0, name)
+    for candidate in candidates:
+        path = repo_file(repo, candidate)
+        if path and os.path.isfile(os.path.realpath(path)) and os.path.realpath(path).startswith(os.path.realpath(repo.vcsdir)):
+            try:
+                sha = ref_resolve(repo, candidate)
+            except UnicodeDecodeError:
+                sha = None
+            if sha == "":
+                # symbolic reference to a branch without commits
+                return None
+            if sha is None or not re.match(r'^[0-9a-f]{40}$', sha):
+                raise Exception("Reference {0} does not hold a valid hash".format(candidate))
+            return sha
+    return None
+
+
 def object_find(repo, name, fmt=None, follow=True):
     """ A name resolution function: Since a vcs object can be refered through various ways such as full hash, short hash,
-    tag etc"""
-    # unimplemented now (placeholder function) --> will be implemented later
-    if name == "HEAD":
-        return ref_resolve(repo, name)
-    else:
-        return name
+    tag etc.
+    name is a full or short hash, HEAD, a branch, a tag or a reference, followed by any number of ~N (Nth first parent
+    ancestor) and ^N (Nth parent) suffixes. If fmt is given and follow is True, a commit is followed to it's tree"""
+    m = re.match(r'^(.*?)((?:[~^]\d*)*)$', name)
+    base, suffix = m.group(1), m.group(2)
+    if not base:
+        raise Exception("Invalid object name {0}".format(name))
+
+    sha = ref_find(repo, base)
+    if sha is None:
+        if re.match(r'^[0-9a-fA-F]{40}$', base):
+            sha = base.lower()
+        elif re.match(r'^[0-9a-fA-F]{%d,39}$' % SHORT_SHA_MIN, base):
+            candidates = object_resolve_prefix(repo, base.lower())
+            if len(candidates) > 1:
+                raise Exception("Short SHA {0} is ambiguous".format(base))
+            if candidates:
+                sha = candidates[0]
+    if sha is None:
+        raise Exception("No such reference or object {0}".format(base))
+
+    for op, num in re.findall(r'([~^])(\d*)', suffix):
+        num = int(num) if num else 1
+        if op == '~':
+            for _ in range(num):
+                parents, _, _ = commit_info(repo, sha)
+                if not parents:
+                    raise Exception("{0} has no parent".format(sha))
+                sha = parents[0]
+        elif num:
+            parents, _, _ = commit_info(repo, sha)
+            if len(parents) < num:
+                raise Exception("{0} has no parent number {1}".format(sha, num))
+            sha = parents[num-1]
+
+    if fmt is not None:
+        objFmt, _ = object_info(repo, sha)
+        if objFmt != fmt and not (objFmt == b'chunked' and fmt == b'blob'):
+            if follow and objFmt == b'commit' and fmt == b'tree':
+                sha = object_read(repo, sha).header(b'tree')[0].decode("ascii")
+            else:
+                raise Exception("Object {0} is a {1}, not a {2}".format(name, objFmt.decode("ascii"), fmt.decode("ascii")))
+    return sha
+
+
+# packfile storage
+# a pack stores many objects in a single file, either whole or as a delta against another object of the pack.
+# every pack (.vcs/objects/pack/pack-<checksum>.pack) comes with an index (.idx) which holds the sorted object hashes,
+# a 256 entry fanout table over the first byte of the hash and the offset of every object inside the pack.
+# the index is memory mapped and searched with a binary search, so a lookup costs O(log n).
+
+PACK_SIGNATURE = b'PACK'
+PACK_VERSION = 2
+IDX_SIGNATURE = b'\xfftOc'
+IDX_VERSION = 2
+
+# object type numbers used in the pack entry headers
+PACK_OBJ_COMMIT = 1
+PACK_OBJ_TREE = 2
+PACK_OBJ_BLOB = 3
+PACK_OBJ_TAG = 4
+# type 5 is unused by git, it holds the chunked blobs
+PACK_OBJ_CHUNKED = 5
+PACK_OBJ_OFS_DELTA = 6
+
+PACK_TYPE_NUM = {b'commit': PACK_OBJ_COMMIT, b'tree': PACK_OBJ_TREE, b'blob': PACK_OBJ_BLOB, b'tag': PACK_OBJ_TAG,
+                 b'chunked': PACK_OBJ_CHUNKED}
+PACK_TYPE_FMT = {v: k for k, v in PACK_TYPE_NUM.items()}
+
+# delta search parameters used by repack
+PACK_WINDOW = 10
+PACK_MAX_DEPTH = 50
+PACK_DELTA_MIN_SIZE = 64
+PACK_DELTA_MAX_SIZE = 16 * 1024 * 1024
+# size of the blocks of the delta base indexed by delta_create and number of positions kept for a repeated block
+DELTA_BLOCK = 16
+DELTA_BUCKET = 4
+
+
+class vcsPack(object):
+    """A packfile together with it's memory mapped index"""
+
+    def __init__(self, path):
+        # path is the path of the pack without the .pack/.idx extension
+        self.path = path
+        with open(path + ".idx", "rb") as f:
+            self.idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(path + ".pack", "rb") as f:
+            self.pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.idx[0:4] != IDX_SIGNATURE or struct.unpack(">I", self.idx[4:8])[0] != IDX_VERSION:
+            raise Exception("Unsupported pack index {0}.idx".format(path))
+        if self.pack[0:4] != PACK_SIGNATURE or struct.unpack(">I", self.pack[4:8])[0] != PACK_VERSION:
+            raise Exception("Unsupported pack {0}.pack".format(path))
+
+        self.count = self.fanout(255)
+        # start of the various tables in the index file
+        self.shaTable = 8 + 256 * 4
+        self.crcTable = self.shaTable + 20 * self.count
+        self.offsetTable = self.crcTable + 4 * self.count
+        self.largeOffsetTable = self.offsetTable + 4 * self.count
+
+    @classmethod
+    def unindexed(cls, path, pack):
+        """Returns the pack held by the memory mapped file pack, which has no index yet: it's entries can only be
+        read by offset. Used to index a received pack"""
+        self = cls.__new__(cls)
+        self.path = path
+        self.idx = None
+        self.pack = pack
+        self.count = 0
+        return self
+
+    def close(self):
+        if self.idx is not None:
+            self.idx.close()
+        self.pack.close()
+
+    def fanout(self, byte):
+        """Number of objects in the pack whose first hash byte is <= byte"""
+        if byte < 0:
+            return 0
+        pos = 8 + byte * 4
+        return struct.unpack(">I", self.idx[pos:pos+4])[0]
+
+    def sha(self, i):
+        """Binary sha of the ith object in index order"""
+        pos = self.shaTable + 20 * i
+        return self.idx[pos:pos+20]
+
+    def offset(self, i):
+        """Offset inside the pack of the ith object in index order"""
+        pos = self.offsetTable + 4 * i
+        off = struct.unpack(">I", self.idx[pos:pos+4])[0]
+        if off & 0x80000000:
+            pos = self.largeOffsetTable + 8 * (off & 0x7fffffff)
+            off = struct.unpack(">Q", self.idx[pos:pos+8])[0]
+        return off
+
+    def find(self, sha):
+        """Returns the offset of the object whose binary sha is passed or None if it isn't in the pack"""
+        lo = self.fanout(sha[0] - 1)
+        hi = self.fanout(sha[0])
+        while lo < hi:
+            mid = (lo + hi) // 2
+            cur = self.sha(mid)
+            if cur < sha:
+                lo = mid + 1
+            elif cur > sha:
+                hi = mid
+            else:
+                return self.offset(mid)
+        return None
+
+    def find_prefix(self, prefix, limit):
+        """Returns the hex sha of at most limit objects of the pack whose hash starts with the hex string prefix"""
+        lower = bytes.fromhex(prefix + "0" * (len(prefix) % 2))
+        lo = self.fanout(lower[0] - 1)
+        hi = self.fanout(lower[0])
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.sha(mid) < lower:
+                lo = mid + 1
+            else:
+                hi = mid
+        res = list()
+        while lo < self.count and len(res) < limit:
+            sha = self.sha(lo).hex()
+            if not sha.startswith(prefix):
+                break
+            res.append(sha)
+            lo += 1
+        return res
+
+    def shas(self):
+        """Generator over the hex sha of every object in the pack"""
+        for i in range(self.count):
+            yield self.sha(i).hex()
+
+    def entry_header(self, offset):
+        """Parses the entry header at offset and returns (type, size, data offset, base offset).
+        base offset is only meaningful for delta entries"""
+        c = self.pack[offset]
+        pos = offset + 1
+        typ = (c >> 4) & 7
+        size = c & 0x0f
+        shift = 4
+        while c & 0x80:
+            c = self.pack[pos]
+            pos += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+
+        base = None
+        if typ == PACK_OBJ_OFS_DELTA:
+            c = self.pack[pos]
+            pos += 1
+            rel = c & 0x7f
+            while c & 0x80:
+                c = self.pack[pos]
+                pos += 1
+                rel = ((rel + 1) << 7) | (c & 0x7f)
+            base = offset - rel
+        return typ, size, pos, base
+
+    def inflate(self, pos, size):
+        """Decompresses the zlib stream starting at pos, size is the expected size of the result"""
+        with trace_span("pack.inflate"):
+            return self._inflate(pos, size)
+
+    def _inflate(self, pos, size):
+        return self.inflate_span(pos, size)[0]
+
+    def inflate_span(self, pos, size):
+        """Decompresses the zlib stream starting at pos like inflate. Returns the data and the position of the end
+        of the stream"""
+        d = zlib.decompressobj()
+        chunk = max(size, 4096)
+        out = list()
+        with memoryview(self.pack) as view:
+            while not d.eof:
+                if pos >= len(self.pack):
+                    raise Exception("Truncated pack {0}.pack".format(self.path))
+                out.append(d.decompress(view[pos:pos+chunk]))
+                pos += min(chunk, len(self.pack) - pos)
+        data = b''.join(out)
+        if TRACE:
+            TRACE.count("pack.inflate.bytes_out", len(data))
+        if len(data) != size:
+            raise Exception("Malformed pack entry in {0}.pack: bad length".format(self.path))
+        return data, pos - len(d.unused_data)
+
+    def inflate_head(self, pos, size):
+        """Decompresses only the first size bytes of the zlib stream starting at pos"""
+        d = zlib.decompressobj()
+        with memoryview(self.pack) as view:
+            return d.decompress(view[pos:pos+size+64], size)
+
+    def info_at(self, offset):
+        """Returns the (fmt, size) of the object stored at offset by reading only entry headers.
+        For a delta entry, the size of the object is read from the beginning of the delta and the type from the base"""
+        typ, size, pos, base = self.entry_header(offset)
+        if typ == PACK_OBJ_OFS_DELTA:
+            # the delta starts with the size of the base and the size of the result
+            head = self.inflate_head(pos, 20)
+            pos, _ = _varint_read(head, 0)
+            _, size = _varint_read(head, pos)
+            while typ == PACK_OBJ_OFS_DELTA:
+                typ, _, _, base = self.entry_header(base)
+        if typ not in PACK_TYPE_FMT:
+            raise Exception("Unknown pack object type {0} in {1}.pack".format(typ, self.path))
+        return PACK_TYPE_FMT[typ], size
+
+    def read_at(self, offset):
+        """Returns the (fmt, data) of the object stored at offset, resolving the delta chain if needed"""
+        deltas = list()
+        while True:
+            typ, size, pos, base = self.entry_header(offset)
+            if typ != PACK_OBJ_OFS_DELTA:
+                break
+            deltas.append((pos, size))
+            offset = base
+
+        if typ not in PACK_TYPE_FMT:
+            raise Exception("Unknown pack object type {0} in {1}.pack".format(typ, self.path))
+        data = self.inflate(pos, size)
+        # apply deltas from the one nearest to the base object to the one of the requested object
+        for pos, size in reversed(deltas):
+            data = delta_apply(data, self.inflate(pos, size))
+        return PACK_TYPE_FMT[typ], data
+
+
+def repo_packs(repo, reload=False):
+    """Returns the list of packs of the repository, opening them the first time they are needed.
+    When reload is True, the pack directory is scanned again and packs already opened are kept"""
+    if repo.packs is None or reload:
+        known = {pack.path: pack for pack in (repo.packs or [])}
+        packs = list()
+        path = repo_dir(repo, "objects", "pack")
+        repo.packsMtime = pack_dir_mtime(repo)
+        if path:
+            for f in sorted(os.listdir(path)):
+                if f.endswith(".idx") and os.path.isfile(os.path.join(path, f[:-4] + ".pack")):
+                    packPath = os.path.join(path, f[:-4])
+                    packs.append(known.pop(packPath) if packPath in known else vcsPack(packPath))
+        # packs which were removed from the disk
+        for pack in known.values():
+            pack.close()
+        repo.packs = packs
+    return repo.packs
+
+
+def pack_dir_mtime(repo):
+    """Returns the modification time of the pack directory, which changes whenever a pack is added or removed"""
+    try:
+        return os.stat(repo_path(repo, "objects", "pack")).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def pack_find(repo, sha):
+    """Returns the (pack, offset) of the object represented by sha or None if it isn't packed"""
+    binsha = bytes.fromhex(sha)
+    packs = repo_packs(repo)
+    for pack in packs:
+        offset = pack.find(binsha)
+        if offset is not None:
+            return pack, offset
+    # a new pack may have been written by some other process since the packs were loaded. Most lookups which miss
+    # are for new objects, so the directory is only listed again when it's modification time changed
+    if pack_dir_mtime(repo) != repo.packsMtime:
+        paths = [pack.path for pack in packs]
+        if [pack.path for pack in repo_packs(repo, reload=True)] != paths:
+            return pack_find(repo, sha)
+    return None
+
+
+def pack_read(repo, sha):
+    """Returns the (fmt, data) of a packed object or None if the object isn't packed"""
+    found = pack_find(repo, sha)
+    if found is None:
+        return None
+    pack, offset = found
+    return pack.read_at(offset)
+
+
+def pack_info(repo, sha):
+    """Returns the (fmt, size) of a packed object or None if the object isn't packed"""
+    found = pack_find(repo, sha)
+    if found is None:
+        return None
+    pack, offset = found
+    return pack.info_at(offset)
+
+
+def _varint_read(data, pos):
+    """Reads a little endian base 128 integer (used in delta headers) and returns (new position, value)"""
+    value = 0
+    shift = 0
+    while True:
+        c = data[pos]
+        pos += 1
+        value |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return pos, value
+
+
+def _varint_write(value):
+    """Encodes value as a little endian base 128 integer"""
+    res = bytearray()
+    while True:
+        c = value & 0x7f
+        value >>= 7
+        if value:
+            res.append(c | 0x80)
+        else:
+            res.append(c)
+            return bytes(res)
+
+
+def delta_apply(base, delta):
+    """Rebuilds an object from the base object and a delta made of copy and insert instructions"""
+    pos, srcSize = _varint_read(delta, 0)
+    pos, dstSize = _varint_read(delta, pos)
+    if srcSize != len(base):
+        raise Exception("Delta base size mismatch")
+
+    res = bytearray()
+    while pos < len(delta):
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            # copy instruction: the low 4 bits tell which offset bytes follow, the next 3 bits which size bytes follow
+            offset = 0
+            size = 0
+            for i in range(4):
+                if op & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if op & (0x10 << i):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            if size == 0:
+                size = 0x10000
+            res += base[offset:offset+size]
+        elif op:
+            # insert instruction: op is the number of literal bytes which follow
+            res += delta[pos:pos+op]
+            pos += op
+        else:
+            raise Exception("Invalid delta instruction")
+
+    if len(res) != dstSize:
+        raise Exception("Delta result size mismatch")
+    return bytes(res)
+
+
+def _delta_insert(res, data):
+    """Appends insert instructions for data to the delta being built in res"""
+    for i in range(0, len(data), 127):
+        chunk = data[i:i+127]
+        res.append(len(chunk))
+        res += chunk
+
+
+def _delta_copy(res, offset, size):
+    """Appends copy instructions of size bytes from offset of the base to the delta being built in res"""
+    while size:
+        n = min(size, 0x10000)
+        op = 0x80
+        args = bytearray()
+        for i in range(4):
+            byte = (offset >> (8 * i)) & 0xff
+            if byte:
+                op |= 1 << i
+                args.append(byte)
+        for i in range(3):
+            byte = (n >> (8 * i)) & 0xff
+            if byte:
+                op |= 0x10 << i
+                args.append(byte)
+        res.append(op)
+        res += args
+        offset += n
+        size -= n
+
+
+def _delta_match(base, i, target, j):
+    """Returns the length of the common run of bytes of base from i and target from j"""
+    n = 0
+    end = min(len(base) - i, len(target) - j)
+    # long runs are compared a block at a time, the block shrinking near the end of the run
+    step = 4096
+    while step:
+        while n + step <= end and base[i+n:i+n+step] == target[j+n:j+n+step]:
+            n += step
+        step //= 8
+    return n
+
+
+def delta_index(base):
+    """Returns the index of the blocks of base used by delta_create: the content of every block of DELTA_BLOCK bytes
+    mapped to the offsets of it's first DELTA_BUCKET occurrences"""
+    index = dict()
+    for off in range(0, len(base) - DELTA_BLOCK + 1, DELTA_BLOCK):
+        bucket = index.setdefault(base[off:off+DELTA_BLOCK], [])
+        if len(bucket) < DELTA_BUCKET:
+            bucket.append(off)
+    return index
+
+
+def delta_create(base, target, maxSize=None, index=None):
+    """Computes a delta which rebuilds target from base, or returns None if the delta would be larger than maxSize.
+    Like git, the base is cut in blocks of DELTA_BLOCK bytes indexed by their content (index, the result of
+    delta_index, when the same base is used several times). The target is scanned byte by byte for a block of the
+    base, and every block found is extended forwards and backwards as far as both agree and becomes a copy
+    instruction. The bytes between the copies are inserted as literal data. The cost is linear in the size of the
+    objects whatever their content"""
+    if index is None:
+        index = delta_index(base)
+
+    res = bytearray(_varint_write(len(base)) + _varint_write(len(target)))
+    if maxSize is None:
+        maxSize = len(target) + len(target) // 127 + len(res) + 1
+    lookup = index.get
+    pos = 0 # first target byte not yet encoded
+    i = 0
+    expected = 0 # base offset following the last copy, where an edit in place resumes
+    end = len(target) - DELTA_BLOCK
+    while i <= end:
+        block = target[i:i+DELTA_BLOCK]
+        candidates = lookup(block)
+        if candidates is None:
+            i += 1
+            if len(res) + i - pos > maxSize:
+                return None
+            continue
+        if expected not in candidates and base[expected:expected+DELTA_BLOCK] == block:
+            candidates = [expected] + candidates
+        off, n = max(((c, _delta_match(base, c, target, i)) for c in candidates), key=lambda x: x[1])
+        # extend the copy backwards over the bytes which would be inserted otherwise
+        while i > pos and off > 0 and base[off-1] == target[i-1]:
+            i -= 1
+            off -= 1
+            n += 1
+        _delta_insert(res, target[pos:i])
+        _delta_copy(res, off, n)
+        i += n
+        pos = i
+        expected = off + n
+        if len(res) > maxSize:
+            return None
+    _delta_insert(res, target[pos:])
+    if len(res) > maxSize:
+        return None
+    return bytes(res)
+
+
+def _pack_entry_header(typ, size):
+    """Encodes the type and size header of a pack entry"""
+    c = (typ << 4) | (size & 0x0f)
+    size >>= 4
+    res = bytearray()
+    while size:
+        res.append(c | 0x80)
+        c = size & 0x7f
+        size >>= 7
+    res.append(c)
+    return bytes(res)
+
+
+def _pack_ofs_encode(rel):
+    """Encodes the distance between a delta entry and it's base entry"""
+    res = bytearray([rel & 0x7f])
+    rel >>= 7
+    while rel:
+        rel -= 1
+        res.append(0x80 | (rel & 0x7f))
+        rel >>= 7
+    return bytes(reversed(res))
+
+
+def pack_index_write(path, entries, packSha):
+    """Writes the index of a pack. entries is a list of (binary sha, crc32, offset) of every object of the pack"""
+    entries = sorted(entries)
+    counts = [0] * 256
+    for sha, _, _ in entries:
+        counts[sha[0]] += 1
+
+    res = bytearray(IDX_SIGNATURE + struct.pack(">I", IDX_VERSION))
+    total = 0
+    for c in counts:
+        total += c
+        res += struct.pack(">I", total)
+    for sha, _, _ in entries:
+        res += sha
+    for _, crc, _ in entries:
+        res += struct.pack(">I", crc)
+    # offsets which don't fit in 31 bits are stored in a separate table of 64 bit offsets
+    large = bytearray()
+    for _, _, offset in entries:
+        if offset < 0x80000000:
+            res += struct.pack(">I", offset)
+        else:
+            res += struct.pack(">I", 0x80000000 | (len(large) // 8))
+            large += struct.pack(">Q", offset)
+    res += large
+    res += packSha
+    res += hashlib.sha1(res).digest()
+
+    tmpPath = path + ".idx.tmp"
+    with open(tmpPath, "wb") as f:
+        f.write(res)
+    os.replace(tmpPath, path + ".idx")
+
+
+def pack_write(repo, shas):
+    """Writes the objects represented by shas in a new pack of repo and returns the path of the pack without extension"""
+    packDir = repo_dir(repo, "objects", "pack", mkdir=True)
+    tmpPath = os.path.join(packDir, "tmp-pack-{0}".format(os.getpid()))
+    with open(tmpPath, "wb") as f:
+        entries, packSha = pack_stream(repo, shas, f)
+
+    path = os.path.join(packDir, "pack-{0}".format(packSha.hex()))
+    os.replace(tmpPath, path + ".pack")
+    pack_index_write(path, entries, packSha)
+    repo_packs(repo, reload=True)
+    return path
+
+
+def pack_index(repo, tmpPath):
+    """Indexes the pack written to tmpPath, a temporary file of the pack directory of repo: the checksum of the pack is
+    checked and every object is hashed, it's deltas being resolved. The pack and it's index are then moved in place.
+    Returns the path of the pack without extension"""
+    with open(tmpPath, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    pack = vcsPack.unindexed(tmpPath[:-len(".pack")] if tmpPath.endswith(".pack") else tmpPath, data)
+    try:
+        if len(data) < 32 or data[0:4] != PACK_SIGNATURE or struct.unpack(">I", data[4:8])[0] != PACK_VERSION:
+            raise Exception("Received data is not a pack")
+        packSha = data[-20:]
+        if hashlib.sha1(memoryview(data)[:-20]).digest() != packSha:
+            raise Exception("Received pack is corrupt: bad checksum")
+        count = struct.unpack(">I", data[8:12])[0]
+
+        entries = list()
+        # the delta bases are mostly among the last objects, the others are read again from the pack
+        recent = vcsLRU(CACHE_OBJECT_LIMIT)
+        offset = 12
+        for _ in range(count):
+            typ, size, pos, base = pack.entry_header(offset)
+            content, end = pack.inflate_span(pos, size)
+            if typ == PACK_OBJ_OFS_DELTA:
+                cached = recent.entries.get(base)
+                fmt, baseData = cached[0] if cached else pack.read_at(base)
+                content = delta_apply(baseData, content)
+            elif typ in PACK_TYPE_FMT:
+                fmt = PACK_TYPE_FMT[typ]
+            else:
+                raise Exception("Unknown pack object type {0} in received pack".format(typ))
+            hasher = hashlib.sha1(fmt + b' ' + str(len(content)).encode() + b'\x00')
+            hasher.update(content)
+            entries.append((hasher.digest(), zlib.crc32(memoryview(data)[offset:end]), offset))
+            recent.put(offset, (fmt, content), len(content))
+            offset = end
+        if offset != len(data) - 20:
+            raise Exception("Received pack is corrupt: unexpected data after the last object")
+    finally:
+        pack.close()
+
+    packDir = os.path.dirname(tmpPath)
+    path = os.path.join(packDir, "pack-{0}".format(packSha.hex()))
+    if repo_fsync(repo):
+        path_fsync(tmpPath)
+    os.replace(tmpPath, path + ".pack")
+    pack_index_write(path, entries, packSha)
+    if repo_fsync(repo):
+        path_fsync(path + ".idx")
+        path_fsync(packDir)
+    repo_packs(repo, reload=True)
+    return path
+
+
+def pack_stream(repo, shas, f):
+    """Writes a pack of the objects represented by shas of repo to the file f. Returns the entries of it's index,
+    (binary sha, crc32, offset) for every object, and the checksum of the pack.
+    Objects are sorted by type and decreasing size and every object is delta compressed against the best
+    of the PACK_WINDOW objects written before it"""
+    # first pass only collects type and size, reading the object headers, so that the content of all the objects
+    # isn't held in memory at once nor decompressed twice
+    info = list()
+    for sha in shas:
+        fmt, size = object_info(repo, sha)
+        info.append((fmt, size, sha))
+    info.sort(key=lambda x: (x[0], -x[1], x[2]))
+
+    checksum = hashlib.sha1()
+    entries = list()
+    # window of the previous objects which are candidate delta bases: [fmt, data, offset, depth, block index]
+    window = collections.deque(maxlen=PACK_WINDOW)
+
+    header = PACK_SIGNATURE + struct.pack(">II", PACK_VERSION, len(info))
+    f.write(header)
+    checksum.update(header)
+    offset = len(header)
+
+    for fmt, _, sha in info:
+        _, data = object_read_raw(repo, sha)
+        size = len(data)
+        best = None
+        if PACK_DELTA_MIN_SIZE <= size <= PACK_DELTA_MAX_SIZE:
+            for base in window:
+                if base[0] != fmt or base[3] >= PACK_MAX_DEPTH or len(base[1]) > 2 * size:
+                    continue
+                # the block index of a base is built the first time it's used
+                if base[4] is None:
+                    base[4] = delta_index(base[1])
+                # a delta is only worth it if it's much smaller than the object itself, and than the best one
+                delta = delta_create(base[1], data, (size // 2 if best is None else len(best[1])) - 1, base[4])
+                if delta is not None:
+                    best = (base, delta)
+
+        level = compression_level(repo, fmt, data, size, loose=False)
+        if best:
+            base, delta = best
+            entry = _pack_entry_header(PACK_OBJ_OFS_DELTA, len(delta)) + _pack_ofs_encode(offset - base[2]) + zlib.compress(delta, level)
+            depth = base[3] + 1
+        else:
+            entry = _pack_entry_header(PACK_TYPE_NUM[fmt], size) + zlib.compress(data, level)
+            depth = 0
+
+        f.write(entry)
+        checksum.update(entry)
+        entries.append((bytes.fromhex(sha), zlib.crc32(entry), offset))
+        if size <= PACK_DELTA_MAX_SIZE:
+            window.append([fmt, data, offset, depth, None])
+        offset += len(entry)
+
+    packSha = checksum.digest()
+    f.write(packSha)
+    return entries, packSha
+
+
+def loose_objects(repo):
+    """Generator over the hash of every loose object of the repository"""
+    path = repo_dir(repo, "objects")
+    for d in sorted(os.listdir(path)):
+        if len(d) != 2 or not os.path.isdir(os.path.join(path, d)):
+            continue
+        for f in sorted(os.listdir(os.path.join(path, d))):
+            if len(f) == 38:
+                yield d + f
+
+
+def oid_bin(sha):
+    """Returns the 20 byte binary form of an object hash given either as an hex string or in binary"""
+    return bytes.fromhex(sha) if isinstance(sha, str) else bytes(sha)
 
 
 # wrapper class for a single record in the tree
 class vcsTreeLeaf(object):
-    """Wrapper class to a single record"""
+    """Wrapper class to a single record. The hash is held in binary (binsha), sha gives it as an hex string"""
+    __slots__ = ("mode", "path", "binsha")
+
     def __init__(self, mode, path, sha):
         self.mode = mode
         self.path = path
-        self.sha = sha
-
-def tree_parse_one(raw, start=0):
-    """ Function to parse a single record in the tree object"""
-    # finding the space terminator of the mode
-    x = raw.find(b' ', start)
-    # checking if mode provided is correct or not
-    assert(x-start == 5 or x-start == 6)
+        self.binsha = oid_bin(sha)
 
-    # read the mode
-    mode = raw[start:x]
+    @property
+    def sha(self):
+        return self.binsha.hex()
 
-    # finding the NULL terminator of the path
-    y = raw.find(b'\x00', x)
-    # and read the path
-    path = raw[x+1:y]
+    @sha.setter
+    def sha(self, sha):
+        self.binsha = oid_bin(sha)
 
-    # Read the SHA and convert to an hex string
-    sha = hex(int.from_bytes(raw[y+1:y+21], "big"))
-    # removing the "0x" substring from the starting of the hex string
-    sha = sha[2:]
-
-    return y+21, vcsTreeLeaf(mode, path, sha)
+def tree_parse_one(raw, start=0):
+    """ Function to parse a single record in the tree object"""
+    pos, items = _tree_parse(raw, start, 1)
+    return pos, items[0]
+
+def _tree_parse(raw, start=0, count=-1):
+    """Parses count records (all of them if count is -1) of the tree raw from start. Returns (end, records).
+    The fields are located with bytes.find, the hashes are kept in binary and the records share one object per
+    distinct mode"""
+    find = raw.find
+    modes = dict()
+    size = len(raw)
+    res = list()
+    pos = start
+    while pos < size and count:
+        # finding the space terminator of the mode and the NULL terminator of the path
+        x = find(b' ', pos)
+        y = find(b'\x00', x)
+        # checking if mode provided is correct and the record is complete
+        if not (5 <= x - pos <= 6) or y < 0 or y + 21 > size:
+            raise Exception("Malformed tree record at offset {0}".format(pos))
+        mode = raw[pos:x]
+        res.append(vcsTreeLeaf(modes.setdefault(mode, mode), raw[x+1:y], raw[y+1:y+21]))
+        pos = y + 21
+        count -= 1
+    return pos, res
 
 def parse_tree(raw):
-    """ Function to parse the whole tree"""
-    pos = 0
-    max_len = len(raw)
-    res = list()
-    while pos < max_len:
-        pos, data = tree_parse_one(raw, pos)
-        res.append(data)
-    
-    return res
+    """ Function to parse the whole tree in a single pass"""
+    return _tree_parse(raw)[1]
 
 def tree_serialize(obj):
-    """Function to serialize a tree object"""
-    res = b''
+    """Function to serialize a tree object. The parts of the records are gathered in a list and joined once,
+    so the cost is linear in the number of records"""
+    res = list()
     for i in obj.items:
-        res += i.mode
-        res += b' '
-        res += i.path
-        res += b'\x00'
-        sha = int(i.sha, 16)
-        res += sha.to_bytes(20, byteorder="big")
+        res += (i.mode, b' ', i.path, b'\x00', i.binsha)
     
-    return res
+    return b''.join(res)
 
 # class for vcs tree
 class vcsTree(vcsObject):
@@ -397,9 +2016,960 @@ class vcsTree(vcsObject):
 
 
 
+# index (staging area)
+# the index file (.vcs/index) records for every file of the worktree the stat data seen when the file was last hashed
+# along with the hash of it's blob. A file whose stat data didn't change since then doesn't need to be read again.
+# layout: "VIDX" + version + number of entries, the entries sorted by path, the extensions and the sha-1 of everything before it.
+# every entry is mode, size, mtime_ns, ctime_ns, inode, binary sha, length of the path followed by the path itself.
+# every extension is a 4 byte signature, the length of it's content and the content. The cache tree ("TREE") keeps
+# the hash of the tree of every directory which didn't change since it was last written, the watch extension ("WTCH")
+# holds the token of the worktree watcher and the position in it's log up to which changes are part of the index.
+
+INDEX_SIGNATURE = b'VIDX'
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct(">4sII")
+INDEX_ENTRY = struct.Struct(">IQQQQ20sH")
+INDEX_EXTENSION = struct.Struct(">4sI")
+INDEX_EXT_TREE = b'TREE'
+INDEX_EXT_WATCH = b'WTCH'
+CACHE_TREE_ENTRY = struct.Struct(">II20sH")
+
+# names which are never part of the worktree snapshot
+WORKTREE_BLACKLIST = ['libvcs.py', 'vcs', '__pycache__', '.vcs']
+
+
+class vcsIndexEntry(object):
+    """Wrapper class to a single entry of the index. Like tree records, the hash is held in binary"""
+    __slots__ = ("path", "mode", "size", "mtime_ns", "ctime_ns", "ino", "binsha")
+
+    def __init__(self, path, mode, size, mtime_ns, ctime_ns, ino, sha):
+        self.path = path
+        self.mode = mode
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.ctime_ns = ctime_ns
+        self.ino = ino
+        self.binsha = oid_bin(sha)
+
+    @property
+    def sha(self):
+        return self.binsha.hex()
+
+    @sha.setter
+    def sha(self, sha):
+        self.binsha = oid_bin(sha)
+
+    @classmethod
+    def from_stat(cls, path, st, sha):
+        return cls(path, st.st_mode, st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino, sha)
+
+    def matches(self, st):
+        """Checks if the stat data of the file is the one recorded in the entry"""
+        return (self.size == st.st_size and self.mtime_ns == st.st_mtime_ns and self.ctime_ns == st.st_ctime_ns
+                and self.ino == st.st_ino and self.mode == st.st_mode)
+
+
+class vcsIndex(object):
+    """In memory representation of the index file"""
+    def __init__(self):
+        # path of the file relative to the worktree --> vcsIndexEntry
+        self.entries = dict()
+        # modification time of the index file when it was read
+        self.mtime_ns = None
+        # cache tree: directory relative to the worktree ("" for the root) --> (tree sha, number of index entries
+        # under the directory, mode of the directory). Only directories whose content didn't change since their
+        # tree was written are present
+        self.trees = dict()
+        # (token of the worktree watcher, position in the watch log) when the index was last refreshed
+        # with the help of the watcher, else None
+        self.watch = None
+
+    def add(self, entry):
+        """Records entry in the index, invalidating the cached trees of the directories holding it"""
+        self.entries[entry.path] = entry
+        self.invalidate(entry.path)
+
+    def remove(self, name):
+        """Removes the entry of file name from the index, invalidating the cached trees of the directories holding it"""
+        del self.entries[name]
+        self.invalidate(name)
+
+    def invalidate(self, name):
+        """Drops the cached trees along the path of file name"""
+        while name:
+            name = os.path.dirname(name)
+            self.trees.pop(name, None)
+
+    def is_racy(self, entry):
+        """A file modified in the same instant the index was written can change again without any change to it's
+        stat data, so such an entry can't be trusted and the file has to be hashed again"""
+        return self.mtime_ns is None or entry.mtime_ns >= self.mtime_ns
+
+
+def index_read(repo):
+    """Reads the index file of the repository. Returns an empty index if there is no index file"""
+    index = vcsIndex()
+    path = repo_file(repo, "index")
+    if not os.path.isfile(path):
+        return index
+
+    with open(path, "rb") as f:
+        data = f.read()
+        index.mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+
+    if hashlib.sha1(data[:-20]).digest() != data[-20:]:
+        raise Exception("Index file {0} is corrupt: bad checksum".format(path))
+    signature, version, count = INDEX_HEADER.unpack_from(data, 0)
+    if signature != INDEX_SIGNATURE or version != INDEX_VERSION:
+        raise Exception("Unsupported index file {0}".format(path))
+
+    pos = INDEX_HEADER.size
+    for _ in range(count):
+        mode, size, mtime_ns, ctime_ns, ino, sha, length = INDEX_ENTRY.unpack_from(data, pos)
+        pos += INDEX_ENTRY.size
+        name = data[pos:pos+length].decode()
+        pos += length
+        index.entries[name] = vcsIndexEntry(name, mode, size, mtime_ns, ctime_ns, ino, sha)
+
+    # extensions, unknown ones are skipped
+    while pos < len(data) - 20:
+        signature, length = INDEX_EXTENSION.unpack_from(data, pos)
+        pos += INDEX_EXTENSION.size
+        if signature == INDEX_EXT_TREE:
+            cache_tree_parse(repo, index, data[pos:pos+length])
+        elif signature == INDEX_EXT_WATCH:
+            end = data.index(b'\x00', pos)
+            index.watch = (data[pos:end].decode(), struct.unpack_from(">Q", data, end + 1)[0])
+        pos += length
+    return index
+
+
+def cache_tree_parse(repo, index, data):
+    """Reads the cache tree extension of the index. Trees hold the absolute path of their entries, so the cache
+    is only valid for the worktree it was written in"""
+    end = data.find(b'\x00')
+    if data[:end].decode() != repo.worktree:
+        return
+    pos = end + 1
+    while pos < len(data):
+        count, mode, sha, length = CACHE_TREE_ENTRY.unpack_from(data, pos)
+        pos += CACHE_TREE_ENTRY.size
+        name = data[pos:pos+length].decode()
+        pos += length
+        index.trees[name] = (sha.hex(), count, mode)
+
+
+def cache_tree_serialize(repo, index):
+    """Forms the content of the cache tree extension of the index"""
+    res = bytearray(repo.worktree.encode() + b'\x00')
+    for name in sorted(index.trees):
+        sha, count, mode = index.trees[name]
+        path = name.encode()
+        res += CACHE_TREE_ENTRY.pack(count, mode, bytes.fromhex(sha), len(path))
+        res += path
+    return res
+
+
+def index_write(repo, index):
+    """Writes the index to the index file of the repository. The file is written under a lock file which is then
+    renamed, so a crash never leaves a truncated index and two processes can't write the index at the same time"""
+    res = bytearray(INDEX_HEADER.pack(INDEX_SIGNATURE, INDEX_VERSION, len(index.entries)))
+    for name in sorted(index.entries):
+        entry = index.entries[name]
+        path = name.encode()
+        res += INDEX_ENTRY.pack(entry.mode, entry.size, entry.mtime_ns, entry.ctime_ns, entry.ino,
+                                entry.binsha, len(path))
+        res += path
+    if index.trees:
+        ext = cache_tree_serialize(repo, index)
+        res += INDEX_EXTENSION.pack(INDEX_EXT_TREE, len(ext))
+        res += ext
+    if index.watch:
+        token, offset = index.watch
+        ext = token.encode() + b'\x00' + struct.pack(">Q", offset)
+        res += INDEX_EXTENSION.pack(INDEX_EXT_WATCH, len(ext))
+        res += ext
+    res += hashlib.sha1(res).digest()
+
+    lockPath = repo_file(repo, "index.lock")
+    try:
+        f = open(lockPath, "xb")
+    except FileExistsError:
+        raise Exception("Unable to create {0}: another vcs process seems to be running".format(lockPath))
+    try:
+        with f:
+            f.write(res)
+        os.replace(lockPath, repo_file(repo, "index"))
+    except BaseException:
+        os.remove(lockPath)
+        raise
+    index.mtime_ns = os.stat(repo_file(repo, "index")).st_mtime_ns
+
+
+def worktree_files(repo, path=None):
+    """Generator over (path relative to worktree, stat result) of every file of the worktree under the
+    directory path (relative to the worktree). Names present in WORKTREE_BLACKLIST are skipped"""
+    if path:
+        stack = [(os.path.join(repo.worktree, path), path + "/")]
+    else:
+        stack = [(repo.worktree, "")]
+    while stack:
+        top, prefix = stack.pop()
+        with trace_span("worktree_walk.scandir"), os.scandir(top) as it:
+            entries = list(it)
+        if TRACE:
+            TRACE.count("worktree_walk.dirs")
+            TRACE.count("worktree_walk.entries", len(entries))
+        for entry in entries:
+            if entry.name in WORKTREE_BLACKLIST:
+                continue
+            if entry.is_dir():
+                stack.append((entry.path, prefix + entry.name + "/"))
+            elif entry.is_file():
+                yield prefix + entry.name, entry.stat()
+
+
+def index_hash_file(repo, name, actually_write=True):
+    """Hashes the worktree file name (relative to the worktree) and returns the index entry of the file.
+    The stat data is taken from the opened file, so a later change of the file is noticed by the next refresh"""
+    with open(os.path.join(repo.worktree, name), "rb") as f:
+        st = os.fstat(f.fileno())
+        sha = object_write_stream(repo, f, st.st_size, actually_write=actually_write)
+    return vcsIndexEntry.from_stat(name, st, sha)
+
+
+def repo_workers(repo, workers=None):
+    """Returns the number of worker threads to use: workers if it's given, else core.workers
+    of the repository config, else the number of CPUs"""
+    if workers:
+        return workers
+    if repo.conf.has_option("core", "workers"):
+        return max(1, repo.conf.getint("core", "workers"))
+    return os.cpu_count() or 1
+
+
+def index_hash_files(repo, names, actually_write=True, workers=1):
+    """Hashes the worktree files names on a pool of workers threads and returns their index entries in the order
+    of names. Reading, sha-1 and zlib release the GIL, so the files are hashed and compressed in parallel"""
+    if workers <= 1 or len(names) <= 1:
+        return [index_hash_file(repo, name, actually_write) for name in names]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda name: index_hash_file(repo, name, actually_write), names))
+
+
+def worktree_skipped(name):
+    """Checks if the path name (relative to the worktree) is under a name present in WORKTREE_BLACKLIST"""
+    return bool(set(name.split("/")) & set(WORKTREE_BLACKLIST))
+
+
+def index_refresh(repo, index, actually_write=True, verbose=False, workers=1):
+    """Brings the index in line with the worktree: new files and files whose stat data changed are hashed
+    (and written if actually_write is True) and entries of deleted files are dropped.
+    When a worktree watcher is running (see vcs watch) and the index is in sync with it, only the paths the watcher
+    saw changing are looked at, else the whole worktree is enumerated.
+    The files to hash are then hashed on workers threads. Returns True if the index has been changed"""
+    with trace_span("index_refresh.watch"):
+        watch, dirty = watch_changes(repo, index)
+    if dirty is None:
+        dirty = [""]
+    changed = watch != index.watch
+    index.watch = watch
+
+    # a path under another dirty directory is enumerated along with it
+    dirty = set(dirty)
+    roots = list()
+    for path in sorted(dirty):
+        parent = path
+        while parent:
+            parent = os.path.dirname(parent)
+            if parent in dirty:
+                break
+        else:
+            if not worktree_skipped(path):
+                roots.append(path)
+
+    names = sorted(index.entries)
+    stale = list()
+    with trace_span("index_refresh.scan"):
+        for path in roots:
+            full = os.path.join(repo.worktree, path)
+            try:
+                st = os.stat(full)
+            except (FileNotFoundError, NotADirectoryError):
+                st = None
+            if st is not None and stat.S_ISDIR(st.st_mode):
+                files = worktree_files(repo, path)
+            elif st is not None and stat.S_ISREG(st.st_mode):
+                files = [(path, st)]
+            else:
+                files = []
+
+            seen = set()
+            for name, st in files:
+                seen.add(name)
+                entry = index.entries.get(name)
+                if entry and entry.matches(st) and not index.is_racy(entry):
+                    continue
+                stale.append(name)
+
+            # entries of path itself and of the files under it which are gone
+            if path:
+                lo = bisect.bisect_left(names, path)
+                hi = bisect.bisect_left(names, path + "0")
+            else:
+                lo, hi = 0, len(names)
+            for name in names[lo:hi]:
+                if (name == path or not path or name.startswith(path + "/")) and name not in seen and name in index.entries:
+                    index.remove(name)
+                    changed = True
+    if TRACE:
+        TRACE.count("index_refresh.hashed", len(stale))
+
+    changed = changed or bool(stale)
+    with trace_span("index_refresh.hash"):
+        hashed = index_hash_files(repo, stale, actually_write, workers)
+    for entry in hashed:
+        name = entry.path
+        # a racy entry which turns out unchanged doesn't invalidate the cached trees
+        if not (name in index.entries and index.entries[name].binsha == entry.binsha and index.entries[name].mode == entry.mode):
+            index.invalidate(name)
+        index.entries[name] = entry
+        if verbose:
+            dest = os.path.join(repo.worktree, name)
+            print("Added {0} to current commit".format(dest))
+            print("sha of {0} ----> {1}\n".format(dest, entry.sha))
+    return changed
+
+
+def index_write_tree(repo, index, actually_write=True):
+    """Creates the tree objects of the files recorded in the index and returns the hash of the root tree.
+    Directories present in the cache tree are reused without looking at their content, so only the trees
+    along the paths of changed files are built again"""
+    names = sorted(index.entries)
+
+    def build(d, lo, hi):
+        """Builds the tree of directory d, whose files are names[lo:hi]"""
+        prefix = d + "/" if d else ""
+        items = list()
+        i = lo
+        while i < hi:
+            rest = names[i][len(prefix):]
+            slash = rest.find("/")
+            if slash < 0:
+                entry = index.entries[names[i]]
+                items.append(vcsTreeLeaf(str(entry.mode).encode(), os.path.join(repo.worktree, names[i]).encode(), entry.binsha))
+                i += 1
+                continue
+
+            sub = prefix + rest[:slash]
+            if sub in index.trees:
+                sha, count, mode = index.trees[sub]
+                j = i + count
+            else:
+                # the files of sub are the names starting with "sub/", and "0" is the character following "/"
+                j = bisect.bisect_left(names, sub + "0", i, hi)
+                sha = build(sub, i, j)
+                mode = index.trees[sub][2] if sub in index.trees else os.stat(os.path.join(repo.worktree, sub)).st_mode
+            items.append(vcsTreeLeaf(str(mode).encode(), os.path.join(repo.worktree, sub).encode(), sha))
+            i = j
+
+        treeObj = vcsTree(repo)
+        treeObj.items = items
+        sha = object_write(treeObj, actually_write)
+        # trees which weren't written can't be reused by a later commit
+        if actually_write:
+            mode = os.stat(os.path.join(repo.worktree, d)).st_mode if d else 0
+            index.trees[d] = (sha, hi - lo, mode)
+        return sha
+
+    if "" in index.trees:
+        return index.trees[""][0]
+    return build("", 0, len(names))
+
+
+def index_snapshot(repo, verbose=False, workers=1):
+    """Refreshes the index of repo, writes the blobs and trees of the worktree and saves the index.
+    Returns the hash of the root tree of the worktree"""
+    # only the files whose stat data changed since they were recorded in the index are hashed again
+    index = index_read(repo)
+    # the blobs and trees are made durable at once, before the index refers to them
+    with vcsBulkCheckin(repo):
+        changed = index_refresh(repo, index, verbose=verbose, workers=workers)
+        # trees of the directories left untouched since the last commit are taken from the cache tree
+        rebuilt = "" not in index.trees
+        treeHash = index_write_tree(repo, index)
+    if changed or rebuilt:
+        index_write(repo, index)
+    return treeHash
+
+
+
+
+# worktree watcher
+# vcs watch runs a daemon which watches every directory of the worktree with the inotify api of linux and appends the
+# paths (relative to the worktree) of the files and directories changing under it to the watch log (.vcs/watch-log),
+# one per line. The watch file (.vcs/watch) holds the token of the daemon: it's pid, start time and a generation number
+# which is bumped whenever the log is truncated or events were lost. The index records the token and the position in
+# the log up to which changes are part of it, so a refresh only looks at the paths logged since then. Whenever the
+# token doesn't match, the whole worktree is enumerated again.
+# before reading the log, a process creates a cookie file in .vcs/watch-cookies and waits for the daemon to delete it.
+# inotify events are delivered in order, so every change made before the cookie was created is in the log by then.
+
+# size of the watch log above which the daemon truncates it and starts a new generation
+WATCH_LOG_LIMIT = 1024 * 1024
+# time in seconds a process waits for the daemon to acknowledge a cookie before enumerating the whole worktree
+WATCH_SYNC_TIMEOUT = 1.0
+# time in seconds during which the daemon gathers events before appending them to the log
+WATCH_BATCH_DELAY = 0.02
+
+# inotify constants (linux/inotify.h)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+def watch_token(repo):
+    """Returns the token of the watcher of the worktree or None if no watcher is running"""
+    path = repo_file(repo, "watch")
+    try:
+        with open(path) as f:
+            token = f.read().strip()
+        os.kill(int(token.split()[0]), 0)
+    except (FileNotFoundError, ValueError, IndexError, ProcessLookupError):
+        return None
+    except PermissionError:
+        pass
+    return token
+
+
+def watch_sync(repo):
+    """Waits until the watcher logged every change made so far. Returns False if it didn't answer in time"""
+    path = os.path.join(repo_dir(repo, "watch-cookies", mkdir=True),
+                        "{0}-{1}-{2}".format(os.getpid(), threading.get_ident(), time.monotonic_ns()))
+    open(path, "xb").close()
+    deadline = time.monotonic() + WATCH_SYNC_TIMEOUT
+    delay = 0.0005
+    while os.path.exists(path):
+        if time.monotonic() > deadline:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                return True
+            return False
+        time.sleep(delay)
+        delay = min(delay * 2, 0.01)
+    return True
+
+
+def watch_changes(repo, index):
+    """Asks the watcher of the worktree for the paths which changed since index was last refreshed.
+    Returns (watch, dirty) where watch is the new (token, log position) to record in the index, or None if no
+    watcher is running, and dirty is the list of changed paths, or None if the whole worktree has to be enumerated"""
+    token = watch_token(repo)
+    if token is None or not watch_sync(repo):
+        return None, None
+    start = index.watch[1] if index.watch and index.watch[0] == token else None
+    try:
+        with open(repo_file(repo, "watch-log"), "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if start is not None and start <= size:
+                f.seek(start)
+                data = f.read(size - start)
+            else:
+                start = None
+                data = b''
+    except FileNotFoundError:
+        return None, None
+    # the log is truncated after the token is changed, so the log read belongs to token if it's still the same
+    if watch_token(repo) != token:
+        return None, None
+    # a batch being appended meanwhile is left for the next refresh
+    end = data.rfind(b'\n') + 1
+    if start is None:
+        return (token, size), None
+    return (token, start + end), data[:end].decode().splitlines()
+
+
+class vcsWatcher(object):
+    """Daemon watching every directory of the worktree of repo with inotify"""
+    def __init__(self, repo):
+        self.repo = repo
+        try:
+            self.libc = ctypes.CDLL(None, use_errno=True)
+            self.libc.inotify_init1
+        except (OSError, AttributeError):
+            raise Exception("vcs watch needs the inotify api of linux")
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        # watch descriptor --> directory relative to the worktree and the opposite
+        self.paths = dict()
+        self.wds = dict()
+        self.dirty = set()
+        self.cookies = list()
+        self.overflow = False
+        self.generation = 0
+        self.started = time.time_ns()
+        self.cookieDir = repo_dir(repo, "watch-cookies", mkdir=True)
+        self.cookieWd = self.add_watch(self.cookieDir, IN_CREATE | IN_ONLYDIR)
+        self.watch_tree("")
+
+    def add_watch(self, path, mask):
+        """Adds an inotify watch on the directory path. Returns the watch descriptor or None if path is gone"""
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                raise Exception("Unable to watch {0}: limit of inotify watches reached "
+                                "(see /proc/sys/fs/inotify/max_user_watches)".format(path))
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                return None
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def watch_tree(self, path):
+        """Watches the directory path (relative to the worktree) and every directory under it"""
+        stack = [path]
+        while stack:
+            top = stack.pop()
+            full = os.path.join(self.repo.worktree, top)
+            wd = self.add_watch(full, WATCH_MASK)
+            if wd is None:
+                continue
+            self.paths[wd] = top
+            self.wds[top] = wd
+            try:
+                with os.scandir(full) as it:
+                    for entry in it:
+                        if entry.name not in WORKTREE_BLACKLIST and entry.is_dir():
+                            stack.append(top + "/" + entry.name if top else entry.name)
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+
+    def unwatch_tree(self, path):
+        """Stops watching the directory path (relative to the worktree) and the directories under it"""
+        for top in [top for top in self.wds if top == path or top.startswith(path + "/")]:
+            wd = self.wds.pop(top)
+            del self.paths[wd]
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self):
+        """Reads the pending inotify events and records the paths they concern"""
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, pos)
+                name = data[pos+INOTIFY_EVENT.size:pos+INOTIFY_EVENT.size+length].rstrip(b'\x00')
+                pos += INOTIFY_EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    self.overflow = True
+                    continue
+                if wd == self.cookieWd:
+                    if mask & IN_CREATE:
+                        self.cookies.append(name)
+                    continue
+                if mask & IN_IGNORED:
+                    top = self.paths.pop(wd, None)
+                    if top is not None and self.wds.get(top) == wd:
+                        del self.wds[top]
+                    continue
+                top = self.paths.get(wd)
+                if top is None or not name:
+                    continue
+                name = os.fsdecode(name)
+                if name in WORKTREE_BLACKLIST:
+                    continue
+                if "\n" in name:
+                    # can't be written to the log
+                    self.overflow = True
+                    continue
+                path = top + "/" + name if top else name
+                self.dirty.add(path)
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        self.watch_tree(path)
+                    elif mask & IN_MOVED_FROM:
+                        self.unwatch_tree(path)
+
+    def token(self):
+        return "{0} {1} {2}".format(os.getpid(), self.started, self.generation)
+
+    def write_token(self):
+        path = repo_file(self.repo, "watch")
+        with open(path + ".tmp", "w") as f:
+            f.write(self.token() + "\n")
+        os.replace(path + ".tmp", path)
+
+    def new_generation(self):
+        """Truncates the log under a new token, so the indexes synced with the previous one enumerate the worktree"""
+        self.generation += 1
+        self.write_token()
+        open(repo_file(self.repo, "watch-log"), "wb").close()
+        self.dirty.clear()
+        self.overflow = False
+
+    def flush(self):
+        """Appends the paths changed since the last flush to the log, then acknowledges the pending cookies"""
+        logPath = repo_file(self.repo, "watch-log")
+        if self.overflow or os.path.getsize(logPath) > WATCH_LOG_LIMIT:
+            self.new_generation()
+        if self.dirty:
+            with open(logPath, "ab") as f:
+                f.write("".join(path + "\n" for path in sorted(self.dirty)).encode())
+            self.dirty.clear()
+        for name in self.cookies:
+            try:
+                os.remove(os.path.join(os.fsencode(self.cookieDir), name))
+            except FileNotFoundError:
+                pass
+        self.cookies = list()
+
+    def run(self):
+        """Watches the worktree until it's removed or the process is terminated"""
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        self.new_generation()
+        try:
+            while "" in self.wds:
+                select.select([self.fd], [], [])
+                self.read()
+                # events following closely are appended in the same batch, unless someone waits for them
+                while not self.cookies and select.select([self.fd], [], [], WATCH_BATCH_DELAY)[0]:
+                    self.read()
+                self.flush()
+        finally:
+            if watch_token(self.repo) == self.token():
+                os.remove(repo_file(self.repo, "watch"))
+            os.close(self.fd)
+
+
+# commit graph
+# the commit graph file (.vcs/commit-graph) holds the tree, the parents, the commit time and the generation number of
+# every commit in a fixed width binary layout, so that history can be walked without decompressing and parsing commits.
+# layout: "VCGR" + version + number of commits + number of extra edges, a 256 entry fanout table over the first byte
+# of the hashes, the sorted binary hashes, the record position of each sorted hash, the records, the extra edges and
+# the sha-1 of everything before it.
+# records are stored in topological order (parents before children), so a new commit is appended without moving the
+# others. A record is the binary hash, the binary tree hash, the positions of the first two parents, the generation
+# number and the commit time. When a commit has more than two parents, the second parent field holds
+# COMMIT_GRAPH_EXTRA_EDGES | index of it's parents (from the second one) in the extra edges list, where the last
+# parent of the commit is marked with COMMIT_GRAPH_LAST_EDGE.
+# generation number of a commit is 1 for a root commit, else 1 + the biggest generation number of it's parents, thus
+# a commit can't be an ancestor of a commit whose generation number isn't bigger.
+
+COMMIT_GRAPH_SIGNATURE = b'VCGR'
+COMMIT_GRAPH_VERSION = 1
+COMMIT_GRAPH_HEADER = struct.Struct(">4sIII")
+COMMIT_GRAPH_RECORD = struct.Struct(">20s20sIIIq")
+COMMIT_GRAPH_NO_PARENT = 0xffffffff
+COMMIT_GRAPH_EXTRA_EDGES = 0x80000000
+COMMIT_GRAPH_LAST_EDGE = 0x80000000
+
+
+def commit_time(commit):
+    """Returns the commit time of a commit object as a unix timestamp, 0 for commits recorded without time.
+    Author and committer lines end with the unix time and the timezone offset of the commit"""
+    for key in (b'committer', b'author'):
+        values = commit.header(key)
+        if values:
+            fields = values[0].split(b' ')
+            if len(fields) >= 2 and fields[-2].isdigit() and re.match(rb'^[+-]\d{4}$', fields[-1]):
+                return int(fields[-2])
+    return 0
+
+
+def commit_parents(commit):
+    """Returns the hash of the parents of a commit object"""
+    return [p.decode("ascii") for p in commit.header(b'parent')]
+
+
+class vcsCommitGraph(object):
+    """Memory mapped commit graph file"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        signature, version, self.count, self.edgeCount = COMMIT_GRAPH_HEADER.unpack_from(self.data, 0)
+        if signature != COMMIT_GRAPH_SIGNATURE or version != COMMIT_GRAPH_VERSION:
+            raise Exception("Unsupported commit graph {0}".format(path))
+        # start of the various tables of the file
+        self.fanoutTable = COMMIT_GRAPH_HEADER.size
+        self.shaTable = self.fanoutTable + 256 * 4
+        self.posTable = self.shaTable + 20 * self.count
+        self.recordTable = self.posTable + 4 * self.count
+        self.edgeTable = self.recordTable + COMMIT_GRAPH_RECORD.size * self.count
+
+    def close(self):
+        self.data.close()
+
+    def fanout(self, byte):
+        if byte < 0:
+            return 0
+        return struct.unpack_from(">I", self.data, self.fanoutTable + 4 * byte)[0]
+
+    def find(self, sha):
+        """Returns the record position of the commit represented by sha, or None if it isn't in the graph"""
+        binsha = bytes.fromhex(sha)
+        lo = self.fanout(binsha[0] - 1)
+        hi = self.fanout(binsha[0])
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = self.shaTable + 20 * mid
+            cur = self.data[pos:pos+20]
+            if cur < binsha:
+                lo = mid + 1
+            elif cur > binsha:
+                hi = mid
+            else:
+                return struct.unpack_from(">I", self.data, self.posTable + 4 * mid)[0]
+        return None
+
+    def record(self, pos):
+        """Returns the raw (binary sha, binary tree sha, parent 1, parent 2, generation, time) of the record at pos"""
+        return COMMIT_GRAPH_RECORD.unpack_from(self.data, self.recordTable + COMMIT_GRAPH_RECORD.size * pos)
+
+    def sha(self, pos):
+        return self.record(pos)[0].hex()
+
+    def tree(self, pos):
+        return self.record(pos)[1].hex()
+
+    def generation(self, pos):
+        return self.record(pos)[4]
+
+    def time(self, pos):
+        return self.record(pos)[5]
+
+    def parents(self, pos):
+        """Returns the record positions of the parents of the commit at pos"""
+        _, _, p1, p2, _, _ = self.record(pos)
+        if p1 == COMMIT_GRAPH_NO_PARENT:
+            return []
+        if p2 == COMMIT_GRAPH_NO_PARENT:
+            return [p1]
+        if not p2 & COMMIT_GRAPH_EXTRA_EDGES:
+            return [p1, p2]
+        res = [p1]
+        i = p2 & ~COMMIT_GRAPH_EXTRA_EDGES
+        while True:
+            edge = struct.unpack_from(">I", self.data, self.edgeTable + 4 * i)[0]
+            res.append(edge & ~COMMIT_GRAPH_LAST_EDGE)
+            if edge & COMMIT_GRAPH_LAST_EDGE:
+                return res
+            i += 1
+
+    def records(self):
+        """Generator over (sha, tree, parent hashes, generation, time) of every commit in topological order"""
+        for pos in range(self.count):
+            binsha, tree, _, _, generation, ctime = self.record(pos)
+            yield binsha.hex(), tree.hex(), [self.sha(p) for p in self.parents(pos)], generation, ctime
+
+
+def repo_commit_graph(repo):
+    """Returns the commit graph of the repository or None if it has no commit graph file"""
+    path = repo_file(repo, "commit-graph")
+    if repo.commitGraph is not None and repo.commitGraph.path == path:
+        return repo.commitGraph
+    if not os.path.isfile(path):
+        return None
+    repo.commitGraph = vcsCommitGraph(path)
+    return repo.commitGraph
+
+
+def commit_graph_serialize(records):
+    """Forms the content of a commit graph file from a list of (sha, tree, parent hashes, generation, time)
+    in topological order"""
+    position = {sha: pos for pos, (sha, _, _, _, _) in enumerate(records)}
+    order = sorted(range(len(records)), key=lambda pos: records[pos][0])
+
+    body = bytearray()
+    edges = bytearray()
+    for sha, tree, parents, generation, ctime in records:
+        p = [position[parent] for parent in parents]
+        p1 = p[0] if p else COMMIT_GRAPH_NO_PARENT
+        if len(p) <= 2:
+            p2 = p[1] if len(p) == 2 else COMMIT_GRAPH_NO_PARENT
+        else:
+            p2 = COMMIT_GRAPH_EXTRA_EDGES | (len(edges) // 4)
+            for i, parent in enumerate(p[1:]):
+                edges += struct.pack(">I", parent | (COMMIT_GRAPH_LAST_EDGE if i == len(p) - 2 else 0))
+        body += COMMIT_GRAPH_RECORD.pack(bytes.fromhex(sha), bytes.fromhex(tree), p1, p2, generation, ctime)
+
+    counts = [0] * 256
+    for sha, _, _, _, _ in records:
+        counts[int(sha[0:2], 16)] += 1
+
+    res = bytearray(COMMIT_GRAPH_HEADER.pack(COMMIT_GRAPH_SIGNATURE, COMMIT_GRAPH_VERSION, len(records), len(edges) // 4))
+    total = 0
+    for c in counts:
+        total += c
+        res += struct.pack(">I", total)
+    for pos in order:
+        res += bytes.fromhex(records[pos][0])
+    for pos in order:
+        res += struct.pack(">I", pos)
+    res += body
+    res += edges
+    res += hashlib.sha1(res).digest()
+    return res
+
+
+def commit_graph_save(repo, data):
+    """Writes the content of the commit graph file of the repository atomically"""
+    path = repo_file(repo, "commit-graph")
+    tmpPath = path + ".tmp"
+    with open(tmpPath, "wb") as f:
+        f.write(data)
+    if repo.commitGraph is not None:
+        repo.commitGraph.close()
+        repo.commitGraph = None
+    os.replace(tmpPath, path)
+
+
+def commit_graph_write(repo):
+    """Writes a commit graph holding every commit reachable from the references and HEAD of the repository.
+    Returns the number of commits in the graph"""
+    starts = list()
+    head = ref_resolve(repo, "HEAD")
+    if head:
+        starts.append(head)
+    for sha in ref_flatten(ref_list(repo)).values():
+        if sha and object_info(repo, sha)[0] == b'commit':
+            starts.append(sha)
+
+    # iterative depth first traversal emitting a commit after all of it's parents (post order)
+    records = list()
+    generation = dict()
+    for start in starts:
+        stack = [(start, False)]
+        while stack:
+            sha, expanded = stack.pop()
+            if sha in generation:
+                continue
+            commit = object_read(repo, sha)
+            parents = commit_parents(commit)
+            if not expanded:
+                stack.append((sha, True))
+                stack.extend((p, False) for p in parents if p not in generation)
+                continue
+            generation[sha] = 1 + max([generation[p] for p in parents], default=0)
+            records.append((sha, commit.header(b'tree')[0].decode("ascii"), parents, generation[sha], commit_time(commit)))
+
+    commit_graph_save(repo, commit_graph_serialize(records))
+    return len(records)
+
+
+def commit_graph_add(repo, sha):
+    """Adds the commit represented by sha to the commit graph without walking the history again: the records and
+    extra edges of the graph are copied as they are, the new record is appended after them and the hash is
+    inserted in the sorted tables. A repository without commit graph only gets one when sha is a root commit,
+    otherwise the graph is written by vcs commit-graph write"""
+    commit = object_read(repo, sha)
+    parents = commit_parents(commit)
+    tree = commit.header(b'tree')[0].decode("ascii")
+    graph = repo_commit_graph(repo)
+
+    if graph is None:
+        if not parents:
+            commit_graph_save(repo, commit_graph_serialize([(sha, tree, [], 1, commit_time(commit))]))
+        return
+    if graph.find(sha) is not None:
+        return
+    positions = [graph.find(p) for p in parents]
+    if None in positions:
+        # the history of the commit isn't in the graph, so the graph is written from scratch
+        commit_graph_write(repo)
+        return
+
+    data = graph.data
+    edges = bytearray(data[graph.edgeTable:graph.edgeTable + 4 * graph.edgeCount])
+    p1 = positions[0] if positions else COMMIT_GRAPH_NO_PARENT
+    if len(positions) <= 2:
+        p2 = positions[1] if len(positions) == 2 else COMMIT_GRAPH_NO_PARENT
+    else:
+        p2 = COMMIT_GRAPH_EXTRA_EDGES | graph.edgeCount
+        for i, p in enumerate(positions[1:]):
+            edges += struct.pack(">I", p | (COMMIT_GRAPH_LAST_EDGE if i == len(positions) - 2 else 0))
+    generation = 1 + max([graph.generation(p) for p in positions], default=0)
+    binsha = bytes.fromhex(sha)
+    record = COMMIT_GRAPH_RECORD.pack(binsha, bytes.fromhex(tree), p1, p2, generation, commit_time(commit))
+
+    # insertion point of the new hash in the sorted hash table
+    lo = graph.fanout(binsha[0] - 1)
+    hi = graph.fanout(binsha[0])
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if data[graph.shaTable + 20 * mid:graph.shaTable + 20 * mid + 20] < binsha:
+            lo = mid + 1
+        else:
+            hi = mid
+
+    res = bytearray(COMMIT_GRAPH_HEADER.pack(COMMIT_GRAPH_SIGNATURE, COMMIT_GRAPH_VERSION, graph.count + 1, len(edges) // 4))
+    for byte in range(256):
+        res += struct.pack(">I", graph.fanout(byte) + (1 if byte >= binsha[0] else 0))
+    res += data[graph.shaTable:graph.shaTable + 20 * lo] + binsha + data[graph.shaTable + 20 * lo:graph.posTable]
+    res += data[graph.posTable:graph.posTable + 4 * lo] + struct.pack(">I", graph.count) + data[graph.posTable + 4 * lo:graph.recordTable]
+    res += data[graph.recordTable:graph.edgeTable] + record
+    res += edges
+    res += hashlib.sha1(res).digest()
+    commit_graph_save(repo, res)
+
+
+def commit_info(repo, sha):
+    """Returns the (parent hashes, generation number, commit time) of a commit, taken from the commit graph
+    when the commit is in it. Generation number is None for a commit which isn't in the graph"""
+    graph = repo_commit_graph(repo)
+    if graph is not None:
+        pos = graph.find(sha)
+        if pos is not None:
+            return [graph.sha(p) for p in graph.parents(pos)], graph.generation(pos), graph.time(pos)
+    commit = object_read(repo, sha)
+    if commit.fmt != b'commit':
+        raise Exception("Object {0} is not a commit".format(sha))
+    return commit_parents(commit), None, commit_time(commit)
+
+
+def commit_is_ancestor(repo, ancestor, sha):
+    """Checks if the commit ancestor is reachable from the commit sha. With a commit graph, the walk
+    never goes below the generation number of ancestor"""
+    _, target, _ = commit_info(repo, ancestor)
+    seen = set()
+    stack = [sha]
+    while stack:
+        cur = stack.pop()
+        if cur == ancestor:
+            return True
+        if cur in seen:
+            continue
+        seen.add(cur)
+        parents, generation, _ = commit_info(repo, cur)
+        if target is not None and generation is not None and generation <= target:
+            continue
+        stack.extend(parents)
+    return False
+
+
+
 
 # command line argument parsing
 argparser = argparse.ArgumentParser()
+argparser.add_argument("--trace", action="store_true", help="print counters and timings of the command on stderr (also set by VCS_TRACE=1)")
+argparser.add_argument("--trace-json", dest="traceJson", metavar="FILE", default=None, help="write the timings of the command to FILE as a Chrome trace (also set by VCS_TRACE=FILE.json)")
 argsubparsers = argparser.add_subparsers(title="Commands", dest="command")
 argsubparsers.required = True
 
@@ -413,30 +2983,120 @@ argsp.add_argument("path",
 
 # subparser for vcs cat-file command and associated arguments
 """command format:  vcs cat-file TYPE OBJECT"""
+"""                 vcs cat-file (-t | -s) OBJECT"""
+"""                 vcs cat-file (--batch | --batch-check)"""
 """Reads a object from repository and deserializes it to create a object of class which supports TYPE"""
+"""-t and -s print the type and the size of the object, which only requires reading the header of the object"""
+"""--batch and --batch-check read object names from the standard input, one per line, and print the hash, type and
+size of every object, followed by it's content with --batch"""
+
+CAT_FILE_TYPES = ["blob", "chunked", "commit", "tag", "tree"]
 
 argsp = argsubparsers.add_parser("cat-file", help="Provide content of repository object")
+# the type is checked by cmd_cat_file: with -t, -s or the batch modes, the only positional argument is the object
 argsp.add_argument("type",
                    metavar='type',
-                   choices=["blob", "commit", "tag", "tree"],
-                   help="Specify the type")
+                   nargs="?",
+                   help="Specify the type ({0})".format(", ".join(CAT_FILE_TYPES)))
+
+argsp.add_argument("-t",
+                   dest="showType",
+                   action="store_true",
+                   help="Print the type of the object")
+
+argsp.add_argument("-s",
+                   dest="showSize",
+                   action="store_true",
+                   help="Print the size of the object")
+
+argsp.add_argument("--batch",
+                   dest="batch",
+                   action="store_true",
+                   help="Print the hash, type, size and content of the objects named on the standard input")
+
+argsp.add_argument("--batch-check",
+                   dest="batchCheck",
+                   action="store_true",
+                   help="Print the hash, type and size of the objects named on the standard input")
 
 argsp.add_argument("object",
                    metavar="object",
+                   nargs="?",
                    help="The object to display")
 
 def cat_file(repo, obj, fmt=None):
-    obj = object_read(repo, object_find(repo, obj, fmt=fmt))
+    sha = object_find(repo, obj, fmt=fmt)
+    if fmt == b'blob':
+        # blobs, chunked or not, are streamed
+        _, _, chunks = object_stream(repo, sha)
+        for chunk in chunks:
+            sys.stdout.buffer.write(chunk)
+        return
+    obj = object_read(repo, sha)
     if (fmt == b'commit'):
         sys.stdout.buffer.write(obj.serialize(obj.commitData))
     else:
         sys.stdout.buffer.write(obj.serialize())
 
 
+def cat_file_info(repo, sha):
+    """Returns the type and the size of the object sha, a chunked blob being shown as the blob it stands for"""
+    fmt, size = object_info(repo, sha)
+    if fmt == b'chunked':
+        fmt, size = b'blob', object_read(repo, sha).size()
+    return fmt, size
+
+
+def line_blocks(fd):
+    """Generator over the lines read from the file descriptor fd, given as a list of the complete lines of every block
+    read (without the newlines). The last line is given even if it doesn't end with a newline. A block holds the lines
+    available when it was read, so a command answering a block at once answers a program waiting for it's answer"""
+    pending = b''
+    while True:
+        data = os.read(fd, STREAM_CHUNK_SIZE)
+        if not data:
+            if pending:
+                yield [pending]
+            return
+        lines = (pending + data).split(b'\n')
+        pending = lines.pop()
+        yield lines
+
+
+def cat_file_batch(repo, contents=True, fd=0, out=None):
+    """Reads object names from the file descriptor fd, one per line, and writes "<sha> <type> <size>" for each of them,
+    followed by the content of the object and a newline if contents is True. Names which don't name an object are
+    written back followed by "missing". Only the header of the objects is read when contents is False.
+    The output is flushed once every name read so far is answered, so a program can write a name and wait for
+    the answer, while the names piped by a program are answered in large writes"""
+    out = out or sys.stdout.buffer
+    for lines in line_blocks(fd):
+        for line in lines:
+            name = line.strip().decode()
+            if not name:
+                continue
+            try:
+                # a full hash doesn't need to be looked up in the references
+                sha = name.lower() if re.match(r'^[0-9a-fA-F]{40}$', name) else object_find(repo, name)
+                fmt, size = cat_file_info(repo, sha)
+            except Exception:
+                out.write(name.encode() + b' missing\n')
+                continue
+            out.write(sha.encode() + b' ' + fmt + b' ' + str(size).encode() + b'\n')
+            if contents:
+                _, _, chunks = object_stream(repo, sha)
+                for chunk in chunks:
+                    out.write(chunk)
+                out.write(b'\n')
+        out.flush()
+
+
 # subparsers for hash-object command and defining associated arguments
-""" command format: vcs hash-object [-w] [-t TYPE] FILE"""
+""" command format: vcs hash-object [-w] [-t TYPE] [--stdin] [FILE]"""
+"""                 vcs hash-object [-w] [-t TYPE] [-j N] --stdin-paths"""
 """Reads a FILE and computes the hash of the content of the FILE.
 Also, form the object of the corresponding FILE and serialize and store it in repository"""
+"""--stdin hashes the standard input, --stdin-paths the files whose paths are read from the standard input"""
 
 argsp = argsubparsers.add_parser("hash-object",
                                  help="Computes object ID and optionally creates a blob from a file")
@@ -451,12 +3111,30 @@ argsp.add_argument("-w",
                    dest="write",
                    action="store_true",
                    help="Actually write the object to memory disk, database etc")
+argsp.add_argument("--stdin",
+                   dest="stdin",
+                   action="store_true",
+                   help="Hash the content read from the standard input")
+argsp.add_argument("--stdin-paths",
+                   dest="stdinPaths",
+                   action="store_true",
+                   help="Hash the files whose paths are read from the standard input, one per line")
+argsp.add_argument("-j", dest="jobs", type=int, default=None, help="number of threads hashing files with --stdin-paths (default: core.workers or the number of CPUs)")
 argsp.add_argument("path",
+                   nargs="?",
                    help="Path to the <FILE>")
 
-def object_hash(fd, fmt, repo=None):
+def object_hash(fd, fmt, repo=None, actually_write=True):
     """ Function to read the content of a open file, create appropiate object
-        and write the object to vcs directory and return the hash of the file"""
+        and write the object to vcs directory and return the hash of the file.
+        Nothing is written if repo is None or actually_write is False"""
+    actually_write = actually_write and repo is not None
+
+    if fmt == b'blob' and fd.seekable():
+        # blobs don't need to be parsed, so they are hashed and written without reading the whole file in memory.
+        # The size of a pipe isn't known before it's read, so it's content is read at once
+        size = os.fstat(fd.fileno()).st_size - fd.tell()
+        return object_write_stream(repo, fd, size, fmt, actually_write=actually_write)
 
     data = fd.read()
 
@@ -468,11 +3146,52 @@ def object_hash(fd, fmt, repo=None):
     else:
         raise Exception('Unknown type %s!' % fmt)
 
-    return object_write(obj, repo)
+    return object_write(obj, actually_write)
+
+
+# number of files being hashed at once for each worker by hash-object --stdin-paths
+HASH_PATHS_WINDOW = 64
+
+def object_hash_path(repo, path, fmt, actually_write=True):
+    """Hashes the file path as an object of type fmt, see object_hash"""
+    with open(path, "rb") as f:
+        return object_hash(f, fmt, repo, actually_write)
+
+
+def object_hash_paths(repo, fmt, actually_write=True, workers=1, fd=0, out=None):
+    """Hashes the files whose paths are read from the file descriptor fd, one per line, on a pool of workers threads
+    and writes their hashes to out in the order of the paths. At most HASH_PATHS_WINDOW files per worker are
+    in flight, so any number of paths is handled in bounded memory. The output is flushed once the files read so
+    far are hashed, after the objects of a bulk checkin are made durable"""
+    out = out or sys.stdout.buffer
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+    window = collections.deque()
+    try:
+        for lines in line_blocks(fd):
+            for line in lines:
+                if not line:
+                    continue
+                path = os.fsdecode(line)
+                if pool is None:
+                    out.write(object_hash_path(repo, path, fmt, actually_write).encode() + b'\n')
+                    continue
+                window.append(pool.submit(object_hash_path, repo, path, fmt, actually_write))
+                if len(window) >= workers * HASH_PATHS_WINDOW:
+                    out.write(window.popleft().result().encode() + b'\n')
+            while window:
+                out.write(window.popleft().result().encode() + b'\n')
+            if repo is not None and repo.bulkCheckin is not None:
+                repo.bulkCheckin.flush()
+            out.flush()
+    finally:
+        if pool is not None:
+            for future in window:
+                future.cancel()
+            pool.shutdown()
 
 
 # subparser for vcs log command
-"""command format: vcs log [commit] [-d]"""
+"""command format: vcs log [commit] [-d] [-n N] [--skip N] [--since DATE] [--until DATE] [--oneline]"""
 """ This command print the commit history starting from the commit passed as argument"""
 """d (dot) flag when passed prints the log in format suitable for graphivz"""
 argsp = argsubparsers.add_parser("log",
@@ -487,61 +3206,196 @@ argsp.add_argument("-d",
                    action="store_true",
                    help="log will be printed in format suitable for graphviz")
 
-def logGraph(repo, sha, seen):
-    """ Function to print the log of commits by traversing the graph"""
-    # seen is a set which stores all the commits which are already visited, thus preventing any circular loop situation in
-    # graph travers al.
-    if sha in seen:
-        return
-    seen.add(sha)
+argsp.add_argument("-n", "--max-count",
+                   dest="maxCount",
+                   type=int,
+                   default=None,
+                   help="show at most this number of commits")
 
-    commit = object_read(repo, sha)
-    # assertion to check, if the object desrialized is a commit object
-    assert(commit.fmt == b'commit')
+argsp.add_argument("--skip",
+                   type=int,
+                   default=0,
+                   help="skip this number of commits before showing any")
 
-    if not b'parent' in commit.commitData.keys():
-        # the first commit
-        return
-    
-    parents = commit.commitData[b'parent']
+argsp.add_argument("--since",
+                   default=None,
+                   help="show commits more recent than a date (unix time or YYYY-MM-DD[ HH:MM:SS])")
 
-    if type(parents) != list:
-        parents = [parents]
-    
-    for p in parents:
-        # as data is kept in objects in byte string format
-        p = p.decode('ascii')
-        print("c_{0} -> c_{1}".format(sha, p))
-        logGraph(repo, p, seen)
+argsp.add_argument("--until",
+                   default=None,
+                   help="show commits older than a date (unix time or YYYY-MM-DD[ HH:MM:SS])")
 
+argsp.add_argument("--oneline",
+                   action="store_true",
+                   help="show every commit on a single line")
+
+# number of commits walked between two prunings of the commits remembered by rev_walk
+REV_WALK_PRUNE_INTERVAL = 1024
+
+def rev_walk(repo, starts, since=None, until=None):
+    """Generator over the commits reachable from the commits starts, newest first, as (sha, parent hashes, commit time).
+    The walk is iterative and uses a priority queue ordered by commit time (and generation number for commits made
+    in the same second). Commits older than since end the walk and commits newer than until are not yielded.
+    With a commit graph, commits already walked are forgotten as soon as no commit left to walk can lead to them
+    again, so memory depends on the width of the history and not on it's length"""
+    heap = list()
+    queued = set()
+    done = dict() # walked commit --> generation number
+    counter = itertools.count()
+
+    def push(sha):
+        if sha in queued or sha in done:
+            return
+        parents, generation, ctime = commit_info(repo, sha)
+        heapq.heappush(heap, (-ctime, -(generation or 0), next(counter), sha, parents, generation))
+        queued.add(sha)
+
+    for sha in starts:
+        push(sha)
+
+    walked = 0
+    while heap:
+        negtime, _, _, sha, parents, generation = heapq.heappop(heap)
+        queued.discard(sha)
+        done[sha] = generation
+        if since is not None and -negtime < since:
+            return
+        if until is None or -negtime <= until:
+            yield sha, parents, -negtime
+        for p in parents:
+            push(p)
+
+        walked += 1
+        if walked % REV_WALK_PRUNE_INTERVAL == 0 and heap and all(e[5] is not None for e in heap):
+            # a commit can only be reached again from a commit of bigger generation number
+            top = max(e[5] for e in heap)
+            for k in [k for k, g in done.items() if g is not None and g >= top]:
+                del done[k]
+
+
+def parse_date(text):
+    """Converts a date given on the command line (unix time or ISO 8601 date) into a unix timestamp"""
+    if text.isdigit():
+        return int(text)
+    try:
+        return int(datetime.datetime.fromisoformat(text).timestamp())
+    except ValueError:
+        raise Exception("Invalid date {0}".format(text))
+
+
+def logGraph(repo, commits, out):
+    """ Function to write the log of commits yielded by rev_walk as the edges of a graphviz graph"""
+    for sha, parents, _ in commits:
+        for p in parents:
+            out.write("c_{0} -> c_{1}\n".format(sha, p).encode())
+
+
+def commitLog(repo, commits, out, head=None, oneline=False):
+    """Function to pretty print the log of commits yielded by rev_walk. The commit head is marked as HEAD"""
+    for sha, _, ctime in commits:
+        commit = object_read(repo, sha)
+        # assertion to check, if the object deserialized is a commit object
+        assert(commit.fmt == b'commit')
+        message = commit.message()
+
+        if oneline:
+            out.write(sha.encode() + b' ' + message.split(b'\n', 1)[0] + b'\n')
+            continue
+        out.write("\n\ncommit id: {0}{1}\n".format(sha, " (HEAD)" if sha == head else "").encode())
+        if ctime:
+            out.write("commit date: {0}\n".format(time.strftime("%a %b %d %H:%M:%S %Y %z", time.localtime(ctime))).encode())
+        out.write(b'commit message: ' + message + b'\n')
 
-def commitLog(repo, sha, seen):
-    """Function to pretty print the log of commits in the terminal"""
-    if sha in seen.keys():
-        return
-    seen[sha] = object_read(repo, sha)
 
-    # assertion to check, if the object deserialized is a commit object
-    assert(seen[sha].fmt == b'commit')
 
-    print("\n")
-    print("commit id: {0}{1}".format(sha, " (HEAD)" if (len(seen.keys()) == 1) else ""))
-    print("commit message: {0}".format(seen[sha].commitData[b''].decode('ascii')))
 
-    if not b'parent' in seen[sha].commitData.keys():
-        return
+# subparser for diff-tree command
+"""command format: vcs diff-tree [-r] [object] [object]"""
+"""Compares two trees (or the trees of two commits) and prints the entries which were added, deleted or modified"""
+argsp = argsubparsers.add_parser("diff-tree", help="Compare the trees of two commits")
+argsp.add_argument("-r", dest="recursive", action="store_true", help="compare the content of the sub directories too")
+argsp.add_argument("old", help="The old commit or tree")
+argsp.add_argument("new", help="The new commit or tree")
 
-    parents = seen[sha].commitData[b'parent']
+# status letters of the changes yielded by tree_diff
+DIFF_ADDED = "A"
+DIFF_DELETED = "D"
+DIFF_MODIFIED = "M"
+
+class vcsTreeChange(object):
+    """A single change between two trees. Mode and sha of the side where the entry is absent are None"""
+    def __init__(self, status, path, oldMode, newMode, oldSha, newSha):
+        self.status = status
+        self.path = path
+        self.oldMode = oldMode
+        self.newMode = newMode
+        self.oldSha = oldSha
+        self.newSha = newSha
 
-    if type(parents) != list:
-        parents = [parents]
-    
-    for p in parents:
-        p = p.decode('ascii')
-        commitLog(repo, p, seen)
 
+def _tree_entries(repo, sha):
+    """Returns the entries of tree sha as a list of (name, mode, sha) sorted by name"""
+    if sha is None:
+        return []
+    return sorted((os.path.basename(item.path), item.mode, item.sha) for item in object_read(repo, sha).items)
 
 
+def _is_tree_mode(mode):
+    return mode is not None and stat.S_ISDIR(int(mode))
+
+
+def tree_diff(repo, old, new, recursive=True, prefix=b''):
+    """Generator over the vcsTreeChange between the trees old and new (hashes, None for an empty tree).
+    Both trees are walked in lockstep by entry name and a sub directory whose tree has the same hash on both sides
+    is skipped without being read, so the cost depends on the size of the change and not on the size of the trees.
+    With recursive, changes inside sub directories are reported file by file, otherwise a changed sub directory is
+    reported as a single entry. Paths are relative to the trees, as byte strings"""
+    if old == new:
+        return
+    oldEntries = _tree_entries(repo, old)
+    newEntries = _tree_entries(repo, new)
+    i = j = 0
+    while i < len(oldEntries) or j < len(newEntries):
+        if j >= len(newEntries) or (i < len(oldEntries) and oldEntries[i][0] < newEntries[j][0]):
+            name, oldMode, oldSha = oldEntries[i]
+            newMode = newSha = None
+            i += 1
+        elif i >= len(oldEntries) or newEntries[j][0] < oldEntries[i][0]:
+            name, newMode, newSha = newEntries[j]
+            oldMode = oldSha = None
+            j += 1
+        else:
+            name, oldMode, oldSha = oldEntries[i]
+            _, newMode, newSha = newEntries[j]
+            i += 1
+            j += 1
+
+        path = prefix + name
+        oldTree = _is_tree_mode(oldMode)
+        newTree = _is_tree_mode(newMode)
+        if oldTree and newTree and oldSha == newSha:
+            # identical sub directory, the mode of a directory isn't part of the snapshot
+            continue
+        if not oldTree and not newTree and oldSha == newSha and oldMode == newMode:
+            continue
+
+        if recursive and (oldTree or newTree):
+            # a file replaced by a directory (or the opposite) is reported as a deletion and an addition
+            if oldSha is not None and not oldTree:
+                yield vcsTreeChange(DIFF_DELETED, path, oldMode, None, oldSha, None)
+            yield from tree_diff(repo, oldSha if oldTree else None, newSha if newTree else None, recursive, path + b'/')
+            if newSha is not None and not newTree:
+                yield vcsTreeChange(DIFF_ADDED, path, None, newMode, None, newSha)
+        elif oldSha is None:
+            yield vcsTreeChange(DIFF_ADDED, path, None, newMode, None, newSha)
+        elif newSha is None:
+            yield vcsTreeChange(DIFF_DELETED, path, oldMode, None, oldSha, None)
+        elif oldTree != newTree:
+            yield vcsTreeChange(DIFF_DELETED, path, oldMode, None, oldSha, None)
+            yield vcsTreeChange(DIFF_ADDED, path, None, newMode, None, newSha)
+        else:
+            yield vcsTreeChange(DIFF_MODIFIED, path, oldMode, newMode, oldSha, newSha)
+
 
 # subparser for ls-tree command
 """command format: vcs ls-tree [object]"""
@@ -556,23 +3410,105 @@ argsp.add_argument("object", help="The tree object hash value")
 argsp = argsubparsers.add_parser("checkout", help="Checkout a commit inside of a empty directory")
 argsp.add_argument("commit", help="The commit or tree associated with commit to be checked out")
 argsp.add_argument("path", help="The empty directory where the tree will be instantiated")
+argsp.add_argument("-j", dest="jobs", type=int, default=None, help="number of threads writing files (default: core.workers or the number of CPUs)")
+
+# upper bound of the blob content held in memory at once by the checkout workers
+CHECKOUT_MEMORY_LIMIT = 64 * 1024 * 1024
+
+class vcsByteBudget(object):
+    """Counter of bytes shared by threads, used to bound the memory held by the objects being processed"""
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, n):
+        """Waits until n bytes fit in the budget and takes them. Returns the number of bytes taken,
+        which never exceeds the limit so that a single object bigger than the limit can still be processed"""
+        n = min(n, self.limit)
+        with self.cond:
+            while self.used and self.used + n > self.limit:
+                self.cond.wait()
+            self.used += n
+        return n
+
+    def release(self, n):
+        with self.cond:
+            self.used -= n
+            self.cond.notify_all()
+
+
+def checkout_plan(repo, tree, path):
+    """Walks the trees (but not the blobs) of tree and returns (directories, files), where directories is a list of
+    (destination, mode) in creation order and files is a list of (destination, blob sha, mode) to instantiate under path"""
+    dirs = list()
+    files = list()
+    stack = [(tree, path)]
+    while stack:
+        tree, dest = stack.pop()
+        for item in tree.items:
+            # trees hold the path of the entries in the worktree they were created from, only the name is used
+            target = os.path.join(dest, os.fsdecode(os.path.basename(item.path)))
+            mode = int(item.mode)
+            if stat.S_ISDIR(mode):
+                dirs.append((target, mode))
+                stack.append((object_read(repo, item.sha), target))
+            else:
+                files.append((target, item.sha, mode))
+    return dirs, files
+
+
+def checkout_blob(repo, sha, dest, mode, budget):
+    """Writes the content of blob sha to the file dest and restores it's mode. Returns the number of bytes written"""
+    fmt, size, chunks = object_stream(repo, sha)
+    if fmt != b'blob':
+        raise Exception("Object {0} is not a blob".format(sha))
+    n = budget.acquire(size)
+    try:
+        with open(dest, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+    finally:
+        budget.release(n)
+    if stat.S_ISREG(mode):
+        os.chmod(dest, stat.S_IMODE(mode))
+    return size
+
+
+def tree_checkout(repo, tree, path, workers=1, plan=None):
+    """Instantiates a tree during checkout into a empty directory. All the directories are created first,
+    then the blobs are decompressed and written on workers threads with bounded memory. plan is the result of
+    checkout_plan when the caller already has it. Returns the number of files and bytes written"""
+    if type(path) == bytes:
+        path = path.decode()
+    dirs, files = plan if plan is not None else checkout_plan(repo, tree, path)
+
+    for dest, mode in dirs:
+        os.mkdir(dest)
+
+    budget = vcsByteBudget(CHECKOUT_MEMORY_LIMIT)
+    task = lambda f: checkout_blob(repo, f[1], f[0], f[2], budget)
+    if workers <= 1:
+        sizes = [task(f) for f in files]
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            sizes = list(pool.map(task, files))
+
+    # modes of the directories are restored last, so that a read only directory doesn't prevent writing it's files
+    for dest, mode in reversed(dirs):
+        os.chmod(dest, stat.S_IMODE(mode))
+    return len(files), sum(sizes)
+
 
-def tree_checkout(repo, tree, path):
-    """Recursively instantiates a tree during checkout into a empty directory"""
-    for item in tree.items:
-        obj = object_read(repo, item.sha)
-        rootPath = os.path.realpath(os.path.join(repo.vcsdir, '../'))
-        relativePath = item.path.decode().replace(rootPath, '')
-        destRootPath = path
-        dest = destRootPath + relativePath.encode()
-
-        if obj.fmt == b'tree':
-            os.mkdir(dest)
-            # recursively call if the object is tree
-            tree_checkout(repo, obj, destRootPath)
-        elif obj.fmt == b'blob':
-            with open(dest, 'wb') as f:
-                f.write(obj.blobdata)
+def index_checkout(repo, files):
+    """Returns the index of the files just written in the worktree of repo by tree_checkout, files being the
+    (destination, blob sha, mode) of checkout_plan. The hashes come from the trees and the stat data from the
+    files, so none of them is read again"""
+    index = vcsIndex()
+    for dest, sha, _ in files:
+        name = os.path.relpath(dest, repo.worktree).replace(os.sep, "/")
+        index.entries[name] = vcsIndexEntry.from_stat(name, os.stat(dest), sha)
+    return index
 
 # subparser for commit command
 """command format: vcs commit [message] [-a]"""
@@ -581,57 +3517,23 @@ argsp = argsubparsers.add_parser("commit", help="Commit the current state of the
 argsp.add_argument("message", help="mention the commit message")
 argsp.add_argument("-a", action="store_true", help="flag to indicate current user is only author of commit not commiter")
 argsp.add_argument("-v", dest="verbose", action="store_true", help="flag to initate verbose mode during commit")
+argsp.add_argument("-j", dest="jobs", type=int, default=None, help="number of threads hashing files (default: core.workers or the number of CPUs)")
 
-def createTree(path=None, actually_write=True, verbose=False):
-    """Creates a tree object of the whole repo"""
-    blackList = ['libvcs.py', 'vcs', '__pycache__', '.vcs']
+def createTree(actually_write=True, verbose=False, workers=1):
+    """Creates a tree object of the whole repo. The worktree is enumerated first, the files are then
+    hashed and compressed on workers threads and the trees are assembled bottom-up from the result,
+    so the hash is the same whatever the number of workers"""
     repo = repo_find()
-    if (path == None):
-        path = repo.worktree
-    content = os.listdir(path)
-    treeContent = list()
-    for files in content:
-        dest = os.path.join(path, files)
-        if os.path.isfile(dest):
-            if files not in blackList:      
-                with open(dest, "rb") as f:
-                    data = f.read()
-                blobObj = vcsBlob(repo, data)
-                sha = object_write(blobObj, actually_write)
-                mode = str(os.stat(dest).st_mode).encode()
-                leafObj = vcsTreeLeaf(mode, dest.encode(), sha)
-                treeContent.append(leafObj)
-                if verbose:
-                    print("Added {0} to current commit".format(dest))
-                    print("sha of {0} ----> {1}\n".format(dest, sha))
-        else:
-            # when the given files is a directory
-            if files not in blackList:
-                leafObj = createTree(dest)
-                treeContent.append(leafObj)
-    
-    treeObj = vcsTree(repo)
-    treeObj.items = treeContent
-    sha = object_write(treeObj, actually_write)
-    if path == repo.worktree:
-        return sha
-    else:
-        mode = str(os.stat(path).st_mode).encode()
-        leafObj = vcsTreeLeaf(mode, path.encode(), sha)
-        return leafObj
+    index = vcsIndex()
+    index_refresh(repo, index, actually_write, verbose, workers)
+    return index_write_tree(repo, index, actually_write)
 
 
 def getObjectFormat(repo, sha):
     """Returns the object format of the object represented by hash"""
     """NOTE: hash has to be a full sha"""
-    path = repo_file(repo, "objects", sha[0:2], sha[2:])
-    with open(path, "rb") as f:
-        raw = zlib.decompress(f.read())
-
-        # computing the starting position of the whitespace in header of the object file
-        x = raw.find(b' ')
-        fmt = raw[0:x].decode("ascii") # the type of object in ascii string
-    return fmt
+    fmt, _ = object_info(repo, sha)
+    return fmt.decode("ascii")
 
 
 
@@ -683,6 +3585,8 @@ argsp = argsubparsers.add_parser("show-ref", help="List references")
 
 def ref_resolve(repo, ref):
     """Recursively finds the sha-1 of objects referenced by a ref"""
+    if TRACE:
+        TRACE.count("ref_resolve")
     if not os.path.exists(os.path.realpath(os.path.join(repo.vcsdir, ref, '..'))):
         raise Exception("Directory missing: {0}".format(os.path.realpath(os.path.join(repo.vcsdir, ref, '..'))))
     if not os.path.isfile(repo_file(repo, ref)):
@@ -721,6 +3625,18 @@ def show_ref(repo, refs, with_hash=True, prefix=""):
             show_ref(repo, v, with_hash = with_hash, prefix="{0}{1}{2}".format(prefix, "/" if prefix else "", k))
 
 
+def ref_flatten(refs, prefix="refs"):
+    """Flattens the nested dictionary returned by ref_list into a dictionary of full reference name --> sha"""
+    ret = collections.OrderedDict()
+    for k, v in refs.items():
+        name = prefix + "/" + k
+        if type(v) == str:
+            ret[name] = v
+        else:
+            ret.update(ref_flatten(v, name))
+    return ret
+
+
 def update_master(repo, sha):
     with open(repo_file(repo, 'HEAD'), 'r') as fp:
         data = fp.read()[:-1] # rejects the '\n' at the end of the string
@@ -736,36 +3652,789 @@ argsp = argsubparsers.add_parser("set", help="set values of variables in config
 argsp.add_argument("--name", default="", help="set the name of the user")
 argsp.add_argument("--email", default="", help="set the email id of the user")
 
+# subparser for vcs add command
+"""command format: vcs add PATH..."""
+"""Hashes the files under the paths ahead of the next commit, writes their blobs and records them in the index.
+Nothing is staged: commit always snapshots the whole worktree"""
+argsp = argsubparsers.add_parser("add", help="Hash files ahead of the next commit")
+argsp.add_argument("path", nargs="+", help="Files or directories to add")
+
+# subparser for vcs rm command
+"""command format: vcs rm PATH..."""
+"""Deletes the files under the paths from the worktree and the index"""
+argsp = argsubparsers.add_parser("rm", help="Delete files from the working tree and from the index")
+argsp.add_argument("path", nargs="+", help="Files or directories to remove")
+
+# subparser for vcs status command
+"""command format: vcs status [-s] [-j N]"""
+"""Shows the files added, modified or deleted in the worktree since the last commit"""
+argsp = argsubparsers.add_parser("status", help="Show the changes of the working directory since the last commit")
+argsp.add_argument("-s", dest="short", action="store_true", help="print one line per file with a status letter")
+argsp.add_argument("-j", dest="jobs", type=int, default=None, help="number of threads hashing files (default: core.workers or the number of CPUs)")
+
+# subparser for vcs watch command
+"""command format: vcs watch [-d | --stop]"""
+"""Watches the worktree with inotify, so that status and commit only look at the files which changed"""
+argsp = argsubparsers.add_parser("watch", help="Watch the working directory for changes")
+argsp.add_argument("-d", dest="daemon", action="store_true", help="run the watcher in the background")
+argsp.add_argument("--stop", action="store_true", help="stop the running watcher")
+
+# subparser for vcs server command
+"""command format: vcs server [-d | --stop]"""
+"""Serves the commands reading the repository from a long running process, which keeps the repository warm"""
+argsp = argsubparsers.add_parser("server", help="Run the command server of the repository")
+argsp.add_argument("-d", dest="daemon", action="store_true", help="run the server in the background")
+argsp.add_argument("--stop", action="store_true", help="stop the running server")
+
+# command server
+# vcs server listens on the unix socket .vcs/server.sock. The vcs launcher sends the commands which only read the
+# repository (see src/vcs) to it when it's running, instead of running them in a new python process: they don't pay for
+# importing libvcs, the repository and it's config are found once and the objects read by the previous commands are in
+# the object cache. Requests are served one at a time. The client sends one json line holding the arguments, the working
+# directory and the VCS_* environment variables, the server answers with frames made of a channel (SERVER_STDOUT,
+# SERVER_STDERR or SERVER_EXIT), the length of the payload and the payload. The exit frame holds the exit status.
+# The server refuses the commands which aren't in SERVER_COMMANDS, the same list as the launcher's: a command writing
+# the repository would run with the state the server kept in memory.
+
+SERVER_SOCKET = "server.sock"
+SERVER_COMMANDS = ["cat-file", "diff-tree", "log", "ls-tree", "rev-parse", "show-ref"]
+SERVER_STDOUT = b'1'
+SERVER_STDERR = b'2'
+SERVER_EXIT = b'x'
+SERVER_FRAME = struct.Struct(">cI")
+
+
+class vcsServerWriter(io.RawIOBase):
+    """Raw stream sending what is written to it as frames of a channel on a connection"""
+    def __init__(self, conn, channel):
+        self.conn = conn
+        self.channel = channel
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.conn.sendall(SERVER_FRAME.pack(self.channel, len(data)) + bytes(data))
+        return len(data)
+
+
+def server_connect(repo):
+    """Returns a connection to the command server of repo, or None if it isn't running"""
+    path = repo_file(repo, SERVER_SOCKET)
+    if not os.path.exists(path):
+        return None
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(os.path.relpath(path))
+    except OSError:
+        conn.close()
+        return None
+    return conn
+
+
+def server_handle(conn, repo):
+    """Runs the command requested on conn with it's output sent back. Returns False if the server was asked to stop"""
+    with conn, conn.makefile("rb") as f:
+        request = json.loads(f.readline())
+        if request.get("stop"):
+            conn.sendall(SERVER_FRAME.pack(SERVER_EXIT, 1) + b'0')
+            return False
+
+        saved = sys.stdout, sys.stderr
+        sys.stdout = io.TextIOWrapper(io.BufferedWriter(vcsServerWriter(conn, SERVER_STDOUT)), encoding="utf-8")
+        sys.stderr = io.TextIOWrapper(vcsServerWriter(conn, SERVER_STDERR), encoding="utf-8", line_buffering=True)
+        for key in [key for key in os.environ if key.startswith("VCS_")]:
+            del os.environ[key]
+        os.environ.update(request.get("env", {}))
+        status = 0
+        try:
+            os.chdir(request["cwd"])
+            command = argparser.parse_args(request["argv"]).command
+            if command not in SERVER_COMMANDS:
+                sys.exit("vcs server doesn't run the {0} command, which writes the repository".format(command))
+            main(request["argv"])
+        except SystemExit as e:
+            if isinstance(e.code, str):
+                sys.stderr.write(e.code + "\n")
+            status = e.code if isinstance(e.code, int) else int(e.code is not None)
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            except OSError:
+                pass
+            sys.stdout, sys.stderr = saved
+            os.chdir(repo.worktree)
+        conn.sendall(SERVER_FRAME.pack(SERVER_EXIT, len(str(status))) + str(status).encode())
+    return True
+
+
+def server_listen(repo):
+    """Creates the socket of the command server of repo. A socket left by a server which died is replaced"""
+    path = repo_file(repo, SERVER_SOCKET)
+    conn = server_connect(repo)
+    if conn is not None:
+        conn.close()
+        raise Exception("A command server is already running for {0}".format(repo.worktree))
+    if os.path.exists(path):
+        os.remove(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # the path is given relative to .vcs, as the length of the path of a unix socket is limited
+    cwd = os.getcwd()
+    os.chdir(repo.vcsdir)
+    try:
+        sock.bind(SERVER_SOCKET)
+    finally:
+        os.chdir(cwd)
+    sock.listen(16)
+    return sock
+
+
+def server_run(repo, sock):
+    """Serves the requests sent to sock until the server is stopped"""
+    global REPO_REUSE
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    REPO_REUSE = {repo.worktree: repo}
+    repo_fresh(repo)
+    os.chdir(repo.worktree)
+    try:
+        while True:
+            conn, _ = sock.accept()
+            try:
+                if not server_handle(conn, repo):
+                    break
+            except (OSError, ValueError):
+                # the client went away or sent garbage
+                continue
+    finally:
+        REPO_REUSE = None
+        sock.close()
+        try:
+            os.remove(repo_file(repo, SERVER_SOCKET))
+        except FileNotFoundError:
+            pass
+
+
+# labels of the changes printed by vcs status
+STATUS_LABELS = {DIFF_ADDED: "new file:", DIFF_DELETED: "deleted:", DIFF_MODIFIED: "modified:"}
+
+def worktree_path(repo, path):
+    """Converts a path given on the command line to a path relative to the worktree ("" for the worktree itself)"""
+    rel = os.path.relpath(os.path.realpath(path), repo.worktree)
+    if rel == os.curdir:
+        return ""
+    if rel == os.pardir or rel.startswith(os.pardir + os.sep):
+        raise Exception("{0} is outside repository at {1}".format(path, repo.worktree))
+    if set(rel.split(os.sep)) & set(WORKTREE_BLACKLIST):
+        raise Exception("{0} can't be part of the repository".format(path))
+    return rel.replace(os.sep, "/")
+
+
+def index_add(repo, index, paths, workers=1):
+    """Hashes and writes the files under paths (relative to the worktree) whose stat data changed and records them in index"""
+    stale = list()
+    for path in paths:
+        full = os.path.join(repo.worktree, path)
+        if os.path.isdir(full):
+            files = worktree_files(repo, path)
+        elif os.path.isfile(full):
+            files = [(path, os.stat(full))]
+        else:
+            raise Exception("Path {0} did not match any files".format(path))
+
+        for name, st in files:
+            entry = index.entries.get(name)
+            if entry and entry.matches(st) and not index.is_racy(entry):
+                continue
+            stale.append(name)
+
+    for entry in index_hash_files(repo, stale, workers=workers):
+        index.add(entry)
+
+
+def index_remove(repo, index, paths):
+    """Removes the files under paths (relative to the worktree) from the worktree and from index"""
+    for path in paths:
+        prefix = path + "/" if path else ""
+        names = [name for name in index.entries if name == path or name.startswith(prefix)]
+        if not names:
+            raise Exception("Path {0} did not match any files in the index".format(path))
+        for name in names:
+            full = os.path.join(repo.worktree, name)
+            if os.path.isfile(full):
+                os.remove(full)
+            index.remove(name)
+
+# subparser for vcs commit-graph command
+"""command format: vcs commit-graph write"""
+"""Writes the commit graph file holding the parents, commit time and generation number of every commit"""
+argsp = argsubparsers.add_parser("commit-graph", help="Write the commit graph file")
+argsp.add_argument("action", choices=["write"], help="write the commit graph of the commits reachable from the references")
+
+# subparser for vcs rev-parse command
+"""command format: vcs rev-parse [--short] [--abbrev N] NAME..."""
+"""Prints the hash of the objects named by full or short hashes, references and ~N, ^N suffixes"""
+argsp = argsubparsers.add_parser("rev-parse", help="Resolve object names to hashes")
+argsp.add_argument("--short", action="store_true", help="print the shortest unique abbreviation of the hashes")
+argsp.add_argument("--abbrev", type=int, default=SHORT_SHA_DEFAULT, metavar="N",
+                   help="minimum length of the abbreviations printed by --short")
+argsp.add_argument("name", nargs="+", help="The names to resolve")
+
+# subparser for vcs repack command
+"""command format: vcs repack [-a] [-d]"""
+"""Packs the loose objects of the repository into a single packfile with delta compression"""
+argsp = argsubparsers.add_parser("repack", help="Pack loose objects into a packfile")
+argsp.add_argument("-a", dest="all", action="store_true", help="also put the objects of the existing packs into the new pack")
+argsp.add_argument("-d", dest="delete", action="store_true", help="remove the loose objects and packs made redundant by the new pack")
+
+def repack(repo, allObjects=False, delete=False):
+    """Packs the loose objects (and the packed ones if allObjects is True) of repo into a new pack.
+    Returns the path of the new pack without extension or None if there was nothing to pack"""
+    loose = list(loose_objects(repo))
+    oldPacks = list(repo_packs(repo, reload=True)) if allObjects else list()
+    shas = set(loose)
+    for pack in oldPacks:
+        shas.update(pack.shas())
+    if not shas:
+        return None
+
+    path = pack_write(repo, sorted(shas))
+
+    if delete:
+        for sha in loose:
+            os.remove(repo_file(repo, "objects", sha[0:2], sha[2:]))
+            # remove the fanout directory once it is empty
+            d = repo_dir(repo, "objects", sha[0:2])
+            if not os.listdir(d):
+                os.rmdir(d)
+        for pack in oldPacks:
+            if pack.path != path:
+                pack.close()
+                os.remove(pack.path + ".pack")
+                os.remove(pack.path + ".idx")
+        repo.packs = None
+    return path
+
+# subparser for vcs gc command
+"""command format: vcs gc [--grace DAYS] [--quarantine] [-j N]"""
+"""Removes the loose objects which can't be reached from the references, HEAD or the index"""
+argsp = argsubparsers.add_parser("gc", help="Remove unreachable loose objects")
+argsp.add_argument("--grace", type=float, default=None, help="only remove objects older than this number of days (default: gc.graceDays or 14)")
+argsp.add_argument("--quarantine", action="store_true", help="move the unreachable objects to .vcs/quarantine instead of deleting them")
+argsp.add_argument("-j", dest="jobs", type=int, default=None, help="number of threads walking the objects (default: core.workers or the number of CPUs)")
+
+# default number of days during which an unreachable object is kept, as it may belong to a commit being written
+GC_GRACE_DAYS = 14
+
+def gc_roots(repo):
+    """Returns the hashes from which objects are reachable: the references, HEAD and the blobs and cached trees of the index"""
+    roots = list(ref_flatten(ref_list(repo)).values())
+    roots.append(ref_resolve(repo, "HEAD"))
+    index = index_read(repo)
+    roots.extend(entry.sha for entry in index.entries.values())
+    roots.extend(sha for sha, _, _ in index.trees.values())
+    return [sha for sha in roots if sha]
+
+
+def object_children(repo, sha):
+    """Returns the hashes of the objects referenced by the object sha: the tree and the parents of a commit,
+    the entries of a tree, the chunks of a chunked blob and the object of a tag"""
+    fmt, _ = object_info(repo, sha)
+    if fmt == b'commit':
+        obj = object_read(repo, sha)
+        return [obj.header(b'tree')[0].decode("ascii")] + commit_parents(obj)
+    if fmt == b'tree':
+        return [item.sha for item in object_read(repo, sha).items]
+    if fmt == b'chunked':
+        return [chunk for chunk, _ in object_read(repo, sha).chunks]
+    if fmt == b'tag':
+        _, data = object_read_raw(repo, sha)
+        return [data.decode("ascii") for data in keyValueMessageParser(data).get(b'object', [])]
+    return []
+
+
+def gc_mark(repo, roots, workers=1):
+    """Returns the set of hashes of the objects reachable from roots. The objects are walked breadth first and
+    the objects of every level are read on workers threads. A missing object stops the walk, since the objects it
+    references could otherwise be taken for unreachable ones"""
+    # packs are opened before the threads start
+    repo_packs(repo)
+    reachable = set(roots)
+    frontier = list(reachable)
+
+    def children(sha):
+        try:
+            return object_children(repo, sha)
+        except Exception as e:
+            raise Exception("Unable to read object {0}, nothing was removed: {1}".format(sha, e))
+
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        while frontier:
+            results = pool.map(children, frontier) if pool else map(children, frontier)
+            frontier = list()
+            for shas in results:
+                for sha in shas:
+                    if sha not in reachable:
+                        reachable.add(sha)
+                        frontier.append(sha)
+    finally:
+        if pool:
+            pool.shutdown()
+    return reachable
+
+
+def gc_sweep(repo, reachable, grace, quarantine=False):
+    """Removes (or moves to .vcs/quarantine if quarantine is True) the loose objects not in reachable which weren't
+    modified for grace seconds, along with stale temporary object files. Reachable loose objects which are also
+    present in a pack are removed as well. Returns a dictionary of counters"""
+    stats = collections.Counter()
+    limit = time.time() - grace
+    objectsDir = repo_dir(repo, "objects")
+    for d in sorted(os.listdir(objectsDir)):
+        full = os.path.join(objectsDir, d)
+        if d.startswith("tmp_obj_"):
+            # left by a write which was interrupted
+            st = os.stat(full)
+            if st.st_mtime < limit:
+                os.remove(full)
+                stats["temporary"] += 1
+                stats["temporaryBytes"] += st.st_size
+            continue
+        if len(d) != 2 or not os.path.isdir(full):
+            continue
+        for f in os.listdir(full):
+            if len(f) != 38:
+                continue
+            sha = d + f
+            path = os.path.join(full, f)
+            st = os.stat(path)
+            stats["loose"] += 1
+            if sha in reachable:
+                if pack_find(repo, sha) is None:
+                    continue
+                stats["packed"] += 1
+                stats["packedBytes"] += st.st_size
+                os.remove(path)
+                continue
+            if st.st_mtime >= limit:
+                stats["recent"] += 1
+                continue
+            stats["unreachable"] += 1
+            stats["unreachableBytes"] += st.st_size
+            if quarantine:
+                os.replace(path, os.path.join(repo_dir(repo, "quarantine", d, mkdir=True), f))
+            else:
+                os.remove(path)
+        # remove the fanout directory once it is empty
+        if not os.listdir(full):
+            os.rmdir(full)
+    return stats
+
+
+# transfer between repositories
+# clone, fetch and push copy the objects a repository lacks from another repository of the local file system.
+# The wanted objects are the new values of the references to update. From them, the sending side walks the commits,
+# trees and blobs, asking the receiving side for every object whether it has it: an object the receiver has isn't
+# walked any further, as the objects it references were written before it and are thus present too. Only the objects
+# which are new to the receiver are walked, so repositories which mostly agree exchange little.
+# The objects are sent as a single pack streamed into a temporary file of the receiver, which indexes it (checking
+# it's checksum and hashing every object) before moving it to it's pack directory. The references are then updated
+# in one transaction: every reference is locked and checked against the value it had when the transfer started
+# before any of them is changed.
+# remotes are recorded in the config as [remote "NAME"] sections holding the path of the repository (url).
+
+# subparser for vcs clone command
+"""command format: vcs clone SOURCE [DIRECTORY] [-j N]"""
+"""Copies the repository SOURCE, with it's branches and tags, into a new repository and checks out it's HEAD"""
+argsp = argsubparsers.add_parser("clone", help="Copy a repository into a new directory")
+argsp.add_argument("source", help="path of the repository to copy")
+argsp.add_argument("directory", nargs="?", default=None, help="where to create the new repository (default: the name of the directory of SOURCE)")
+argsp.add_argument("-j", dest="jobs", type=int, default=None, help="number of threads writing files (default: core.workers or the number of CPUs)")
+
+# subparser for vcs fetch command
+"""command format: vcs fetch [REMOTE]"""
+"""Copies the branches of REMOTE to refs/remotes/REMOTE, it's new tags and it's HEAD to FETCH_HEAD"""
+argsp = argsubparsers.add_parser("fetch", help="Download the objects and references of another repository")
+argsp.add_argument("remote", nargs="?", default="origin", help="name of a remote or path of a repository (default: origin)")
+
+# subparser for vcs push command
+"""command format: vcs push [REMOTE] [BRANCH ...] [-f]"""
+"""Updates the branches of REMOTE with the ones of the repository, copying the objects REMOTE lacks"""
+argsp = argsubparsers.add_parser("push", help="Update the branches of another repository")
+argsp.add_argument("remote", nargs="?", default="origin", help="name of a remote or path of a repository (default: origin)")
+argsp.add_argument("branch", nargs="*", help="branches to push (default: the current branch)")
+argsp.add_argument("-f", dest="force", action="store_true", help="update the branches even if commits of REMOTE are lost")
+
+
+# options of the core section of the config which clone copies from the source repository
+CLONE_CONFIG = ["chunkthreshold", "chunksize"]
+
+
+def remote_find(repo, name):
+    """Returns (remote name, repository) for name, which is either the name of a remote of repo or the path of a
+    repository. The remote name is None for a path which isn't the path of one of the remotes"""
+    remote, path = None, name
+    for section in repo.conf.sections():
+        m = re.match(r'^remote "(.+)"$', section)
+        url = repo.conf.get(section, "url", fallback=None)
+        if m and url and (m.group(1) == name or os.path.realpath(url) == os.path.realpath(name)):
+            remote, path = m.group(1), url
+            break
+    if not os.path.isdir(os.path.join(path, ".vcs")):
+        raise Exception("{0} is neither a remote nor a vcs repository".format(name))
+    return remote, vcsRepository(os.path.realpath(path))
+
+
+def remote_add(repo, name, path):
+    """Records the repository path as the remote name of repo"""
+    section = 'remote "{0}"'.format(name)
+    if not repo.conf.has_section(section):
+        repo.conf.add_section(section)
+    repo.conf.set(section, "url", os.path.realpath(path))
+    with open(repo_file(repo, "config"), "w") as f:
+        repo.conf.write(f)
+
+
+def ref_head(repo):
+    """Returns the reference HEAD points to, or None if HEAD holds a commit hash"""
+    with open(repo_file(repo, "HEAD")) as f:
+        data = f.read().strip()
+    return data[5:] if data.startswith("ref: ") else None
+
+
+def ref_value(repo, ref):
+    """Returns the hash held by the reference ref, or "" if there is no such reference"""
+    if not os.path.isfile(repo_path(repo, ref)):
+        return ""
+    return ref_resolve(repo, ref)
+
+
+def ref_transaction(repo, updates):
+    """Updates references all at once. updates is a list of (reference, old hash, new hash), old being "" for a
+    reference which doesn't exist yet. Every reference is locked and checked to still hold old before any of them
+    is changed, so either all the references are updated or none of them"""
+    locks = list()
+    try:
+        for ref, old, new in updates:
+            path = repo_file(repo, *ref.split("/"), mkdir=True)
+            try:
+                fd = os.open(path + ".lock", os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+            except FileExistsError:
+                raise Exception("Reference {0} is locked by another process ({1}.lock exists)".format(ref, path))
+            locks.append(path)
+            with os.fdopen(fd, "w") as f:
+                f.write(new + "\n")
+            if ref_value(repo, ref) != old:
+                raise Exception("Reference {0} was changed by another process".format(ref))
+        for path in locks:
+            os.replace(path + ".lock", path)
+        locks = list()
+    finally:
+        for path in locks:
+            os.remove(path + ".lock")
+
+
+def transfer_objects(repo, wants, has):
+    """Returns the hashes of the objects of repo reachable from the objects wants which the receiving repository
+    lacks, has(sha) telling whether the receiver has the object sha"""
+    missing = list()
+    seen = set()
+    stack = [sha for sha in wants if sha]
+    while stack:
+        sha = stack.pop()
+        if sha in seen:
+            continue
+        seen.add(sha)
+        if has(sha):
+            continue
+        missing.append(sha)
+        stack.extend(object_children(repo, sha))
+    return missing
+
+
+def transfer(source, dest, updates):
+    """Sets the references of the repository dest to the hashes of updates, a list of (reference, hash), after
+    copying from the repository source the objects dest lacks. Returns (number of objects copied, size of the pack
+    sent, references changed as (reference, old hash, new hash))"""
+    updates = [(ref, ref_value(dest, ref), new) for ref, new in updates]
+    updates = [(ref, old, new) for ref, old, new in updates if old != new]
+    shas = transfer_objects(source, [new for _, _, new in updates], lambda sha: object_exists(dest, sha))
+
+    size = 0
+    if shas:
+        packDir = repo_dir(dest, "objects", "pack", mkdir=True)
+        tmpPath = os.path.join(packDir, "tmp-pack-{0}".format(os.getpid()))
+        try:
+            with open(tmpPath, "wb") as f:
+                pack_stream(source, shas, f)
+                size = f.tell()
+            pack_index(dest, tmpPath)
+        finally:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+
+    for ref, _, new in updates:
+        if not object_exists(dest, new):
+            raise Exception("Object {0} of {1} is missing after the transfer".format(new, ref))
+    ref_transaction(dest, updates)
+    return len(shas), size, updates
+
+
+def fetch(repo, remote, source):
+    """Copies to repo the branches of the repository source as refs/remotes/REMOTE/BRANCH when remote is the name
+    of a remote of repo, the tags repo doesn't have and the HEAD of source as FETCH_HEAD. Returns the result of transfer"""
+    updates = list()
+    for ref, sha in ref_flatten(ref_list(source)).items():
+        if not sha:
+            continue
+        if ref.startswith("refs/heads/") and remote:
+            updates.append(("refs/remotes/{0}/{1}".format(remote, ref[len("refs/heads/"):]), sha))
+        elif ref.startswith("refs/tags/") and not ref_value(repo, ref):
+            updates.append((ref, sha))
+    head = ref_resolve(source, "HEAD")
+    if head:
+        updates.append(("FETCH_HEAD", head))
+    return transfer(source, repo, updates)
+
+
+def clone(sourcePath, path, workers=1):
+    """Creates the repository path as a copy of the repository sourcePath, which becomes it's remote origin, and
+    checks out it's HEAD. Returns the new repository and the result of transfer"""
+    if not os.path.isdir(os.path.join(sourcePath, ".vcs")):
+        raise Exception("{0} is not a vcs repository".format(sourcePath))
+    if os.path.exists(path) and (not os.path.isdir(path) or os.listdir(path)):
+        raise Exception("{0} already exists and is not an empty directory".format(path))
+    source = vcsRepository(os.path.realpath(sourcePath))
+    repo_create(path)
+    repo = vcsRepository(os.path.realpath(path))
+    # the chunking settings decide the hash of large files, without them the files checked out would not match
+    # the chunked blobs of the commits
+    for option in CLONE_CONFIG:
+        if source.conf.has_option("core", option):
+            repo.conf.set("core", option, source.conf.get("core", option))
+    remote_add(repo, "origin", sourcePath)
+
+    updates = list()
+    for ref, sha in ref_flatten(ref_list(source)).items():
+        if not sha:
+            continue
+        if ref.startswith("refs/heads/"):
+            updates.append((ref, sha))
+            updates.append(("refs/remotes/origin/" + ref[len("refs/heads/"):], sha))
+        elif ref.startswith("refs/tags/"):
+            updates.append((ref, sha))
+    head = ref_resolve(source, "HEAD")
+    branch = ref_head(source)
+    if branch is None and head:
+        # detached HEAD
+        updates.append(("HEAD", head))
+    result = transfer(source, repo, updates)
+    if branch is not None:
+        with open(repo_file(repo, "HEAD"), "w") as f:
+            f.write("ref: {0}\n".format(branch))
+
+    if head:
+        tree = object_read(repo, object_find(repo, head, fmt=b'tree'))
+        plan = checkout_plan(repo, tree, repo.worktree)
+        tree_checkout(repo, tree, repo.worktree, workers=workers, plan=plan)
+        # the index is filled from the plan, without hashing the files again. It has no cache tree: the trees of
+        # the source hold the paths of it's worktree, not the ones the next commit of this worktree writes
+        index_write(repo, index_checkout(repo, plan[1]))
+    return repo, result
+
+
+def push(repo, remote, dest, branches, force=False):
+    """Sets the branches of the repository dest to the ones of repo, copying the objects dest lacks, and the remote
+    tracking branches of repo when remote is the name of a remote. A branch which would lose commits isn't updated
+    unless force is True, nor is the branch checked out in dest. Returns the result of transfer"""
+    destHead = ref_head(dest)
+    updates = list()
+    for branch in branches:
+        ref = "refs/heads/" + branch
+        new = ref_value(repo, ref)
+        if not new:
+            raise Exception("No branch {0}".format(branch))
+        old = ref_value(dest, ref)
+        if old == new:
+            continue
+        if old and not force and not (object_exists(repo, old) and commit_is_ancestor(repo, old, new)):
+            raise Exception("Branch {0} of {1} has commits which the local branch doesn't have: fetch them first, or push with -f to drop them".format(branch, dest.worktree))
+        if ref == destHead and dest.conf.get("receive", "denycurrentbranch", fallback="refuse") != "ignore":
+            raise Exception("Branch {0} is checked out in {1}, whose worktree would not match it anymore "
+                            "(set denycurrentbranch = ignore in the receive section of it's config to allow it)".format(branch, dest.worktree))
+        updates.append((ref, new))
+
+    result = transfer(repo, dest, updates)
+    if remote:
+        tracking = [("refs/remotes/{0}/{1}".format(remote, ref[len("refs/heads/"):]), new) for ref, _, new in result[2]]
+        ref_transaction(repo, [(ref, ref_value(repo, ref), new) for ref, new in tracking])
+    return result
+
+
+def transfer_report(verb, result):
+    """Prints the number of objects and bytes transferred and the references changed"""
+    count, size, updates = result
+    print("{0} {1} objects ({2} bytes)".format(verb, count, size))
+    for ref, old, new in updates:
+        print("  {0}..{1}  {2}".format(old[:7] if old else "(new)", new[:7], ref))
+
+
 # cmd_* function definitions
 def cmd_init(args):
     """calling function for init command"""
     repo_create(args.path)
 
+def cmd_add(args):
+    """Calling function for vcs add command"""
+    repo = repo_find()
+    index = index_read(repo)
+    index_add(repo, index, [worktree_path(repo, path) for path in args.path], workers=repo_workers(repo))
+    index_write(repo, index)
+
 def cmd_cat_file(args):
     """Calling function for cat-file command"""
+    if args.object is None and not (args.batch or args.batchCheck):
+        args.object, args.type = args.type, None
+    if args.type is not None and args.type not in CAT_FILE_TYPES:
+        raise Exception("Invalid object type {0} (choose from {1})".format(args.type, ", ".join(CAT_FILE_TYPES)))
+    repo = repo_find()
+    if args.batch or args.batchCheck:
+        try:
+            cat_file_batch(repo, contents=args.batch)
+        except BrokenPipeError:
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    elif args.object is None:
+        raise Exception("Specify the object to display")
+    elif args.showType or args.showSize:
+        fmt, size = cat_file_info(repo, object_find(repo, args.object))
+        print(fmt.decode("ascii") if args.showType else size)
+    elif args.type:
+        cat_file(repo, args.object, fmt=args.type.encode())
+    else:
+        raise Exception("Specify the type of the object or one of -t, -s")
+
+def cmd_clone(args):
+    """Calling function for vcs clone command"""
+    path = args.directory or os.path.basename(os.path.realpath(args.source))
+    workers = args.jobs or os.cpu_count() or 1
+    repo, result = clone(args.source, path, workers)
+    print("Cloned {0} into {1}".format(args.source, path))
+    transfer_report("Received", result)
+
+def cmd_fetch(args):
+    """Calling function for vcs fetch command"""
     repo = repo_find()
-    cat_file(repo, args.object, fmt=args.type.encode())
+    remote, source = remote_find(repo, args.remote)
+    transfer_report("Received", fetch(repo, remote, source))
+
+def cmd_push(args):
+    """Calling function for vcs push command"""
+    repo = repo_find()
+    remote, dest = remote_find(repo, args.remote)
+    branches = args.branch
+    if not branches:
+        head = ref_head(repo)
+        if head is None or not head.startswith("refs/heads/"):
+            raise Exception("HEAD is not a branch, name the branches to push")
+        branches = [head[len("refs/heads/"):]]
+    transfer_report("Sent", push(repo, remote, dest, branches, force=args.force))
+
+def cmd_gc(args):
+    """Calling function for vcs gc command"""
+    repo = repo_find()
+    if args.grace is not None:
+        grace = args.grace
+    else:
+        grace = repo.conf.getfloat("gc", "gracedays", fallback=GC_GRACE_DAYS)
+
+    start = time.time()
+    roots = gc_roots(repo)
+    reachable = gc_mark(repo, roots, workers=repo_workers(repo, args.jobs))
+    marked = time.time()
+    stats = gc_sweep(repo, reachable, grace * 24 * 3600, quarantine=args.quarantine)
+    swept = time.time()
+
+    reclaimed = stats["packedBytes"] + stats["temporaryBytes"]
+    if not args.quarantine:
+        reclaimed += stats["unreachableBytes"]
+    print("mark:  {0} reachable objects from {1} roots in {2:.2f}s".format(len(reachable), len(roots), marked - start))
+    print("sweep: {0} loose objects in {1:.2f}s".format(stats["loose"], swept - marked))
+    print("       {0} unreachable ({1} bytes) {2}".format(stats["unreachable"], stats["unreachableBytes"],
+                                                          "quarantined" if args.quarantine else "removed"))
+    print("       {0} unreachable kept as they are recent".format(stats["recent"]))
+    print("       {0} already packed ({1} bytes) removed".format(stats["packed"], stats["packedBytes"]))
+    print("       {0} temporary files ({1} bytes) removed".format(stats["temporary"], stats["temporaryBytes"]))
+    print("total: {0} bytes reclaimed in {1:.2f}s".format(reclaimed, swept - start))
+
 
 def cmd_hash_object(args):
     """calling function for hash-object command"""
     if args.write:
-        repo = vcsRepository(".")
+        repo = repo_find()
     else:
-        repo = None
-    
-    with open(args.path, "rb") as f:
-        sha = object_hash(f, args.type.encode(), repo)
-        print(sha)
+        # the config of the repository, if any, tells whether the file would be stored as a chunked blob
+        repo = repo_find(required=False)
+    fmt = args.type.encode()
+
+    if args.stdinPaths:
+        if args.stdin or args.path:
+            raise Exception("--stdin-paths reads the paths from the standard input, no other input can be given")
+        workers = repo_workers(repo, args.jobs) if repo else (args.jobs or os.cpu_count() or 1)
+        if args.write:
+            with vcsBulkCheckin(repo):
+                object_hash_paths(repo, fmt, True, workers)
+        else:
+            object_hash_paths(repo, fmt, False, workers)
+        return
+    if not args.stdin and args.path is None:
+        raise Exception("Specify the file to hash")
+
+    if args.stdin:
+        print(object_hash(sys.stdin.buffer, fmt, repo, actually_write=args.write))
+    if args.path:
+        print(object_hash_path(repo, args.path, fmt, actually_write=args.write))
 
 def cmd_log(args):
     """Calling function for log command"""
     repo = repo_find()
-    if args.dot:
-        print("digraph vcslog{")
-        logGraph(repo, object_find(repo, args.commit), set())
-        print("}")
-    else:
-        commitLog(repo, object_find(repo, args.commit), dict())
+    sha = object_find(repo, args.commit)
+    since = parse_date(args.since) if args.since else None
+    until = parse_date(args.until) if args.until else None
+    commits = itertools.islice(rev_walk(repo, [sha], since, until), args.skip,
+                               args.skip + args.maxCount if args.maxCount is not None else None)
+
+    # output goes straight to the buffered binary stdout instead of one print call per line
+    out = sys.stdout.buffer
+    try:
+        if args.dot:
+            out.write(b'digraph vcslog{\n')
+            logGraph(repo, commits, out)
+            out.write(b'}\n')
+        else:
+            commitLog(repo, commits, out, head=ref_resolve(repo, "HEAD"), oneline=args.oneline)
+        out.flush()
+    except BrokenPipeError:
+        # the reader of the output (head, less ...) went away, stdout now points to devnull so the flush at exit is silent
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+
+def cmd_diff_tree(args):
+    """Calling function for vcs diff-tree command"""
+    repo = repo_find()
+    old = object_find(repo, args.old, fmt=b'tree')
+    new = object_find(repo, args.new, fmt=b'tree')
+    out = sys.stdout.buffer
+    for change in tree_diff(repo, old, new, recursive=args.recursive):
+        out.write(":{0} {1} {2} {3} {4}\t".format(
+            (change.oldMode or b'0').decode("ascii").rjust(6, "0"),
+            (change.newMode or b'0').decode("ascii").rjust(6, "0"),
+            change.oldSha or "0" * 40,
+            change.newSha or "0" * 40,
+            change.status).encode() + change.path + b'\n')
+    out.flush()
 
 def cmd_ls_tree(args):
     """ Calling function for ls-tree command"""
@@ -775,7 +4444,7 @@ def cmd_ls_tree(args):
     for item in obj.items:
         print("{0} {1} {2}\t{3}".format(
             "0" * (6 - len(item.mode)) + item.mode.decode("ascii"),
-            object_read(repo, item.sha).fmt.decode("ascii"),
+            object_info(repo, item.sha)[0].decode("ascii"),
             item.sha,
             item.path.decode("ascii")))
 
@@ -788,7 +4457,7 @@ def cmd_checkout(args):
 
     # deserializing the tree byte object mentioned in commit object
     if obj.fmt == b'commit':
-        obj = object_read(repo, obj.commitData[b'tree'][0].decode("ascii"))
+        obj = object_read(repo, obj.header(b'tree')[0].decode("ascii"))
     
     # verify that the path mentioned in the argument is empty
     if os.path.exists(args.path):
@@ -799,7 +4468,19 @@ def cmd_checkout(args):
     else:
         os.makedirs(args.path)
     
-    tree_checkout(repo, obj, os.path.realpath(args.path).encode())
+    start = time.time()
+    count, size = tree_checkout(repo, obj, os.path.realpath(args.path), workers=repo_workers(repo, args.jobs))
+    elapsed = max(time.time() - start, 1e-6)
+    print("Checked out {0} files ({1} bytes) in {2:.2f}s: {3:.0f} files/s, {4:.1f} MB/s".format(
+        count, size, elapsed, count / elapsed, size / elapsed / (1024 * 1024)))
+
+
+def cmd_commit_graph(args):
+    """Calling function for vcs commit-graph command"""
+    repo = repo_find()
+    if args.action == "write":
+        count = commit_graph_write(repo)
+        print("Wrote commit graph with {0} commits".format(count))
 
 
 def cmd_commit(args):
@@ -811,7 +4492,7 @@ def cmd_commit(args):
     repo = repo_find()
     dct = collections.OrderedDict()
 
-    treeHash = createTree(verbose=args.verbose).encode()
+    treeHash = index_snapshot(repo, verbose=args.verbose, workers=repo_workers(repo, args.jobs)).encode()
     headPath = os.path.join(repo.vcsdir, "HEAD")
     if not os.path.exists(headPath):
         raise Exception("{0} doesn't exist".format(headPath))
@@ -825,15 +4506,15 @@ def cmd_commit(args):
     # -------------------------------------------
     if headCommitHash:
         # check if the commit hash (sha-1) exists or not
-        if not os.path.isfile(os.path.join(repo.vcsdir, "objects", headCommitHash[:2], headCommitHash[2:])):
+        if not object_exists(repo, headCommitHash):
             raise Exception("Commit pointed by HEAD --> {0} doesn't exist".format(headCommitHash))
-        # check if the hash in HEAD is a commit object hash
-        fmt = getObjectFormat(repo, headCommitHash)
-        if fmt != "commit":
+        # check if the hash in HEAD is a commit object hash (only the header of the object is read)
+        fmt, _ = object_info(repo, headCommitHash)
+        if fmt != b'commit':
             raise Exception("Object pointed by HEAD --> {0} is not a commit".format(headCommitHash))
         # check if changes been made in worktree since last commit
         obj = object_read(repo, headCommitHash)
-        if obj.commitData[b'tree'][0] == treeHash:
+        if obj.header(b'tree')[0] == treeHash:
             print('Nothing to commit. No change in worktree since last commit ({0})'.format(headCommitHash))
             return
     
@@ -844,19 +4525,103 @@ def cmd_commit(args):
     if headCommitHash:
         # add parent if headCommitHash is not empty,ie, first commit will not have a parent commit entry
         dct[b'parent'] = headCommitHash.encode()
-    dct[b'author'] = name.encode() + b' ' + email.encode()
+    # author and committer lines end with the unix time and the timezone offset of the commit
+    stamp = " {0} {1}".format(int(time.time()), time.strftime("%z")).encode()
+    dct[b'author'] = name.encode() + b' ' + email.encode() + stamp
     if not args.a:
-        dct[b'committer'] = name.encode() + b' ' + email.encode()
+        dct[b'committer'] = name.encode() + b' ' + email.encode() + stamp
     dct[b''] = args.message.encode()
     commitObj = vcsCommit(repo)
     commitObj.commitData = dct
     sha = object_write(commitObj, True)
     # updating the HEAD commit
     update_master(repo, sha)
+    commit_graph_add(repo, sha)
     print("commit hash: {0}".format(sha))
     print("commit message: {0}\n".format(args.message)) 
 
 
+def cmd_status(args):
+    """Calling function for vcs status command"""
+    repo = repo_find()
+    tree = index_snapshot(repo, workers=repo_workers(repo, args.jobs))
+    head = ref_resolve(repo, "HEAD")
+    headTree = object_find(repo, head, fmt=b'tree') if head else None
+    changes = list(tree_diff(repo, headTree, tree))
+    if args.short:
+        for change in changes:
+            print("{0} {1}".format(change.status, os.fsdecode(change.path)))
+        return
+    print("On commit {0}".format(object_abbrev(repo, head)) if head else "No commits yet")
+    if not changes:
+        print("Nothing to commit, worktree clean")
+        return
+    print("Changes since the last commit:")
+    for change in changes:
+        print("\t{0:<12}{1}".format(STATUS_LABELS[change.status], os.fsdecode(change.path)))
+
+
+def cmd_watch(args):
+    """Calling function for vcs watch command"""
+    repo = repo_find()
+    token = watch_token(repo)
+    if args.stop:
+        if token is None:
+            raise Exception("No watcher is running")
+        os.kill(int(token.split()[0]), signal.SIGTERM)
+        return
+    if token is not None:
+        raise Exception("A watcher is already running (pid {0})".format(token.split()[0]))
+    watcher = vcsWatcher(repo)
+    if args.daemon:
+        pid = os.fork()
+        if pid:
+            print("Watching {0} directories (pid {1})".format(len(watcher.wds), pid))
+            return
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in range(3):
+            os.dup2(devnull, fd)
+    else:
+        print("Watching {0} directories".format(len(watcher.wds)))
+        sys.stdout.flush()
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+
+
+def cmd_server(args):
+    """Calling function for vcs server command"""
+    repo = repo_find()
+    if args.stop:
+        conn = server_connect(repo)
+        if conn is None:
+            raise Exception("No command server is running")
+        with conn:
+            conn.sendall(json.dumps({"stop": True}).encode() + b'\n')
+            conn.recv(SERVER_FRAME.size + 1)
+        return
+    sock = server_listen(repo)
+    if args.daemon:
+        pid = os.fork()
+        if pid:
+            sock.close()
+            print("Serving {0} (pid {1})".format(repo.worktree, pid))
+            return
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in range(3):
+            os.dup2(devnull, fd)
+    else:
+        print("Serving {0}".format(repo.worktree))
+        sys.stdout.flush()
+    try:
+        server_run(repo, sock)
+    except KeyboardInterrupt:
+        pass
+
+
 def cmd_show_ref(args):
     """Calling function for vcs show-ref command"""
     repo = repo_find()
@@ -864,6 +4629,34 @@ def cmd_show_ref(args):
     show_ref(repo, refs, prefix="")
 
 
+def cmd_repack(args):
+    """Calling function for vcs repack command"""
+    repo = repo_find()
+    path = repack(repo, allObjects=args.all, delete=args.delete)
+    if path is None:
+        print("Nothing to pack")
+        return
+    pack = vcsPack(path)
+    print("Packed {0} objects into {1} ({2} bytes)".format(pack.count, os.path.basename(path) + ".pack", len(pack.pack)))
+    pack.close()
+
+
+def cmd_rev_parse(args):
+    """Calling function for vcs rev-parse command"""
+    repo = repo_find()
+    for name in args.name:
+        sha = object_find(repo, name)
+        print(object_abbrev(repo, sha, args.abbrev) if args.short else sha)
+
+
+def cmd_rm(args):
+    """Calling function for vcs rm command"""
+    repo = repo_find()
+    index = index_read(repo)
+    index_remove(repo, index, [worktree_path(repo, path) for path in args.path])
+    index_write(repo, index)
+
+
 def cmd_set(args):
     """calling function for vcs set command"""
     repo = repo_find()
@@ -885,18 +4678,33 @@ def cmd_set(args):
 def main(argv = sys.argv[1:]):
     args = argparser.parse_args(argv)
 
-    if args.command == "add"                   : cmd_add(args)
-    elif args.command == "cat-file"            : cmd_cat_file(args)
-    elif args.command == "checkout"            : cmd_checkout(args)
-    elif args.command == "commit"              : cmd_commit(args)
-    elif args.command == "hash-object"         : cmd_hash_object(args)
-    elif args.command == "log"                 : cmd_log(args)
-    elif args.command == "init"                : cmd_init(args)
-    elif args.command == "ls-tree"             : cmd_ls_tree(args)
-    elif args.command == "merge"               : cmd_merge(args)
-    elif args.command == "rebase"              : cmd_rebase(args)
-    elif args.command == "rev-parse"           : cmd_rev_parse(args)
-    elif args.command == "rm"                  : cmd_rm(args)
-    elif args.command == "show-ref"            : cmd_show_ref(args)
-    elif args.command == "tag"                 : cmd_tag(args)
-    elif args.command == "set"                 : cmd_set(args)
\ No newline at end of file
+    trace_begin(args.trace, args.traceJson)
+    try:
+        with trace_span("command " + args.command):
+            if args.command == "add"                   : cmd_add(args)
+            elif args.command == "cat-file"            : cmd_cat_file(args)
+            elif args.command == "checkout"            : cmd_checkout(args)
+            elif args.command == "clone"               : cmd_clone(args)
+            elif args.command == "commit"              : cmd_commit(args)
+            elif args.command == "commit-graph"        : cmd_commit_graph(args)
+            elif args.command == "diff-tree"           : cmd_diff_tree(args)
+            elif args.command == "fetch"               : cmd_fetch(args)
+            elif args.command == "gc"                  : cmd_gc(args)
+            elif args.command == "hash-object"         : cmd_hash_object(args)
+            elif args.command == "log"                 : cmd_log(args)
+            elif args.command == "init"                : cmd_init(args)
+            elif args.command == "ls-tree"             : cmd_ls_tree(args)
+            elif args.command == "merge"               : cmd_merge(args)
+            elif args.command == "push"                : cmd_push(args)
+            elif args.command == "rebase"              : cmd_rebase(args)
+            elif args.command == "repack"              : cmd_repack(args)
+            elif args.command == "rev-parse"           : cmd_rev_parse(args)
+            elif args.command == "rm"                  : cmd_rm(args)
+            elif args.command == "show-ref"            : cmd_show_ref(args)
+            elif args.command == "status"              : cmd_status(args)
+            elif args.command == "tag"                 : cmd_tag(args)
+            elif args.command == "server"              : cmd_server(args)
+            elif args.command == "set"                 : cmd_set(args)
+            elif args.command == "watch"               : cmd_watch(args)
+    finally:
+        trace_end()
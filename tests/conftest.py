@@ -0,0 +1,55 @@
+# shared fixtures of the tests: a new repository in a temporary directory, used through libvcs.main like the vcs
+# command, and helpers to fill it's worktree
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import libvcs
+
+
+def write_files(root, files):
+    """Writes files, a dict of paths relative to root to their content"""
+    for path, data in files.items():
+        full = os.path.join(root, path)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        with open(full, "wb") as f:
+            f.write(data)
+
+
+def read_files(root):
+    """Returns the files under root, except the .vcs directory, as a dict of relative paths to their content"""
+    files = dict()
+    for dirpath, dirnames, filenames in os.walk(root):
+        if ".vcs" in dirnames:
+            dirnames.remove(".vcs")
+        for name in filenames:
+            full = os.path.join(dirpath, name)
+            with open(full, "rb") as f:
+                files[os.path.relpath(full, root)] = f.read()
+    return files
+
+
+def make_repo(path):
+    """Creates a repository at path with a user name and email, so that commits don't ask for them"""
+    libvcs.repo_create(path)
+    with open(os.path.join(path, ".vcs", "userInfo"), "w") as f:
+        f.write("[info]\nname = test\nemail = test@example.com\n\n")
+    return path
+
+
+def commit(message):
+    """Commits the worktree of the repository of the current directory and returns the hash of HEAD"""
+    libvcs.main(["commit", message])
+    return libvcs.ref_resolve(libvcs.repo_find(), "HEAD")
+
+
+@pytest.fixture
+def worktree(tmp_path, monkeypatch):
+    """A new repository, the current directory being it's worktree"""
+    path = make_repo(str(tmp_path / "repo"))
+    monkeypatch.chdir(path)
+    return path
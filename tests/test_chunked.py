@@ -0,0 +1,56 @@
+import configparser
+import os
+import random
+
+import libvcs
+from conftest import commit, read_files, write_files
+
+
+def set_chunking(worktree, threshold, size):
+    path = os.path.join(worktree, ".vcs", "config")
+    conf = configparser.ConfigParser()
+    conf.read(path)
+    conf.set("core", "chunkthreshold", str(threshold))
+    conf.set("core", "chunksize", str(size))
+    with open(path, "w") as f:
+        conf.write(f)
+
+
+def chunked_tree_entry(repo, name):
+    """Returns the object of the file name of the tree of HEAD (tree entries hold the full path of the files)"""
+    tree = libvcs.object_find(repo, "HEAD", fmt=b'tree')
+    for item in libvcs.object_read(repo, tree).items:
+        if os.path.basename(item.path) == name:
+            return libvcs.object_read(repo, item.sha)
+
+
+def test_chunked_checkout_round_trip(worktree, tmp_path):
+    set_chunking(worktree, 16384, 4096)
+    rng = random.Random(0)
+    big = rng.randbytes(300000)
+    write_files(worktree, {"big.bin": big, "small.txt": b"small\n"})
+    commit("first")
+    repo = libvcs.repo_find()
+    first = chunked_tree_entry(repo, b"big.bin")
+    assert first.fmt == b'chunked'
+    assert sum(size for _, size in first.chunks) == len(big)
+    assert len(first.chunks) > 10
+
+    # an edit in the middle only adds the chunks around it
+    edited = big[:150000] + b"edit" + big[150000:]
+    write_files(worktree, {"big.bin": edited})
+    commit("second")
+    second = chunked_tree_entry(repo, b"big.bin")
+    assert len(set(second.chunks) - set(first.chunks)) <= 3
+
+    target = str(tmp_path / "out")
+    os.mkdir(target)
+    libvcs.main(["checkout", "HEAD", target])
+    assert read_files(target) == {"big.bin": edited, "small.txt": b"small\n"}
+
+    # the chunked blobs survive a repack
+    libvcs.main(["repack", "-a", "-d"])
+    target = str(tmp_path / "out2")
+    os.mkdir(target)
+    libvcs.main(["checkout", "HEAD", target])
+    assert read_files(target) == {"big.bin": edited, "small.txt": b"small\n"}
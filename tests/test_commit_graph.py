@@ -0,0 +1,93 @@
+import os
+
+import libvcs
+from conftest import commit, write_files
+
+
+def write_commit(repo, tree, parents, time, message):
+    """Writes a commit object with the given parents and returns it's hash"""
+    lines = [b"tree " + tree.encode()] + [b"parent " + p.encode() for p in parents]
+    person = b"test <test@example.com> %d +0000" % time
+    lines += [b"author " + person, b"committer " + person]
+    raw = b"\n".join(lines) + b"\n\n" + message + b"\n"
+    return libvcs.object_write(libvcs.vcsCommit(repo, raw))
+
+
+def set_ref(repo, name, sha):
+    with open(os.path.join(repo.vcsdir, "refs", "heads", name), "w") as f:
+        f.write(sha + "\n")
+
+
+def make_history(worktree):
+    """Builds a history with branches, a merge and an octopus merge. Returns the repository"""
+    write_files(worktree, {"a.txt": b"a\n"})
+    first = commit("first")
+    write_files(worktree, {"a.txt": b"b\n"})
+    second = commit("second")
+    repo = libvcs.repo_find()
+    tree = libvcs.object_read_raw(repo, second)[1][5:45].decode()
+    side = write_commit(repo, tree, [first], 2000000000, b"side")
+    other = write_commit(repo, tree, [first], 2000000001, b"other")
+    merge = write_commit(repo, tree, [second, side], 2000000002, b"merge")
+    octopus = write_commit(repo, tree, [merge, side, other], 2000000003, b"octopus")
+    set_ref(repo, "side", side)
+    set_ref(repo, "octopus", octopus)
+    return repo
+
+
+def plain_walk(repo):
+    """Returns sha --> (parents, generation, time) of every commit reachable from the refs and HEAD, read from
+    the commit objects"""
+    starts = [libvcs.ref_resolve(repo, "HEAD")] + [sha for sha in libvcs.ref_flatten(libvcs.ref_list(repo)).values() if sha]
+    info = dict()
+
+    def visit(sha):
+        if sha not in info:
+            commit = libvcs.object_read(repo, sha)
+            parents = libvcs.commit_parents(commit)
+            generation = 1 + max([visit(p)[1] for p in parents], default=0)
+            info[sha] = (parents, generation, libvcs.commit_time(commit))
+        return info[sha]
+
+    for sha in starts:
+        visit(sha)
+    return info
+
+
+def test_commit_graph_matches_object_walk(worktree):
+    repo = make_history(worktree)
+    expected = plain_walk(repo)
+    assert libvcs.commit_graph_write(repo) == len(expected)
+
+    repo = libvcs.repo_find()
+    graph = libvcs.repo_commit_graph(repo)
+    assert graph.count == len(expected)
+    for sha, info in expected.items():
+        assert libvcs.commit_info(repo, sha) == info
+    for sha, tree, parents, generation, time in graph.records():
+        assert (parents, generation, time) == expected[sha]
+        assert tree == libvcs.object_read_raw(repo, sha)[1][5:45].decode()
+
+
+def test_commit_graph_ancestry(worktree):
+    repo = make_history(worktree)
+    shas = list(plain_walk(repo))
+    without = {(a, b): libvcs.commit_is_ancestor(repo, a, b) for a in shas for b in shas}
+    libvcs.commit_graph_write(repo)
+    repo = libvcs.repo_find()
+    assert {(a, b): libvcs.commit_is_ancestor(repo, a, b) for a in shas for b in shas} == without
+
+
+def test_commit_graph_add(worktree):
+    repo = make_history(worktree)
+    libvcs.commit_graph_write(repo)
+    write_files(worktree, {"a.txt": b"c\n"})
+    head = commit("third")
+
+    repo = libvcs.repo_find()
+    expected = plain_walk(repo)
+    graph = libvcs.repo_commit_graph(repo)
+    assert graph.count == len(expected)
+    assert graph.find(head) is not None
+    for sha, info in expected.items():
+        assert libvcs.commit_info(repo, sha) == info
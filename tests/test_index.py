@@ -0,0 +1,92 @@
+import os
+
+import libvcs
+from conftest import commit, write_files
+
+
+def test_index_round_trip(worktree):
+    repo = libvcs.repo_find()
+    index = libvcs.vcsIndex()
+    index.entries["a.txt"] = libvcs.vcsIndexEntry("a.txt", 0o100644, 12, 1 << 60, 5, 42, "ab" * 20)
+    index.entries["dir/sub/b"] = libvcs.vcsIndexEntry("dir/sub/b", 0o100755, 0, 0, 0, 0, "00" * 19 + "01")
+    index.entries["été.txt"] = libvcs.vcsIndexEntry("été.txt", 0o100644, 3, 7, 8, 9, "cd" * 20)
+    libvcs.index_write(repo, index)
+
+    read = libvcs.index_read(repo)
+    assert sorted(read.entries) == sorted(index.entries)
+    for name, entry in index.entries.items():
+        other = read.entries[name]
+        assert (other.path, other.mode, other.size, other.mtime_ns, other.ctime_ns, other.ino, other.sha) == \
+               (entry.path, entry.mode, entry.size, entry.mtime_ns, entry.ctime_ns, entry.ino, entry.sha)
+
+
+def test_index_follows_worktree(worktree):
+    write_files(worktree, {"a.txt": b"a\n", "dir/b.txt": b"b\n"})
+    commit("first")
+    repo = libvcs.repo_find()
+    index = libvcs.index_read(repo)
+    assert sorted(index.entries) == ["a.txt", "dir/b.txt"]
+    for name, entry in index.entries.items():
+        assert entry.matches(os.stat(os.path.join(worktree, name)))
+
+    write_files(worktree, {"a.txt": b"changed\n"})
+    os.remove(os.path.join(worktree, "dir", "b.txt"))
+    assert libvcs.index_refresh(repo, index)
+    assert sorted(index.entries) == ["a.txt"]
+    with open(os.path.join(worktree, "a.txt"), "rb") as f:
+        assert index.entries["a.txt"].sha == libvcs.object_hash(f, b'blob')
+
+
+def test_cache_tree_round_trip(worktree):
+    write_files(worktree, {"a.txt": b"a\n", "dir/b.txt": b"b\n", "dir/sub/c.txt": b"c\n", "keep/d.txt": b"d\n"})
+    head = commit("first")
+    repo = libvcs.repo_find()
+    index = libvcs.index_read(repo)
+    assert sorted(index.trees) == ["", "dir", "dir/sub", "keep"]
+    fmt, data = libvcs.object_read_raw(repo, head)
+    assert data.startswith(b"tree " + index.trees[""][0].encode())
+
+    libvcs.index_write(repo, index)
+    assert libvcs.index_read(repo).trees == index.trees
+
+    # a change only invalidates the trees of the directories holding the file
+    write_files(worktree, {"dir/sub/c.txt": b"changed\n"})
+    libvcs.index_refresh(repo, index)
+    assert sorted(index.trees) == ["keep"]
+
+
+def test_parallel_hashing_gives_serial_trees(worktree):
+    write_files(worktree, {"d{0}/f{1}.txt".format(i % 7, i): b"file %d\n" % i for i in range(300)})
+    repo = libvcs.repo_find()
+    shas = list()
+    for workers in (1, 8):
+        index = libvcs.vcsIndex()
+        libvcs.index_refresh(repo, index, workers=workers)
+        shas.append(libvcs.index_write_tree(repo, index))
+    assert shas[0] == shas[1]
+
+
+def test_parallel_commit_many_objects(worktree):
+    # the hashing threads create the fan-out directories of the objects concurrently
+    write_files(worktree, {"f{0}.txt".format(i): b"content %d\n" % i for i in range(3000)})
+    libvcs.main(["commit", "-j", "32", "many files"])
+    repo = libvcs.repo_find()
+    assert len(libvcs.index_read(repo).entries) == 3000
+
+
+def test_watch_extension_round_trip(worktree):
+    repo = libvcs.repo_find()
+    index = libvcs.vcsIndex()
+    index.watch = ("1234-5678-3", 4096)
+    libvcs.index_write(repo, index)
+    assert libvcs.index_read(repo).watch == index.watch
+
+
+def test_status(worktree, capsys):
+    write_files(worktree, {"a.txt": b"a\n", "dir/b.txt": b"b\n", "dir/c.txt": b"c\n"})
+    commit("first")
+    write_files(worktree, {"a.txt": b"changed\n", "dir/new.txt": b"new\n"})
+    os.remove(os.path.join(worktree, "dir", "c.txt"))
+    capsys.readouterr()
+    libvcs.main(["status", "-s"])
+    assert capsys.readouterr().out.splitlines() == ["M a.txt", "D dir/c.txt", "A dir/new.txt"]
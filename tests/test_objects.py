@@ -0,0 +1,43 @@
+import os
+
+import libvcs
+from conftest import commit, write_files
+
+
+def test_tree_round_trip_keeps_leading_zeros():
+    items = [libvcs.vcsTreeLeaf(b"100644", b"a.txt", "00" * 3 + "ab" * 17),
+             libvcs.vcsTreeLeaf(b"40000", b"dir", "0f" + "12" * 19)]
+    obj = libvcs.vcsTree(None)
+    obj.items = items
+    raw = libvcs.tree_serialize(obj)
+    parsed = libvcs.parse_tree(raw)
+    assert [(i.mode, i.path, i.sha) for i in parsed] == [(i.mode, i.path, i.sha) for i in items]
+    assert libvcs.tree_parse_one(raw)[1].sha == items[0].sha
+
+
+def test_commit_with_many_parents_round_trip():
+    raw = b"tree " + b"1" * 40 + b"\n"
+    raw += b"".join(b"parent %040x\n" % i for i in range(5000))
+    raw += b"gpgsig line one\n line two\n\nmessage\n"
+    dct = libvcs.keyValueMessageParser(raw)
+    assert len(dct[b"parent"]) == 5000
+    assert dct[b"gpgsig"] == [b"line one\nline two"]
+    assert libvcs.keyValueMessageSerialize(dct) == raw
+
+
+def test_bulk_checkin_fsyncs_the_objects(worktree, monkeypatch):
+    with open(".vcs/config", "a") as f:
+        f.write("fsyncobjectfiles = true\n")
+    synced = list()
+    fsync = libvcs.path_fsync
+    monkeypatch.setattr(libvcs, "path_fsync", lambda path: synced.append(path) or fsync(path))
+    write_files(worktree, {"f{0}.txt".format(i): b"file %d\n" % i for i in range(20)})
+    head = commit("first")
+    repo = libvcs.repo_find()
+    objects = list(libvcs.loose_objects(repo))
+    assert head in objects and len(objects) == 22
+    # every object file of the batch and every fan-out directory it went to
+    names = [os.path.basename(path) for path in synced]
+    assert sum(name.startswith("tmp_obj_") for name in names) >= 21
+    assert {sha[0:2] for sha in objects} <= set(names)
+    assert not [name for name in os.listdir(".vcs/objects") if name.startswith("tmp_obj_")]
@@ -0,0 +1,89 @@
+import os
+import random
+import time
+
+import libvcs
+from conftest import commit, write_files
+
+
+def repetitive_text(lines):
+    """Returns lines lines of source like text where most lines are repeated many times"""
+    words = [b"    return self.value\n", b"}\n", b"\n", b"        x = x + 1\n", b"\n"]
+    return b"".join(words[i % 5] if i % 9 else b"line %d\n" % (i % 50) for i in range(lines))
+
+
+def test_delta_round_trip():
+    rng = random.Random(0)
+    pairs = [(b"", b""), (b"", b"new"), (b"old", b""), (b"same content\n" * 10, b"same content\n" * 10)]
+    for _ in range(200):
+        base = bytes(rng.choice(b"ab\n") for _ in range(rng.randint(0, 300)))
+        target = bytearray(base)
+        for _ in range(rng.randint(0, 5)):
+            i = rng.randint(0, len(target))
+            if rng.random() < 0.5:
+                target[i:i] = bytes(rng.choice(b"abc\n") for _ in range(rng.randint(1, 40)))
+            else:
+                del target[i:i + rng.randint(1, 40)]
+        pairs.append((base, bytes(target)))
+    for base, target in pairs:
+        assert libvcs.delta_apply(base, libvcs.delta_create(base, target)) == target
+
+
+def test_delta_large_repetitive_file():
+    base = repetitive_text(40000)
+    target = base.replace(b"line 7\n", b"changed 7\n", 1)
+    target = target[:150000] + b"inserted line\n" + target[150000:]
+    start = time.perf_counter()
+    delta = libvcs.delta_create(base, target)
+    elapsed = time.perf_counter() - start
+    assert libvcs.delta_apply(base, delta) == target
+    assert len(delta) < 200
+    assert elapsed < 2
+
+
+def test_delta_max_size():
+    rng = random.Random(1)
+    base = rng.randbytes(100000)
+    other = rng.randbytes(100000)
+    assert libvcs.delta_create(base, other, 50000) is None
+    edited = base[:5000] + b"edit" + base[5000:]
+    assert libvcs.delta_create(base, edited, 50000) is not None
+
+
+def test_repack_round_trip(worktree):
+    text = repetitive_text(5000)
+    rng = random.Random(2)
+    write_files(worktree, {"a.txt": text, "dir/b.bin": rng.randbytes(20000), "dir/c.txt": b"small\n"})
+    commit("first")
+    write_files(worktree, {"a.txt": text.replace(b"line 3\n", b"line three\n", 1)})
+    commit("second")
+    write_files(worktree, {"a.txt": text + b"appended\n", "dir/c.txt": b"changed\n"})
+    commit("third")
+
+    repo = libvcs.repo_find()
+    objects = {sha: libvcs.object_read_raw(repo, sha) for sha in libvcs.loose_objects(repo)}
+    libvcs.main(["repack", "-a", "-d"])
+
+    repo = libvcs.repo_find()
+    assert list(libvcs.loose_objects(repo)) == []
+    packs = libvcs.repo_packs(repo)
+    assert len(packs) == 1
+    assert sorted(packs[0].shas()) == sorted(objects)
+    for sha, raw in objects.items():
+        assert libvcs.object_read_raw(repo, sha) == raw
+    # the revisions of a.txt are stored as deltas
+    types = [packs[0].entry_header(packs[0].find(bytes.fromhex(sha)))[0] for sha in objects]
+    assert types.count(libvcs.PACK_OBJ_OFS_DELTA) >= 2
+
+
+def test_pack_written_by_another_process(worktree):
+    write_files(worktree, {"a.txt": b"content\n"})
+    commit("first")
+    repo = libvcs.repo_find()
+    shas = list(libvcs.loose_objects(repo))
+    assert libvcs.pack_find(repo, shas[0]) is None
+
+    # the pack is written through another repository object, as another process would
+    other = libvcs.repo_find()
+    libvcs.pack_write(other, shas)
+    assert libvcs.pack_find(repo, shas[0]) is not None
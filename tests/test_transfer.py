@@ -0,0 +1,127 @@
+import os
+
+import pytest
+
+import libvcs
+from conftest import commit, make_repo, read_files, write_files
+
+
+def ref(path, name):
+    """Returns the hash held by the reference name of the repository at path, or "" if there is none"""
+    return libvcs.ref_value(libvcs.vcsRepository(os.path.realpath(path)), name)
+
+
+@pytest.fixture
+def source(tmp_path, monkeypatch):
+    """A repository with two commits on master, the current directory being it's worktree"""
+    path = make_repo(str(tmp_path / "source"))
+    monkeypatch.chdir(path)
+    write_files(path, {"a.txt": b"a\n", "dir/b.txt": b"b\n"})
+    commit("first")
+    write_files(path, {"dir/b.txt": b"changed\n", "dir/sub/c.txt": b"c\n"})
+    commit("second")
+    return path
+
+
+def clone(source, path, monkeypatch):
+    """Clones source to path and makes path the current directory, with a user to commit as"""
+    libvcs.main(["clone", source, path])
+    monkeypatch.chdir(path)
+    with open(os.path.join(path, ".vcs", "userInfo"), "w") as f:
+        f.write("[info]\nname = test\nemail = test@example.com\n\n")
+
+
+def test_clone(source, tmp_path, monkeypatch, capsys):
+    path = str(tmp_path / "clone")
+    clone(source, path, monkeypatch)
+    assert read_files(path) == read_files(source)
+    head = ref(source, "refs/heads/master")
+    assert ref(path, "refs/heads/master") == head
+    assert ref(path, "refs/remotes/origin/master") == head
+    assert libvcs.ref_resolve(libvcs.repo_find(), "HEAD") == head
+
+    # the index comes from the checkout: the hashes of the trees and the stat data of the files written
+    repo = libvcs.repo_find()
+    index = libvcs.index_read(repo)
+    assert sorted(index.entries) == ["a.txt", "dir/b.txt", "dir/sub/c.txt"]
+    for name, entry in index.entries.items():
+        full = os.path.join(path, name)
+        assert entry.matches(os.stat(full))
+        with open(full, "rb") as f:
+            assert entry.sha == libvcs.object_hash(f, b'blob')
+    capsys.readouterr()
+    libvcs.main(["status", "-s"])
+    assert capsys.readouterr().out == ""
+
+
+def test_fetch(source, tmp_path, monkeypatch):
+    path = str(tmp_path / "clone")
+    clone(source, path, monkeypatch)
+    old = ref(path, "refs/remotes/origin/master")
+
+    monkeypatch.chdir(source)
+    write_files(source, {"a.txt": b"new\n"})
+    new = commit("third")
+    monkeypatch.chdir(path)
+    libvcs.main(["fetch"])
+    assert ref(path, "refs/remotes/origin/master") == new
+    assert ref(path, "FETCH_HEAD") == new
+    # the local branch is left as it was, and the objects of the new commit are present
+    assert ref(path, "refs/heads/master") == old
+    assert libvcs.object_exists(libvcs.repo_find(), new)
+
+
+def test_push(source, tmp_path, monkeypatch):
+    path = str(tmp_path / "clone")
+    clone(source, path, monkeypatch)
+    write_files(path, {"a.txt": b"pushed\n"})
+    new = commit("pushed")
+
+    # the branch checked out in the source is refused
+    with pytest.raises(Exception, match="checked out"):
+        libvcs.main(["push"])
+    assert ref(source, "refs/heads/master") != new
+
+    with open(os.path.join(source, ".vcs", "config"), "a") as f:
+        f.write("\n[receive]\ndenycurrentbranch = ignore\n")
+    libvcs.main(["push"])
+    assert ref(source, "refs/heads/master") == new
+    assert ref(path, "refs/remotes/origin/master") == new
+    assert libvcs.object_exists(libvcs.vcsRepository(os.path.realpath(source)), new)
+
+    # a push which would lose the commits of the source is refused unless forced
+    monkeypatch.chdir(source)
+    write_files(source, {"dir/b.txt": b"source side\n"})
+    theirs = commit("source side")
+    monkeypatch.chdir(path)
+    write_files(path, {"dir/b.txt": b"clone side\n"})
+    ours = commit("clone side")
+    with pytest.raises(Exception, match="fetch them first"):
+        libvcs.main(["push"])
+    assert ref(source, "refs/heads/master") == theirs
+    libvcs.main(["push", "-f"])
+    assert ref(source, "refs/heads/master") == ours
+
+
+def test_locked_reference_leaves_references_unchanged(source, tmp_path, monkeypatch):
+    path = str(tmp_path / "clone")
+    clone(source, path, monkeypatch)
+    repo = libvcs.repo_find()
+    head = ref(path, "refs/heads/master")
+    write_files(path, {"a.txt": b"other\n"})
+    new = commit("other")
+
+    lock = os.path.join(path, ".vcs", "refs", "heads", "topic.lock")
+    open(lock, "w").close()
+    with pytest.raises(Exception, match="locked"):
+        libvcs.ref_transaction(repo, [("refs/heads/master", new, head), ("refs/heads/topic", "", new)])
+    assert ref(path, "refs/heads/master") == new
+    assert ref(path, "refs/heads/topic") == ""
+    assert not os.path.exists(os.path.join(path, ".vcs", "refs", "heads", "master.lock"))
+    os.remove(lock)
+
+    # a reference changed since it was read isn't updated either
+    with pytest.raises(Exception, match="changed by another process"):
+        libvcs.ref_transaction(repo, [("refs/heads/topic", "", new), ("refs/heads/master", head, head)])
+    assert ref(path, "refs/heads/topic") == ""
+    assert ref(path, "refs/heads/master") == new